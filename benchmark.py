@@ -0,0 +1,233 @@
+"""Measure what a latency probe cycle costs, against a fake ping binary.
+
+A deterministic stand-in `ping` is put first on PATH. It prints canned Linux
+or Windows output after a configurable delay, dropping a configurable share
+of packets, so results depend on this code and not on the network. Results
+are printed (or saved) as JSON so runs on different commits can be diffed:
+
+    python3 benchmark.py --output bench_output.txt
+    python3 benchmark.py --format windows --loss 0.2 --delay_ms 5
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import monitoring
+import ping_wrapper
+from my_exceptions import NoConnectionException
+
+_TARGET_COUNTS = (1, 10, 100)
+
+_FAKE_PING = r'''#!{python}
+"""Stand-in for ping, see benchmark.py"""
+import os, random, sys, time
+
+args = sys.argv[1:]
+ip = args[-1]
+count = 1
+for flag in ("-c", "-n"):
+    if flag in args:
+        count = int(args[args.index(flag) + 1])
+delay = float(os.environ.get("FAKE_PING_DELAY_MS", "0")) / 1000
+loss = float(os.environ.get("FAKE_PING_LOSS", "0"))
+windows = os.environ.get("FAKE_PING_FORMAT") == "windows"
+rng = random.Random("{{}}-{{}}".format(os.environ.get("FAKE_PING_SEED", "0"), ip))
+
+times = []
+lines = ["Pinging {{}} with 32 bytes of data:".format(ip) if windows
+         else "PING {{0}} ({{0}}) 56(84) bytes of data.".format(ip)]
+for seq in range(1, count + 1):
+    time.sleep(delay)
+    if rng.random() < loss:
+        if windows:
+            lines.append("Request timed out.")
+        continue
+    rtt = 10 + rng.random() * 5
+    times.append(rtt)
+    if windows:
+        lines.append("Reply from {{}}: bytes=32 time={{}}ms TTL=117".format(ip, int(rtt)))
+    else:
+        lines.append("64 bytes from {{}}: icmp_seq={{}} ttl=117 time={{:.1f}} ms".format(ip, seq, rtt))
+
+received = len(times)
+lines.append("")
+if windows:
+    lines.append("Ping statistics for {{}}:".format(ip))
+    lines.append("    Packets: Sent = {{}}, Received = {{}}, Lost = {{}} ({{}}% loss),".format(
+        count, received, count - received, 100 * (count - received) // count))
+    if times:
+        lines.append("    Minimum = {{}}ms, Maximum = {{}}ms, Average = {{}}ms".format(
+            int(min(times)), int(max(times)), int(sum(times) / received)))
+else:
+    lines.append("--- {{}} ping statistics ---".format(ip))
+    lines.append("{{}} packets transmitted, {{}} received, {{}}% packet loss, time {{}}ms".format(
+        count, received, 100 * (count - received) // count, int(delay * 1000 * count)))
+    if times:
+        avg = sum(times) / received
+        mdev = (sum(t * t for t in times) / received - avg * avg) ** 0.5
+        lines.append("rtt min/avg/max/mdev = {{:.3f}}/{{:.3f}}/{{:.3f}}/{{:.3f}} ms".format(
+            min(times), avg, max(times), mdev))
+print("\n".join(lines))
+sys.exit(0 if times else 1)
+'''
+
+
+def install_fake_ping(directory):
+    """Write the fake ping into directory and put it first on PATH."""
+    path = os.path.join(directory, "ping")
+    with open(path, "w") as handle:
+        handle.write(_FAKE_PING.format(python=sys.executable))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ["PATH"] = directory + os.pathsep + os.environ.get("PATH", "")
+
+
+def measure(name, target_count, function, iterations):
+    """Run function iterations times, return a dict of timing/allocation stats."""
+    function()  # warm up: imports, event loop, caches
+
+    wall_ms = []
+    cpu_ms = []
+    child_cpu_ms = []
+    for _ in range(iterations):
+        before_times = os.times()
+        before_cpu = time.process_time()
+        start = time.perf_counter()
+        function()
+        wall_ms.append((time.perf_counter() - start) * 1000)
+        cpu_ms.append((time.process_time() - before_cpu) * 1000)
+        after_times = os.times()
+        child_cpu_ms.append(((after_times.children_user - before_times.children_user)
+                             + (after_times.children_system - before_times.children_system)) * 1000)
+
+    # allocations are counted in a separate run, tracemalloc slows everything down
+    tracemalloc.start()
+    function()
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = snapshot.statistics("filename")
+
+    return {
+        "name": name,
+        "targets": target_count,
+        "iterations": iterations,
+        "wall_ms_mean": statistics.mean(wall_ms),
+        "wall_ms_median": statistics.median(wall_ms),
+        "wall_ms_max": max(wall_ms),
+        "cpu_ms_mean": statistics.mean(cpu_ms),
+        "child_cpu_ms_mean": statistics.mean(child_cpu_ms),
+        "alloc_peak_kib": peak / 1024,
+        "alloc_live_blocks": sum(statistic.count for statistic in stats),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def ignore_lost_pings(function, *args, **kwargs):
+    """Call function. ping() and ping_parallel() raise on a lost packet (see --loss), that still counts as a run."""
+    try:
+        function(*args, **kwargs)
+    except NoConnectionException:
+        pass
+
+
+def run_benchmarks(iterations, target_counts=_TARGET_COUNTS):
+    results = []
+
+    results.append(measure("ping", 1, lambda: ignore_lost_pings(ping_wrapper.ping, "10.0.0.1", 2), iterations))
+
+    for count in target_counts:
+        targets = list("10.0.{}.{}".format(n // 250, n % 250 + 1) for n in range(count))
+        results.append(measure("ping_parallel", count, lambda t=targets: ignore_lost_pings(
+            ping_wrapper.ping_parallel, t, sample_count=1), iterations))
+
+    results.append(measure("log_latency", 1, lambda: monitoring.log_latency("10.0.0.1", sample_interval=2),
+                           iterations))
+
+    # the latency tick the monitor runs by default
+    for count in target_counts:
+        targets = list("10.0.{}.{}".format(n // 250, n % 250 + 1) for n in range(count))
+        tiers = (("lan", []), ("isp", []), ("remote", targets))
+        results.append(measure("log_latency_consensus", count, lambda t=tiers: monitoring.log_latency_consensus(
+            t, sample_interval=2), iterations))
+
+    return results
+
+
+def redirect_output(directory):
+    """Point every file the monitor writes into directory, and ship nothing."""
+    monitoring._OUTPUT_CSV = os.path.join(directory, "output.csv")
+    if monitoring._OUTPUT_COLUMNS is not None:
+        monitoring._OUTPUT_COLUMNS = os.path.join(directory, "output.columns")
+    if monitoring._OUTPUT_SQLITE is not None:
+        monitoring._OUTPUT_SQLITE = os.path.join(directory, "output.sqlite")
+    if monitoring._OUTAGE_LOG is not None:
+        monitoring._OUTAGE_LOG = os.path.join(directory, "outages.jsonl")
+    if monitoring._OUTPUT_LATENCY_SKETCHES is not None:
+        monitoring._OUTPUT_LATENCY_SKETCHES = os.path.join(directory, "latency_sketches.jsonl")
+    if monitoring._STATS_FILE is not None:
+        monitoring._STATS_FILE = os.path.join(directory, "monitor_stats.jsonl")
+    monitoring._SHIP_TO = None
+    monitoring._SHIP_SPOOL_DIRECTORY = os.path.join(directory, "spool")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the latency probe path against a fake ping.')
+    parser.add_argument('--iterations', type=int, default=20, help='timed runs per benchmark')
+    parser.add_argument('--format', choices=('linux', 'windows'), default='linux', help='ping output to emulate')
+    parser.add_argument('--delay_ms', type=float, default=0, help='fake ping delay per packet')
+    parser.add_argument('--loss', type=float, default=0, help='share of packets the fake ping drops, 0-1')
+    parser.add_argument('--seed', default='0', help='seed for the fake ping\'s loss and latency')
+    parser.add_argument('--output', help='save JSON here instead of printing it')
+    args = parser.parse_args()
+
+    os.environ["FAKE_PING_FORMAT"] = args.format
+    os.environ["FAKE_PING_DELAY_MS"] = str(args.delay_ms)
+    os.environ["FAKE_PING_LOSS"] = str(args.loss)
+    os.environ["FAKE_PING_SEED"] = args.seed
+
+    # always go through the ping binary, never the in-process ICMP socket
+    ping_wrapper._PREFER_NATIVE_ICMP = False
+
+    with tempfile.TemporaryDirectory() as directory:
+        install_fake_ping(directory)
+        redirect_output(directory)
+        # keep the console printer's output out of the JSON
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = run_benchmarks(args.iterations)
+            monitoring.close_writers()
+
+    report = json.dumps({
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": vars(args),
+        "results": results,
+    }, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, "w") as handle:
+            print(report, file=handle)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""Receive batches of CSV rows from monitors' shippers (see shipper.py) and store them per site.
+
+    python3 collector.py --directory sites --http_port 8080 --tcp_port 9000
+
+and on each monitor, e.g. monitoring._SHIP_TO = "http://collector:8080/ingest".
+
+Each site gets <directory>/<site>/output.csv, in the monitor's own format, so
+summary.py reads it as it is:
+
+    python3 summary.py --csv_input_filename sites/home/output.csv
+
+Batches are appended in the order they arrive: a monitor that was offline
+adds its backlog when it comes back (summary.py sorts every series by time
+before graphing or summarizing it), and several monitors can feed one site
+(use --link, or a site each, to tell them apart).
+Once a batch's rows are on disk its sequence number is recorded in
+<site>/shippers.json; a batch from a shipper whose sequence is not above the
+last one stored is a resend and is acknowledged without being stored again."""
+import argparse
+import gzip
+import http.server
+import json
+import logging
+import os
+import re
+import socketserver
+import threading
+import time
+import zlib
+
+from shipper import split_batch_id
+
+_SITE_REGEX = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9._-]*$")
+# the largest gzipped batch accepted, ~100 times the default batch
+_MAX_BATCH_BYTES = 16 * 1000 * 1000
+
+
+class SiteStore:
+    """One site's output.csv and the last sequence stored from each of its shippers."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._csv_filename = os.path.join(directory, "output.csv")
+        self._shippers_filename = os.path.join(directory, "shippers.json")
+        try:
+            with open(self._shippers_filename) as handle:
+                self._last_sequences = json.load(handle)
+        except FileNotFoundError:
+            self._last_sequences = {}
+        self._handle = None
+        self._lock = threading.Lock()
+
+    def store(self, shipper_id, sequence, text):
+        """Append text unless this batch was stored before. Returns True if it was appended."""
+        with self._lock:
+            if sequence <= self._last_sequences.get(shipper_id, -1):
+                return False
+            if self._handle is None:
+                self._handle = open(self._csv_filename, "a")
+            self._handle.write(text if text.endswith("\n") or not text else text + "\n")
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+
+            self._last_sequences[shipper_id] = sequence
+            with open(self._shippers_filename + ".tmp", "w") as handle:
+                json.dump(self._last_sequences, handle, indent=1)
+            os.replace(self._shippers_filename + ".tmp", self._shippers_filename)
+            return True
+
+    def close(self):
+        with self._lock:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+
+
+class Collector:
+    """The site stores under directory, opened as batches for them arrive. Safe to share between threads."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._sites = {}
+        self._lock = threading.Lock()
+
+    def site_store(self, site):
+        if not _SITE_REGEX.match(site):
+            raise ValueError("bad site name {!r}".format(site))
+        with self._lock:
+            store = self._sites.get(site)
+            if store is None:
+                store = self._sites[site] = SiteStore(os.path.join(self.directory, site))
+            return store
+
+    def receive(self, batch_id, site, payload):
+        """Store one gzipped batch. Returns True if stored, False if it was a resend. Raises ValueError if it's bad."""
+        shipper_id, sequence = split_batch_id(batch_id)
+        store = self.site_store(site)
+        try:
+            text = gzip.decompress(payload).decode("utf-8")
+        except (OSError, EOFError, zlib.error, UnicodeDecodeError) as e:
+            raise ValueError("batch {} from {}: {}".format(batch_id, site, e))
+        stored = store.store(shipper_id, sequence, text)
+        logging.debug("{} batch {} from {} ({} bytes)".format(
+            "stored" if stored else "already had", batch_id, site, len(payload)))
+        return stored
+
+    def close(self):
+        with self._lock:
+            for store in self._sites.values():
+                store.close()
+
+
+class CollectorHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Take batches POSTed by shipper.HttpTransport, on any path."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, collector):
+        self.collector = collector
+        super().__init__(address, CollectorRequestHandler)
+
+
+class CollectorRequestHandler(http.server.BaseHTTPRequestHandler):
+    server_version = "internet_connection_monitor_collector"
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            self.send_error(411)
+            return
+        if length > _MAX_BATCH_BYTES:
+            self.send_error(413)
+            return
+        payload = self.rfile.read(length)
+        try:
+            self.server.collector.receive(self.headers.get("X-Batch-Id", ""), self.headers.get("X-Site", ""),
+                                          payload)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except Exception:
+            logging.exception("storing a batch failed")
+            self.send_error(500)
+            return
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug("collector http: " + format, *args)
+
+
+class CollectorTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Take batches from shipper.TcpTransport: a JSON header line, the batch, answered with "OK <batch id>"."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, collector):
+        self.collector = collector
+        super().__init__(address, CollectorTCPHandler)
+
+
+class CollectorTCPHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        # one connection carries batches until the shipper hangs up
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                header = json.loads(line.decode())
+                length = int(header["length"])
+                if length > _MAX_BATCH_BYTES:
+                    raise ValueError("batch of {} bytes is too big".format(length))
+                payload = self.rfile.read(length)
+                if len(payload) < length:
+                    return
+                self.server.collector.receive(str(header["batch_id"]), str(header["site"]), payload)
+            except (ValueError, KeyError, TypeError) as e:
+                # the stream can't be trusted to be in step any more
+                self.wfile.write("ERROR {}\n".format(e).encode())
+                return
+            self.wfile.write("OK {}\n".format(header["batch_id"]).encode())
+
+
+def start_servers(collector, http_address=None, tcp_address=None):
+    """Serve collector on daemon threads, return the servers (call shutdown() on each to stop)."""
+    servers = []
+    if http_address is not None:
+        servers.append(CollectorHTTPServer(http_address, collector))
+    if tcp_address is not None:
+        servers.append(CollectorTCPServer(tcp_address, collector))
+    for server in servers:
+        threading.Thread(target=server.serve_forever, name=type(server).__name__, daemon=True).start()
+        logging.info("{} on {}:{}".format(type(server).__name__, *server.server_address[:2]))
+    return servers
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Store samples pushed by monitors (see shipper.py), per site.')
+    parser.add_argument('--directory', default='sites', help='one subdirectory per site is made here')
+    parser.add_argument('--host', default='', help='address to listen on')
+    parser.add_argument('--http_port', type=int, default=8080, help='port for http:// shippers, 0 for none')
+    parser.add_argument('--tcp_port', type=int, default=0, help='port for tcp:// shippers, 0 for none')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every batch')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    collector = Collector(args.directory)
+    servers = start_servers(collector,
+                            (args.host, args.http_port) if args.http_port else None,
+                            (args.host, args.tcp_port) if args.tcp_port else None)
+    if not servers:
+        parser.error("nothing to listen on: give --http_port or --tcp_port")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    for server in servers:
+        server.shutdown()
+    collector.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""Samples as fixed-width binary columns, one append-only file per column.
+
+    output.columns/epoch_ms.i64   int64    ms since the epoch
+    output.columns/latency.f32    float32  ms, NaN when not measured
+    output.columns/down.f32       float32  Mbit/s, NaN when not measured
+    output.columns/up.f32         float32  Mbit/s, NaN when not measured
+    output.columns/state.u8       uint8    1 up, 0 down, 255 unknown
+    output.columns/interval.f32   float32  seconds the sample stands for, NaN if unknown
+
+Record n of every file is sample n, 25 bytes a sample against ~40 bytes of
+CSV text and nothing to parse. Writing only needs the standard library, so
+the monitor doesn't depend on numpy; readers map the files with numpy.memmap.
+
+Extra probe rows (tcp/dns/http) are not stored, the CSV keeps those. With
+several links (see monitoring._LINKS) each link's samples go to a store of
+their own in a subdirectory named after it (output.columns/eth0/...), see
+link_directory() and links().
+
+Convert an existing CSV (split or not) with:
+
+    python3 columnar_store.py --csv_input_filename output.csv --output_directory output.columns
+"""
+import argparse
+import csv
+import datetime
+import logging
+import math
+import os
+import threading
+import time
+from array import array
+
+import splitlogfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# (name, array typecode, numpy dtype), all native byte order
+COLUMNS = (
+    ("epoch_ms", "q", "=i8"),
+    ("latency", "f", "=f4"),
+    ("down", "f", "=f4"),
+    ("up", "f", "=f4"),
+    ("state", "B", "u1"),
+    ("interval", "f", "=f4"),
+)
+EXTENSIONS = {"q": ".i64", "f": ".f32", "B": ".u8"}
+
+STATE_DOWN = 0
+STATE_UP = 1
+STATE_UNKNOWN = 255
+
+# write the batch once it has this many samples or its oldest is this old
+# (a state change always writes), same as csv_writer
+_FLUSH_ROWS = 64
+_FLUSH_SECONDS = 10
+
+
+def column_filename(directory, name, typecode):
+    return os.path.join(directory, name + EXTENSIONS[typecode])
+
+
+def encode_float(value):
+    """Return value (a number or a CSV string) as stored, NaN for "" or None."""
+    if value is None or value == "":
+        return math.nan
+    return float(value)
+
+
+def encode_state(state_is_up):
+    """Return STATE_UP, STATE_DOWN or STATE_UNKNOWN for a bool or its CSV string."""
+    if state_is_up is True or state_is_up == "True":
+        return STATE_UP
+    if state_is_up is False or state_is_up == "False":
+        return STATE_DOWN
+    return STATE_UNKNOWN
+
+
+def link_directory(directory, link):
+    """Return the directory of link's store inside directory ("" = samples not tagged with a link)."""
+    return os.path.join(directory, link) if link else directory
+
+
+def links(directory):
+    """Return the links with samples in directory, "" for the untagged ones at its top, sorted."""
+    found = []
+    if record_count(directory):
+        found.append("")
+    if os.path.isdir(directory):
+        for name in sorted(os.listdir(directory)):
+            if os.path.isdir(os.path.join(directory, name)) and record_count(os.path.join(directory, name)):
+                found.append(name)
+    return found
+
+
+def record_count(directory):
+    """Return the number of complete records, i.e. the length of the shortest column."""
+    counts = []
+    for name, typecode, _ in COLUMNS:
+        try:
+            size = os.path.getsize(column_filename(directory, name, typecode))
+        except FileNotFoundError:
+            size = 0
+        counts.append(size // array(typecode).itemsize)
+    return min(counts)
+
+
+class ColumnarWriter:
+    """Append samples to the column files in batches. Safe to share between threads.
+
+    Samples tagged with a link are passed on to a writer of link_directory()."""
+
+    def __init__(self, directory, flush_rows=_FLUSH_ROWS, flush_seconds=_FLUSH_SECONDS):
+        self.directory = directory
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self._oldest_row_time = None
+        self._buffers = list(array(typecode) for _, typecode, _ in COLUMNS)
+        self._handles = None
+        self._last_state = None
+        # {link: ColumnarWriter}
+        self._link_writers = {}
+        self._lock = threading.Lock()
+
+    def write_sample(self, unixtime, latency="", down_bandwidth="", up_bandwidth="", state_is_up="",
+                     sample_interval=None, tier_states=None, link=""):
+        """Queue one sample. Values may be numbers or the strings save_to_csv writes, "" for none.
+
+        tier_states is accepted for the same signature as sqlite_store, but not stored."""
+        if link:
+            self._link_writer(link).write_sample(unixtime, latency, down_bandwidth, up_bandwidth, state_is_up,
+                                                 sample_interval)
+            return
+        state = encode_state(state_is_up)
+        values = (int(round(unixtime * 1000)), encode_float(latency), encode_float(down_bandwidth),
+                  encode_float(up_bandwidth), state, encode_float(sample_interval))
+        with self._lock:
+            now = time.monotonic()
+            if not len(self._buffers[0]):
+                self._oldest_row_time = now
+            for buffer, value in zip(self._buffers, values):
+                buffer.append(value)
+
+            state_changed = (state != STATE_UNKNOWN and self._last_state is not None
+                             and state != self._last_state)
+            if state != STATE_UNKNOWN:
+                self._last_state = state
+            if (state_changed or len(self._buffers[0]) >= self.flush_rows
+                    or now - self._oldest_row_time >= self.flush_seconds):
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+            link_writers = list(self._link_writers.values())
+        for writer in link_writers:
+            writer.flush()
+
+    def flush_if_due(self):
+        with self._lock:
+            if len(self._buffers[0]) and time.monotonic() - self._oldest_row_time >= self.flush_seconds:
+                self._flush_locked()
+            link_writers = list(self._link_writers.values())
+        for writer in link_writers:
+            writer.flush_if_due()
+
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            if self._handles is not None:
+                for handle in self._handles:
+                    handle.close()
+                self._handles = None
+            link_writers = list(self._link_writers.values())
+        for writer in link_writers:
+            writer.close()
+
+    def _link_writer(self, link):
+        with self._lock:
+            writer = self._link_writers.get(link)
+            if writer is None:
+                writer = self._link_writers[link] = ColumnarWriter(link_directory(self.directory, link),
+                                                                   self.flush_rows, self.flush_seconds)
+            return writer
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # a crash between column writes leaves some columns a record ahead: drop the partial record
+        count = record_count(self.directory)
+        self._handles = []
+        for name, typecode, _ in COLUMNS:
+            handle = open(column_filename(self.directory, name, typecode), "ab")
+            handle.truncate(count * array(typecode).itemsize)
+            self._handles.append(handle)
+
+    def _flush_locked(self):
+        if not len(self._buffers[0]):
+            return
+        if self._handles is None:
+            self._open()
+        for handle, buffer in zip(self._handles, self._buffers):
+            buffer.tofile(handle)
+            handle.flush()
+        self._buffers = list(array(typecode) for _, typecode, _ in COLUMNS)
+
+
+def load(directory, start=None, end=None):
+    """Map the column files and return {name: numpy array} for samples between start and end.
+
+    start and end are datetimes, None for open. The arrays are read-only views
+    of the files, pages are only read when the values are used. Samples are
+    assumed to be in time order, as the monitor writes them."""
+    if numpy is None:
+        raise RuntimeError("reading {} needs numpy".format(directory))
+
+    count = record_count(directory)
+    columns = {}
+    for name, typecode, dtype in COLUMNS:
+        if count:
+            columns[name] = numpy.memmap(column_filename(directory, name, typecode), dtype=dtype,
+                                         mode="r", shape=(count,))
+        else:
+            # mmap can't map an empty file
+            columns[name] = numpy.empty(0, dtype=dtype)
+
+    first, last = 0, count
+    if start is not None:
+        first = int(numpy.searchsorted(columns["epoch_ms"], int(start.timestamp() * 1000), side="left"))
+    if end is not None:
+        last = int(numpy.searchsorted(columns["epoch_ms"], int(end.timestamp() * 1000), side="right"))
+    return dict((name, values[first:last]) for name, values in columns.items())
+
+
+def local_datetime64s(epoch_ms):
+    """Return naive local datetime64[ms]s (like the CSV's dates) for an array of epoch ms.
+
+    The UTC offset is looked up once per distinct hour instead of once per
+    sample, the conversion itself happens inside numpy."""
+    epoch_ms = numpy.asarray(epoch_ms, dtype="=i8")
+    if not len(epoch_ms):
+        return epoch_ms.astype("datetime64[ms]")
+    hours, hour_index = numpy.unique(epoch_ms // 3600000, return_inverse=True)
+    offsets_ms = numpy.array(list(_utc_offset_ms(hour * 3600) for hour in hours.tolist()), dtype="=i8")
+    local_ms = epoch_ms + offsets_ms[hour_index.reshape(-1)]
+    return local_ms.astype("datetime64[ms]")
+
+
+def _utc_offset_ms(unixtime):
+    return int(datetime.datetime.fromtimestamp(unixtime).astimezone().utcoffset().total_seconds() * 1000)
+
+
+def _unixtime_from_date_and_time_string(date_string, time_string):
+    # same format as summary.datetime_from_date_and_time_string, without strptime
+    microsecond = 0
+    if "." in time_string:
+        time_string, fraction = time_string.split(".")
+        microsecond = int(fraction.ljust(6, "0")[:6])
+    return datetime.datetime(int(date_string[0:4]), int(date_string[5:7]), int(date_string[8:10]),
+                             int(time_string[0:2]), int(time_string[3:5]), int(time_string[6:8]),
+                             microsecond).timestamp()
+
+
+def convert_csv(csv_filename, directory):
+    """Append every sample of the output CSV (split or not) to the store in directory. Returns the count."""
+    if links(directory):
+        raise ValueError("{} already has samples, convert into an empty directory".format(directory))
+
+    def lines():
+        if os.path.exists(csv_filename):
+            with open(csv_filename, "r") as handle:
+                yield from handle
+        if splitlogfile.has_manifest(csv_filename):
+            yield from splitlogfile.iter_lines(csv_filename)
+
+    writer = ColumnarWriter(directory, flush_rows=65536)
+    count = 0
+    for row in csv.reader(lines()):
+        if len(row) < 6:
+            continue
+        # col 14: extra probe rows
+        if len(row) > 14 and row[14] != "":
+            continue
+        writer.write_sample(_unixtime_from_date_and_time_string(row[0], row[1]),
+                            latency=row[2], down_bandwidth=row[3], up_bandwidth=row[4], state_is_up=row[5],
+                            sample_interval=row[15] if len(row) > 15 else None,
+                            link=row[19] if len(row) > 19 else "")
+        count += 1
+    writer.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert the output CSV to a columnar sample store.')
+    parser.add_argument('--csv_input_filename', default='output.csv', help='csv (or split csv base name) to read')
+    parser.add_argument('--output_directory', default='output.columns', help='directory to write the columns to')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    start = time.perf_counter()
+    count = convert_csv(args.csv_input_filename, args.output_directory)
+    logging.info("converted {} samples in {:.1f}s".format(count, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
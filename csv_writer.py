@@ -0,0 +1,131 @@
+"""Append rows to the output CSV without reopening it for every sample.
+
+Rows are batched in memory and written when enough have piled up, when they
+get old, or straight away when the connection state changes. The file is
+fsync'd on its own (longer) interval, so an SD card sees a handful of writes
+a minute instead of an open/append/close per sample."""
+import logging
+import os
+import signal
+import threading
+import time
+
+# write the batch once it has this many rows...
+_FLUSH_ROWS = 64
+# ...or its oldest row is this old
+_FLUSH_SECONDS = 10
+# and fsync at most this often (a state change always fsyncs)
+_FSYNC_SECONDS = 60
+
+
+class TimestampFormatter:
+    """Format the date and time columns without strftime.
+
+    The date string is rebuilt once a day and the time string once a second,
+    every other row reuses the cached strings."""
+
+    def __init__(self):
+        self._day = None
+        self._date_string = None
+        self._second_of_day = None
+        self._time_string = None
+
+    def date_string(self, date_time):
+        day = date_time.toordinal()
+        if day != self._day:
+            self._day = day
+            self._date_string = "%04d-%02d-%02d" % (date_time.year, date_time.month, date_time.day)
+        return self._date_string
+
+    def time_string(self, date_time):
+        second_of_day = date_time.hour * 3600 + date_time.minute * 60 + date_time.second
+        if second_of_day != self._second_of_day:
+            self._second_of_day = second_of_day
+            self._time_string = "%02d:%02d:%02d" % (date_time.hour, date_time.minute, date_time.second)
+        return self._time_string
+
+
+class BufferedCsvWriter:
+    """Keep the CSV open and write rows to it in batches. Safe to share between threads.
+
+    target is a filename to append to, or an object with write(), flush(),
+    fileno() and close(), e.g. a splitlogfile.SplitIntoChunksByWriteDate."""
+
+    def __init__(self, target, flush_rows=_FLUSH_ROWS, flush_seconds=_FLUSH_SECONDS,
+                 fsync_seconds=_FSYNC_SECONDS):
+        if hasattr(target, "write"):
+            self.filename = getattr(target, "base_filename", repr(target))
+            self._target = target
+        else:
+            self.filename = target
+            self._target = None
+        self._handle = self._target
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.fsync_seconds = fsync_seconds
+        self._rows = []
+        self._oldest_row_time = None
+        self._last_fsync_time = time.monotonic()
+        self._last_state_is_up = None
+        self._lock = threading.Lock()
+
+    def write_row(self, fields, state_is_up=None):
+        """Queue one row. Pass the row's state to flush as soon as it changes."""
+        line = ",".join(fields)
+        with self._lock:
+            now = time.monotonic()
+            if not self._rows:
+                self._oldest_row_time = now
+            self._rows.append(line)
+
+            state_changed = (state_is_up is not None
+                             and self._last_state_is_up is not None
+                             and state_is_up != self._last_state_is_up)
+            if state_is_up is not None:
+                self._last_state_is_up = state_is_up
+
+            if state_changed:
+                self._flush_locked(fsync=True)
+            elif (len(self._rows) >= self.flush_rows
+                    or now - self._oldest_row_time >= self.flush_seconds):
+                self._flush_locked()
+
+    def flush(self, fsync=False):
+        with self._lock:
+            self._flush_locked(fsync)
+
+    def flush_if_due(self):
+        """Flush rows that have waited too long, for callers that write rarely."""
+        with self._lock:
+            if self._rows and time.monotonic() - self._oldest_row_time >= self.flush_seconds:
+                self._flush_locked()
+
+    def close(self):
+        with self._lock:
+            self._flush_locked(fsync=True)
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+
+    def _flush_locked(self, fsync=False):
+        if self._rows:
+            if self._handle is None:
+                # a target reopens its own file on the next write
+                self._handle = self._target if self._target is not None else open(self.filename, "a")
+            self._handle.write("\n".join(self._rows) + "\n")
+            self._handle.flush()
+            self._rows = []
+
+        if self._handle is not None and (fsync or time.monotonic() - self._last_fsync_time >= self.fsync_seconds):
+            os.fsync(self._handle.fileno())
+            self._last_fsync_time = time.monotonic()
+
+    def install_signal_handler(self, signum=signal.SIGTERM):
+        """Turn signum into a normal exit, so the caller's own cleanup gets to close this writer.
+
+        Call from the main thread. The handler only raises SystemExit: flushing
+        from inside it could deadlock on a lock the main thread already holds."""
+        def handler(received_signum, frame):
+            logging.info("got signal {}, exiting".format(received_signum))
+            raise SystemExit(0)
+        signal.signal(signum, handler)
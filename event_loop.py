@@ -0,0 +1,77 @@
+"""Give each thread its own long-lived asyncio event loop.
+
+Blocking callers (monitoring's PeriodicEvent callbacks, ping_parallel) use
+run_sync() to drive coroutines without paying for a new loop on every call."""
+import asyncio
+import contextlib
+import logging
+import signal
+import threading
+
+_thread_state = threading.local()
+
+
+def get_thread_event_loop():
+    """Return this thread's event loop, creating it on first use."""
+    loop = getattr(_thread_state, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        _thread_state.loop = loop
+    return loop
+
+
+def run_sync(coroutine):
+    """Run a coroutine to completion on this thread's event loop.
+
+    If ctrl+c (or a SystemExit from a signal handler) stops it half way, the
+    loop is closed with close_thread_event_loop() before the exception goes on."""
+    loop = get_thread_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    except (KeyboardInterrupt, SystemExit):
+        # a second ctrl+c mustn't leave the cancelled tasks half finished
+        with exit_signals_ignored():
+            close_thread_event_loop()
+        raise
+
+
+def close_thread_event_loop():
+    """Cancel the tasks left on this thread's event loop, wait for them to finish, then close it."""
+    loop = getattr(_thread_state, "loop", None)
+    if loop is None or loop.is_closed():
+        return
+    try:
+        if hasattr(asyncio, "all_tasks"):
+            tasks = asyncio.all_tasks(loop)
+        else:
+            # python 3.6, which also lists the finished tasks
+            tasks = {task for task in asyncio.Task.all_tasks(loop) if not task.done()}
+        for task in tasks:
+            task.cancel()
+        # like asyncio.run(): let the cancelled tasks run their finally blocks
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        for task in tasks:
+            if not task.cancelled() and task.exception() is not None:
+                # get_name() is python 3.8+
+                name = task.get_name() if hasattr(task, "get_name") else repr(task)
+                logging.error("task {} failed while closing its event loop".format(name),
+                              exc_info=task.exception())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+    finally:
+        loop.close()
+
+
+@contextlib.contextmanager
+def exit_signals_ignored():
+    """Ignore SIGINT and SIGTERM inside the block, e.g. while shutting down. Does nothing off the main thread."""
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    previous_handlers = {}
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        previous_handlers[signum] = signal.signal(signum, signal.SIG_IGN)
+    try:
+        yield
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
@@ -0,0 +1,118 @@
+"""Render summary.py's graph on demand from the monitor's recent samples, for status_server.
+
+    /                 a page showing all the graphs
+    /graph_6h.png     the last 6 hours
+    /graph_24h.png    the last 24 hours
+    /graph_7d.png     the last 7 days
+    /graph_all.png    everything in the sample ring
+
+A graph is only rendered when someone asks for it and a sample arrived since
+it was last rendered; otherwise the cached PNG is sent, or 304 Not Modified if
+the client's copy (ETag / If-Modified-Since) is current. For graphs of the
+whole CSV history, run summary.py."""
+import email.utils
+import io
+import threading
+import time
+import uuid
+
+from columnar_store import COLUMNS
+
+_WINDOWS = (("6h", 6), ("24h", 24), ("7d", 7 * 24), ("all", None))
+
+# the ring's ids start again after a restart, so ETags from an earlier process must not match
+_ETAG_NONCE = uuid.uuid4().hex[:8]
+
+# pyplot keeps global state, so only one graph is drawn at a time
+_render_lock = threading.Lock()
+
+
+def _import_summary():
+    # matplotlib is only loaded once a graph is asked for, without a display
+    import matplotlib
+    matplotlib.use("Agg")
+    import summary
+    return summary
+
+
+def render_png(ring, hours):
+    """Draw the last hours (None = all) of the ring's samples, return PNG bytes."""
+    import numpy
+    summary = _import_summary()
+
+    start = None if hours is None else time.time() - hours * 3600
+    columns = ring.slice(start)
+    samples = summary.ColumnSamples(dict((name, numpy.frombuffer(columns[name], dtype=dtype))
+                                         for name, _, dtype in COLUMNS))
+
+    png = io.BytesIO()
+    with _render_lock:
+        samples.save_graph(png)
+    return png.getvalue()
+
+
+class GraphCache:
+    """The last PNG rendered for each window, and the ring's last_id when it was rendered."""
+
+    def __init__(self, ring):
+        self.ring = ring
+        self._graphs = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, hours, last_id):
+        """Return the PNG for window name at sample last_id, rendering it if it isn't cached."""
+        with self._lock:
+            cached = self._graphs.get(name)
+        if cached is not None and cached[0] == last_id:
+            return cached[1]
+        png = render_png(self.ring, hours)
+        with self._lock:
+            self._graphs[name] = (last_id, png)
+        return png
+
+
+def _not_modified(request_headers, etag, last_modified):
+    if_none_match = request_headers.get("If-None-Match")
+    if if_none_match is not None:
+        return etag in (tag.strip() for tag in if_none_match.split(",")) or if_none_match.strip() == "*"
+    if_modified_since = request_headers.get("If-Modified-Since")
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have whole seconds
+        return int(last_modified) <= since
+    return False
+
+
+def graph_routes(ring):
+    """Return the graph routes for a sample_ring.SampleRing, for status_server."""
+    cache = GraphCache(ring)
+
+    def graph(name, hours):
+        def route(query, request_headers):
+            # read both before rendering, so a sample arriving meanwhile makes the next request re-render
+            last_id = ring.last_id
+            latest = ring.latest()
+            last_modified = None if latest is None else latest["epoch_ms"] / 1000
+            etag = '"{}-{}-{}"'.format(_ETAG_NONCE, name, last_id)
+            headers = {"ETag": etag, "Cache-Control": "no-cache"}
+            if last_modified is not None:
+                headers["Last-Modified"] = email.utils.formatdate(last_modified, usegmt=True)
+
+            if _not_modified(request_headers, etag, last_modified):
+                return 304, None, b"", headers
+            return 200, "image/png", cache.get(name, hours, last_id), headers
+        return route
+
+    def index(query, request_headers):
+        images = "".join('<p><a href="graph_{0}.png"><img src="graph_{0}.png" width="800"></a></p>'.format(name)
+                         for name, _ in _WINDOWS)
+        page = "<!doctype html><title>internet connection monitor</title>{}".format(images)
+        return 200, "text/html; charset=utf-8", page.encode(), {}
+
+    routes = {"/": index}
+    for name, hours in _WINDOWS:
+        routes["/graph_{}.png".format(name)] = graph(name, hours)
+    return routes
@@ -0,0 +1,264 @@
+"""Ping from inside the process with ICMP sockets driven by asyncio.
+
+Unprivileged ICMP datagram sockets are used where the OS allows them (Linux
+with net.ipv4.ping_group_range covering our gid, macOS), otherwise raw sockets
+(root or CAP_NET_RAW). Raw sockets, and macOS's datagram ones, hand over the
+IP header too; it is stripped when there is one. If neither can be opened,
+or the event loop can't watch sockets (the Proactor loop, windows' default),
+is_available() returns False and ping_wrapper falls back to the ping binary."""
+import asyncio
+import ipaddress
+import itertools
+import os
+import socket
+import struct
+import time
+import weakref
+
+from my_exceptions import NoConnectionException
+from event_loop import run_sync
+
+# Same meaning as ping_wrapper._MAX_PING_TIME_SECONDS
+_MAX_PING_TIME_SECONDS = 2
+
+# Gap between echo requests when taking more than one sample. 0.2s is the
+# smallest interval the ping binary allows for unprivileged users.
+_SAMPLE_INTERVAL_SECONDS = 0.2
+
+_ICMP_ECHO_REPLY = 0
+_ICMP_ECHO_REQUEST = 8
+_ICMP_HEADER = struct.Struct("!BBHHH")
+_PAYLOAD = b"internet_connection_monitor\x00\x00\x00\x00\x00"
+
+# SO_BINDTODEVICE from linux's socket.h, for pythons that don't define it
+_SO_BINDTODEVICE = getattr(socket, "SO_BINDTODEVICE", 25)
+
+_available = None
+# {loop: {source: IcmpProber}}
+_probers = weakref.WeakKeyDictionary()
+# numbers each prober in this process, so their raw sockets can tell their replies apart
+_prober_numbers = itertools.count()
+
+
+def checksum(data):
+    """Return the RFC 1071 internet checksum of data."""
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(struct.unpack("!{}H".format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def build_echo_request(identifier, sequence, payload=_PAYLOAD):
+    header = _ICMP_HEADER.pack(_ICMP_ECHO_REQUEST, 0, 0, identifier, sequence)
+    return _ICMP_HEADER.pack(_ICMP_ECHO_REQUEST, 0, checksum(header + payload),
+                             identifier, sequence) + payload
+
+
+def open_icmp_socket():
+    """Open a non-blocking ICMP socket, return (socket, is_raw)."""
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        is_raw = False
+    except OSError:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        is_raw = True
+    sock.setblocking(False)
+    return sock, is_raw
+
+
+def bind_to_source(sock, source):
+    """Send sock's packets from source: a local IPv4 address, or an interface name (linux only)."""
+    try:
+        ipaddress.IPv4Address(source)
+    except ValueError:
+        sock.setsockopt(socket.SOL_SOCKET, _SO_BINDTODEVICE, source.encode() + b"\x00")
+    else:
+        sock.bind((source, 0))
+
+
+def is_available():
+    """Return True if this process may open an ICMP socket and its event loops can watch it."""
+    global _available
+    if _available is None:
+        proactor_policy = getattr(asyncio, "WindowsProactorEventLoopPolicy", None)
+        if proactor_policy is not None and isinstance(asyncio.get_event_loop_policy(), proactor_policy):
+            # no add_reader
+            _available = False
+            return _available
+        try:
+            sock, _ = open_icmp_socket()
+        except OSError:
+            _available = False
+        else:
+            sock.close()
+            _available = True
+    return _available
+
+
+class IcmpProber:
+    """One ICMP socket shared by every probe running on an event loop.
+
+    Replies are matched to outstanding requests by identifier, sequence
+    number and address, so any number of probes to any number of hosts can be
+    in flight at once.
+
+    source is the interface name or local address to send from, see
+    bind_to_source(); None for whatever the routing table picks."""
+
+    def __init__(self, loop, source=None):
+        self.loop = loop
+        self.source = source
+        self.sock, self.is_raw = open_icmp_socket()
+        if source is not None:
+            try:
+                bind_to_source(self.sock, source)
+            except OSError:
+                self.sock.close()
+                raise
+        # datagram sockets get their identifier rewritten by the kernel, which
+        # also filters replies for us; raw sockets see everyone's replies,
+        # including those to the probers on other threads and sources, so
+        # each prober gets an identifier of its own.
+        self.identifier = (os.getpid() + next(_prober_numbers)) & 0xffff
+        self._sequence = itertools.count(1)
+        self._pending = {}
+        self._resolved = {}
+        loop.add_reader(self.sock.fileno(), self._on_readable)
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        for ip, future in self._pending.values():
+            if not future.done():
+                future.cancel()
+        self._pending.clear()
+
+    def _on_readable(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # e.g. ECONNREFUSED queued by an earlier ICMP error
+                return
+            receive_time = time.perf_counter()
+
+            # an ICMP message starts with its type, an IPv4 header with version 4
+            if data and data[0] >> 4 == 4:
+                data = data[(data[0] & 0x0f) * 4:]  # strip the IP header
+            if len(data) < _ICMP_HEADER.size:
+                continue
+            icmp_type, _, _, identifier, sequence = _ICMP_HEADER.unpack_from(data)
+            if icmp_type != _ICMP_ECHO_REPLY:
+                continue
+            if self.is_raw and identifier != self.identifier:
+                continue
+
+            ip, future = self._pending.get(sequence, (None, None))
+            if future is None or future.done() or ip != address[0]:
+                continue
+            future.set_result(receive_time)
+
+    async def resolve(self, host):
+        ip = self._resolved.get(host)
+        if ip is None:
+            try:
+                infos = await self.loop.getaddrinfo(host, None, family=socket.AF_INET)
+            except socket.gaierror as e:
+                raise NoConnectionException("could not resolve {}: {}".format(host, e))
+            ip = infos[0][4][0]
+            self._resolved[host] = ip
+        return ip
+
+    async def probe(self, host, timeout=_MAX_PING_TIME_SECONDS):
+        """Send one echo request, return the round trip time in ms."""
+        ip = await self.resolve(host)
+
+        sequence = next(self._sequence) & 0xffff
+        future = self.loop.create_future()
+        self._pending[sequence] = (ip, future)
+        try:
+            send_time = time.perf_counter()
+            try:
+                self.sock.sendto(build_echo_request(self.identifier, sequence), (ip, 0))
+            except OSError as e:
+                raise NoConnectionException("could not send to {}: {}".format(ip, e))
+            try:
+                receive_time = await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                raise NoConnectionException("no reply from {} within {}s".format(ip, timeout))
+        finally:
+            self._pending.pop(sequence, None)
+
+        return (receive_time - send_time) * 1000
+
+
+def get_prober(loop=None, source=None):
+    """Return the IcmpProber for loop (default: the running loop) sending from source."""
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    probers = _probers.get(loop)
+    if probers is None:
+        probers = _probers[loop] = {}
+    prober = probers.get(source)
+    if prober is None:
+        prober = IcmpProber(loop, source)
+        probers[source] = prober
+    return prober
+
+
+async def async_ping_and_return_samples(ip, sample_count=2, timeout=_MAX_PING_TIME_SECONDS, source=None):
+    """Ping an IP, return one latency in ms per sample_count, None for each lost sample."""
+    prober = get_prober(source=source)
+
+    async def delayed_probe(delay):
+        if delay:
+            await asyncio.sleep(delay)
+        return await prober.probe(ip, timeout)
+
+    results = await asyncio.gather(*(delayed_probe(n * _SAMPLE_INTERVAL_SECONDS)
+                                     for n in range(sample_count)),
+                                   return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception) and not isinstance(result, NoConnectionException):
+            raise result
+    return list(None if isinstance(result, NoConnectionException) else result
+                for result in results)
+
+
+async def async_ping_and_return_latency_list(ip, sample_count=2, timeout=_MAX_PING_TIME_SECONDS, source=None):
+    """Ping an IP, return a list of latencies in ms, one per sample_count.
+
+    Raises NoConnectionException if any sample is lost, like the ping binary
+    based version in ping_wrapper."""
+    samples = await async_ping_and_return_samples(ip, sample_count, timeout, source)
+    if None in samples:
+        raise NoConnectionException("{} of {} pings to {} got no reply".format(
+            samples.count(None), sample_count, ip))
+    return samples
+
+
+def ping_and_return_latency_list(ip, sample_count=2):
+    """Ping an IP, return a list of latencies in ms, one per sample_count."""
+    return run_sync(async_ping_and_return_latency_list(ip, sample_count))
+
+
+def ping(ip, sample_count=2):
+    """Ping an IP, return its average latency."""
+    latencies = ping_and_return_latency_list(ip, sample_count)
+    return sum(latencies) / len(latencies)  # average
+
+
+if __name__ == "__main__":
+    if not is_available():
+        print("ICMP sockets are not available to this user")
+    else:
+        for host in ("127.0.0.1", "8.8.8.8"):
+            try:
+                print("ping_and_return_latency_list('{}') = {}".format(
+                    host, ping_and_return_latency_list(host, 4)))
+            except NoConnectionException as e:
+                print("ping('{}') = Got NoConnectionException ({})".format(host, e))
@@ -0,0 +1,103 @@
+"""Time the monitor's own hot path and dump the timings as JSON lines.
+
+    @instrumentation.timed("save_to_csv")
+    def save_to_csv(...):
+
+Every call to a timed function adds its duration to a histogram under that
+name, and dump() appends one JSON line with each name's count, total, max and
+histogram since the previous dump to a stats file, then starts over:
+
+    {"time": 1604510176.2, "seconds": 60.0, "timers": {"save_to_csv": {"count": 30, ...}}, ...}
+
+Timing is off until enable() is called. Until then a timed function costs one
+extra call and a global lookup; nothing is measured or stored."""
+import functools
+import json
+import threading
+import time
+
+from metrics import Histogram
+
+# histogram bucket bounds in ms, from a fast save_to_csv to a slow speed test
+_DURATION_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000,
+                        60000)
+
+# None while disabled; a Timings once enable() is called
+_timings = None
+
+
+class Timings:
+    """Durations per name since the last reset. Safe to share between threads."""
+
+    def __init__(self, buckets=_DURATION_BUCKETS_MS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histogram = Histogram("duration_ms", "time spent per call", buckets, ["name"])
+        self._max = {}
+        self._since = time.time()
+
+    def record(self, name, milliseconds):
+        with self._lock:
+            self._histogram.observe(milliseconds, (name,))
+            if milliseconds > self._max.get(name, 0.0):
+                self._max[name] = milliseconds
+
+    def snapshot_and_reset(self):
+        """Return {name: stats dict} since the last reset, and the time of the last reset."""
+        with self._lock:
+            values, self._histogram.values = self._histogram.values, {}
+            maxima, self._max = self._max, {}
+            since, self._since = self._since, time.time()
+
+        timers = {}
+        for (name,), histogram_values in values.items():
+            timers[name] = {
+                "count": histogram_values.count,
+                "total_ms": round(histogram_values.sum, 3),
+                "mean_ms": round(histogram_values.sum / histogram_values.count, 3),
+                "max_ms": round(maxima.get(name, 0.0), 3),
+                # not cumulative, keyed by upper bound
+                "buckets_ms": dict((str(bound), count) for bound, count
+                                   in zip(self.buckets + ("+Inf",), histogram_values.bucket_counts) if count),
+            }
+        return timers, since
+
+
+def enable():
+    global _timings
+    if _timings is None:
+        _timings = Timings()
+
+
+def is_enabled():
+    return _timings is not None
+
+
+def timed(name):
+    """Decorator: record how long each call takes under name, while enabled."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            timings = _timings
+            if timings is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timings.record(name, (time.perf_counter() - start) * 1000)
+        return wrapper
+    return decorate
+
+
+def dump(filename, extra=None):
+    """Append the timings since the last dump as one JSON line, with extra's keys added. Does nothing if disabled."""
+    if _timings is None:
+        return
+    timers, since = _timings.snapshot_and_reset()
+    now = time.time()
+    document = {"time": round(now, 3), "seconds": round(now - since, 3), "timers": timers}
+    if extra:
+        document.update(extra)
+    with open(filename, "a") as handle:
+        handle.write(json.dumps(document, sort_keys=True) + "\n")
@@ -0,0 +1,186 @@
+"""Latency percentiles per minute as small mergeable sketches, so months of p50/p95/p99 never read the raw samples.
+
+A LatencySketch puts each latency in a logarithmic bucket (as DDSketch does):
+bucket i holds the values in (gamma^(i-1), gamma^i], gamma = (1 + a) / (1 - a),
+so any quantile it returns is within a = 1% of the true value, however long
+the tail. Merging two sketches adds their bucket counts, so the sketch of an
+hour, a day or a month is the merge of its minutes and is just as accurate.
+
+SketchWriter is one of monitoring's sample writers: it keeps the current
+minute's sketch and appends it to a JSON-lines file once the minute is over,
+a few hundred bytes a minute:
+
+    {"t":1604510160,"s":60,"n":30,"min":11.2,"max":48.9,"sum":512.4,"z":0,"a":0.01,"b":{"122":3,...}}
+
+t is the window's start (unixtime), s its length, n the number of samples,
+z how many were 0, a the accuracy and b the bucket counts. A window cut short
+by a restart may appear twice; merging makes that harmless."""
+import json
+import math
+import threading
+import time
+
+_DEFAULT_RELATIVE_ACCURACY = 0.01
+_DEFAULT_WINDOW_SECONDS = 60
+# latencies below this many ms are counted as 0
+_MIN_LATENCY_MS = 0.001
+
+
+class LatencySketch:
+    """Log-bucketed histogram of latencies in ms with mergeable counts."""
+    __slots__ = ("relative_accuracy", "_log_gamma", "buckets", "zero_count", "count", "min", "max", "sum")
+
+    def __init__(self, relative_accuracy=_DEFAULT_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self._log_gamma = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        # {bucket index: count}
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sum = 0.0
+
+    def add(self, value):
+        if value < _MIN_LATENCY_MS:
+            self.zero_count += 1
+        else:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add other's counts to this sketch. Both must have the same relative accuracy."""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("can't merge sketches of different accuracy")
+        buckets = self.buckets
+        for index, count in other.buckets.items():
+            buckets[index] = buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Return the q quantile (0 <= q <= 1) in ms, or None if the sketch is empty."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return max(0.0, self.min)
+        gamma = math.exp(self._log_gamma)
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # the value with the same relative error to both ends of the bucket
+                value = 2 * gamma ** index / (gamma + 1)
+                return min(self.max, max(self.min, value))
+        return self.max
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def to_dict(self):
+        return {
+            "n": self.count,
+            "min": round(self.min, 3),
+            "max": round(self.max, 3),
+            "sum": round(self.sum, 3),
+            "z": self.zero_count,
+            "a": self.relative_accuracy,
+            "b": dict((str(index), count) for index, count in sorted(self.buckets.items())),
+        }
+
+    @classmethod
+    def from_dict(cls, document):
+        sketch = cls(document.get("a", _DEFAULT_RELATIVE_ACCURACY))
+        sketch.buckets = dict((int(index), count) for index, count in document["b"].items())
+        sketch.zero_count = document.get("z", 0)
+        sketch.count = document["n"]
+        sketch.min = document["min"]
+        sketch.max = document["max"]
+        sketch.sum = document["sum"]
+        return sketch
+
+
+class SketchWriter:
+    """Sketch each window_seconds of latency samples and append it to filename. Safe to share between threads."""
+
+    def __init__(self, filename, window_seconds=_DEFAULT_WINDOW_SECONDS,
+                 relative_accuracy=_DEFAULT_RELATIVE_ACCURACY):
+        self.filename = filename
+        self.window_seconds = window_seconds
+        self.relative_accuracy = relative_accuracy
+        self._window_start = None
+        self._sketch = None
+        self._lock = threading.Lock()
+
+    def write_sample(self, unixtime, latency="", down_bandwidth="", up_bandwidth="", state_is_up="",
+                     sample_interval=None, tier_states=None, link=""):
+        """Add one sample, same signature as the writers in columnar_store and sqlite_store. Only latency is kept."""
+        if latency == "" or latency is None:
+            return
+        window_start = int(unixtime // self.window_seconds * self.window_seconds)
+        with self._lock:
+            # a sample dated before the current window (a clock step) is kept in it
+            if self._window_start is None or window_start > self._window_start:
+                self._write_locked()
+                self._window_start = window_start
+                self._sketch = LatencySketch(self.relative_accuracy)
+            self._sketch.add(float(latency))
+
+    def flush_if_due(self):
+        """Write the current window once it is over, even if no sample has arrived since."""
+        with self._lock:
+            if self._window_start is not None and time.time() >= self._window_start + self.window_seconds:
+                self._write_locked()
+
+    def close(self):
+        with self._lock:
+            self._write_locked()
+
+    def _write_locked(self):
+        if self._sketch is None or not self._sketch.count:
+            return
+        document = {"t": self._window_start, "s": self.window_seconds}
+        document.update(self._sketch.to_dict())
+        with open(self.filename, "a") as handle:
+            handle.write(json.dumps(document, separators=(",", ":")) + "\n")
+        self._window_start = None
+        self._sketch = None
+
+
+def iter_windows(filename, start=None, end=None):
+    """Yield (window start unixtime, LatencySketch) for the windows in filename overlapping [start, end)."""
+    with open(filename) as handle:
+        for line in handle:
+            try:
+                document = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by a crash
+            window_start = document["t"]
+            if start is not None and window_start + document["s"] <= start:
+                continue
+            if end is not None and window_start >= end:
+                continue
+            yield window_start, LatencySketch.from_dict(document)
+
+
+def merge_windows(windows, period_seconds):
+    """Merge (window start, sketch) pairs into one sketch per period, return [(period start, sketch)] in time order."""
+    periods = {}
+    for window_start, sketch in windows:
+        period_start = int(window_start // period_seconds * period_seconds)
+        merged = periods.get(period_start)
+        if merged is None:
+            periods[period_start] = sketch
+        else:
+            merged.merge(sketch)
+    return sorted(periods.items())
@@ -0,0 +1,196 @@
+"""Prometheus metrics for the monitor, served as /metrics by status_server.
+
+Metrics are updated from save_to_csv as each sample is saved, and a scrape
+only formats what has been counted so far; it never reads output.csv.
+Updates are a dict lookup and an add (plus a bisect over the buckets for a
+histogram) and take no lock of their own: monitoring makes them under the
+lock save_to_csv already holds. A scrape copies each value as it goes, so at
+worst it is one sample behind on some series."""
+import bisect
+import math
+
+# latency histogram buckets in ms, see monitoring._LATENCY_BUCKETS_MS
+_DEFAULT_LATENCY_BUCKETS_MS = (5, 10, 20, 30, 50, 75, 100, 150, 250, 500, 1000, 2000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    # an empty label is the same as no label to Prometheus, so leave it out
+    pairs = list(pair for pair in zip(names, values) if pair[1] != "") + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + "}"
+
+
+class Metric:
+    """A metric family: one value per combination of label values."""
+    kind = "untyped"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        for label_values, value in list(self.values.items()):
+            lines.append("{}{} {}".format(self.name, _format_labels(self.label_names, label_values),
+                                          _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, label_values=(), amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, label_values=()):
+        self.values[label_values] = value
+
+
+class _HistogramValues:
+    __slots__ = ("bucket_counts", "sum", "count")
+
+    def __init__(self, bucket_count):
+        # not cumulative; the last one is +Inf
+        self.bucket_counts = [0] * (bucket_count + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, label_values=()):
+        values = self.values.get(label_values)
+        if values is None:
+            values = self.values[label_values] = _HistogramValues(len(self.buckets))
+        # le is inclusive: a value equal to a bound goes in that bound's bucket
+        values.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        values.sum += value
+        values.count += 1
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        for label_values, values in list(self.values.items()):
+            counts = list(values.bucket_counts)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _format_labels(self.label_names, label_values, [("le", _format_value(bound))]),
+                    cumulative))
+            labels = _format_labels(self.label_names, label_values)
+            lines.append("{}_sum{} {}".format(self.name, labels, _format_value(values.sum)))
+            lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+
+class MonitorMetrics:
+    """The monitor's metrics, fed one saved sample at a time by record_sample().
+
+    Every series has a link label, the uplink the sample was taken on; it is
+    left out when monitoring the default route only."""
+
+    def __init__(self, latency_buckets=_DEFAULT_LATENCY_BUCKETS_MS):
+        self.up = Gauge("internet_up", "1 if the last latency sample reached the internet, 0 if not", ["link"])
+        self.tier_up = Gauge("internet_tier_up", "1 if the tier answered in the last consensus sample",
+                             ["link", "tier"])
+        self.probes = Counter("internet_probes_total", "Samples taken, by probe and result",
+                              ["link", "probe", "result"])
+        self.latency = Histogram("internet_latency_milliseconds", "Latency of answered probes",
+                                 latency_buckets, ["link", "probe"])
+        self.download = Gauge("internet_bandwidth_download_bits_per_second", "Result of the last speed test",
+                              ["link"])
+        self.upload = Gauge("internet_bandwidth_upload_bits_per_second", "Result of the last speed test",
+                            ["link"])
+        self.bandwidth_timestamp = Gauge("internet_bandwidth_last_test_timestamp_seconds",
+                                         "When the last successful speed test finished", ["link"])
+        self.outages = Counter("internet_outages_total", "Times the link was seen going down", ["link"])
+        self.outage_seconds = Counter("internet_outage_seconds_total", "Time spent down, counted at recovery",
+                                      ["link"])
+        self.last_change = Gauge("internet_last_state_change_timestamp_seconds",
+                                 "When the link last went up or down", ["link"])
+        self.metrics = [self.up, self.tier_up, self.probes, self.latency, self.download, self.upload,
+                        self.bandwidth_timestamp, self.outages, self.outage_seconds, self.last_change]
+        # {link: ...}
+        self._state_is_up = {}
+        self._down_since = {}
+
+    def record_sample(self, unixtime, latency="", down_bandwidth="", up_bandwidth="", state_is_up="",
+                      probe="", tier_states=None, link=""):
+        """Count one row as save_to_csv writes it: values are strings, "" for none."""
+        is_bandwidth = down_bandwidth != "" or up_bandwidth != ""
+        name = probe or ("bandwidth" if is_bandwidth else "latency")
+        if state_is_up != "":
+            self.probes.inc((link, name, "up" if state_is_up else "down"))
+        if latency != "":
+            self.latency.observe(float(latency), (link, name))
+        if is_bandwidth:
+            # save_to_csv gets Mbit/s
+            if down_bandwidth != "":
+                self.download.set(float(down_bandwidth) * 1000000, (link,))
+            if up_bandwidth != "":
+                self.upload.set(float(up_bandwidth) * 1000000, (link,))
+            self.bandwidth_timestamp.set(unixtime, (link,))
+        if tier_states:
+            for tier, answered in tier_states.items():
+                if answered is not None:
+                    self.tier_up.set(1 if answered else 0, (link, tier))
+
+        # only the latency samples decide whether the link is up
+        if probe or is_bandwidth or state_is_up == "":
+            return
+        self.up.set(1 if state_is_up else 0, (link,))
+        previous_state_is_up = self._state_is_up.get(link)
+        if state_is_up == previous_state_is_up:
+            return
+        if not state_is_up:
+            self.outages.inc((link,))
+            self._down_since[link] = unixtime
+        elif self._down_since.get(link) is not None:
+            self.outage_seconds.inc((link,), amount=max(0.0, unixtime - self._down_since.pop(link)))
+        if previous_state_is_up is not None:
+            self.last_change.set(unixtime, (link,))
+        self._state_is_up[link] = state_is_up
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def metrics_routes(monitor_metrics):
+    """Return the /metrics route for status_server."""
+    def route(query, request_headers):
+        return 200, CONTENT_TYPE, monitor_metrics.render().encode(), {}
+    return {"/metrics": route}
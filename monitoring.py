@@ -1,17 +1,138 @@
+import asyncio
+import atexit
 import logging
 import time
 import datetime
 import sys
 import math
-
-from ping_wrapper import ping
-from my_exceptions import NoConnectionException
+import queue
+import threading
+import socket
+import struct
+import ipaddress
+
+from ping_wrapper import (ping_and_return_probe_result, uses_native_icmp, PingSession, ProbeResult,
+                          FastOutageDetector, iter_ping_parallel, start_probe_results)
+import icmp_ping
+from probes import TcpConnectProbe, DnsProbe, measure_all
+from path_monitor import PathMonitor
+from event_loop import run_sync, exit_signals_ignored
+from scheduler import Scheduler
+from csv_writer import BufferedCsvWriter, TimestampFormatter
+from columnar_store import ColumnarWriter
+from sqlite_store import SqliteWriter
+from latency_sketch import SketchWriter
+from sample_ring import SampleRing, capacity_for
+from status_server import start_status_server, samples_routes
+from graph_server import graph_routes
+from metrics import MonitorMetrics, metrics_routes
+from shipper import Shipper, transport_from_url
+from outage_log import OutageTracker
+import instrumentation
+import splitlogfile
 
 import speedtest
 
 _LATENCY_IP = "8.8.8.8"
+# Consensus mode: every latency tick pings one or more targets per tier at once
+# and records which tiers answered, so an outage can be put down to our LAN,
+# the ISP or the remote end. The link counts as up while any remote anchor
+# answers; many gateways and ISP hops never answer pings, so the nearer tiers
+# don't count towards its health. "gateway" is read from /proc/net/route on
+# every tick, "isp_hop" is hop 2 as last seen by the path monitor (hop 1 being
+# our own router).
+_CONSENSUS_ENABLED = True
+_CONSENSUS_TIERS = (
+    ("lan", ["gateway"]),
+    ("isp", ["isp_hop"]),
+    ("remote", [_LATENCY_IP, "1.1.1.1", "9.9.9.9"]),
+)
+# each tick has to fit in the latency period
+_CONSENSUS_TIMEOUT_SECONDS = 1
+# Path monitoring: every hop towards _LATENCY_IP is probed at once on this
+# period, and a per-hop RTT/loss history is kept in memory (Linux only).
+_PATH_MONITOR_ENABLED = sys.platform.startswith("linux")
+_PATH_PROBE_PERIOD_SECONDS = 60
 _PING_SAMPLE_COUNT = 2
+# Adaptive latency sampling: after a lost or slow ping the latency period drops
+# to the minimum to pin down when an outage starts and ends, then after every
+# run of stable samples it backs off towards the maximum.
+_LATENCY_PERIOD_SECONDS = 2
+_LATENCY_MIN_PERIOD_SECONDS = 0.25
+_LATENCY_MAX_PERIOD_SECONDS = 10
+_LATENCY_BACKOFF_FACTOR = 1.5
+_STABLE_SAMPLES_BEFORE_BACKOFF = 30
+_SLOW_LATENCY_MS = 250
+# A latency ping waits up to this long for its reply, but no longer than the
+# latency period: while replies are lost, sampling keeps its pace. It waits at
+# least this many times the last latency measured, so a slow link isn't cut off.
+_LATENCY_TIMEOUT_SECONDS = 2
+_LATENCY_TIMEOUT_FACTOR = 3
+# When ping() would have to fork the ping binary for every sample, run one
+# continuous ping instead and read its replies on each latency tick.
+_USE_PING_SESSION = True
+_PING_SESSION_INTERVAL_SECONDS = 1.0
+# Probes run next to the latency ping on every latency tick, all at once on one
+# event loop. Each writes its own rows, tagged with its name in col 14.
+_EXTRA_PROBES = [
+    TcpConnectProbe("1.1.1.1", 443),
+    DnsProbe("1.1.1.1", "example.com"),
+    # HttpTtfbProbe("http://example.com/"),
+]
+# Uplinks to monitor side by side, as (interface, targets): pings to targets and
+# speed tests are sent from that interface (an interface name, or a local
+# address), and each row is tagged with the interface in col 19. The first one
+# feeds the graphs, latency sketches and the console line; the columnar/SQLite
+# stores keep every link's samples, tagged. E.g.
+#   [("eth0", ["8.8.8.8", "1.1.1.1"]), ("wwan0", ["8.8.8.8", "1.1.1.1"])]
+# None to monitor _LATENCY_IP over the default route only.
+_LINKS = None
+# Fast-detect mode: a FastOutageDetector keeps staggered probes in flight to
+# this target and writes a row, timed to the millisecond, whenever the link
+# goes down or comes back. It sends ~20 packets/s, so point it at something
+# that won't rate limit ICMP (e.g. the gateway or the ISP's first hop).
+_FAST_DETECT_ENABLED = False
+_FAST_DETECT_IP = _LATENCY_IP
 _OUTPUT_CSV = "./output.csv"
+# Split the output into one file per day (output.2020-11-04.csv, ...), listed
+# in output.csv.manifest.json. None writes everything to _OUTPUT_CSV.
+_SPLIT_OUTPUT_PERIOD = splitlogfile.DAILY
+_COMPRESS_OUTPUT_OLDER_THAN = datetime.timedelta(days=31)
+_DELETE_OUTPUT_OLDER_THAN = datetime.timedelta(days=365)
+# also append latency/bandwidth samples to a binary columnar store in this
+# directory (see columnar_store.py), None to only write the CSV
+_OUTPUT_COLUMNS = None
+# also insert them into a SQLite database (see sqlite_store.py), e.g. "./output.sqlite", None for no database
+_OUTPUT_SQLITE = None
+# append a line per outage (start, end, duration, tier, samples) to this file as
+# it ends (see outage_log.py), None for none. summary.py reads it when present.
+_OUTAGE_LOG = "./outages.jsonl"
+# append a sketch of each minute's latencies to this file (see latency_sketch.py), for
+# summary.py's percentiles over months, None for none
+_OUTPUT_LATENCY_SKETCHES = "./latency_sketches.jsonl"
+# keep this many hours of latency/bandwidth samples in memory (see sample_ring.py), None for none
+_RECENT_SAMPLES_HOURS = 7 * 24
+# serve them and graphs of them on this address (see status_server.py and graph_server.py),
+# None for no server. Only this machine by default: ("", 8000) serves the whole network
+_STATUS_SERVER_ADDRESS = ("127.0.0.1", 8000)
+# also push every row to a collector (see shipper.py and collector.py), e.g.
+# "http://collector:8080/ingest" or "tcp://collector:9000", None to keep them here.
+# Batches wait in _SHIP_SPOOL_DIRECTORY until the collector has them.
+_SHIP_TO = None
+_SHIP_SITE = socket.gethostname()
+_SHIP_SPOOL_DIRECTORY = "./spool"
+# count samples for Prometheus, served as /metrics by the status server
+_METRICS_ENABLED = True
+# upper bounds (ms) of the latency histogram buckets
+_LATENCY_BUCKETS_MS = (5, 10, 20, 30, 50, 75, 100, 150, 250, 500, 1000, 2000)
+# refetch speedtest.net's config and pick a new server this often (and after any failed test)
+_SPEEDTEST_SESSION_MAX_AGE_SECONDS = 6 * 60 * 60
+# how often to log how late the scheduler starts each event
+_SCHEDULER_STATS_PERIOD_SECONDS = 600
+# append timings of the monitor's own work to this file, one JSON line every _STATS_PERIOD_SECONDS
+# (see instrumentation.py), e.g. "./monitor_stats.jsonl", None to not time anything
+_STATS_FILE = None
+_STATS_PERIOD_SECONDS = 60
 # How often to print a new line (otherwise overwrite). A new line is always printed on disconnect.
 _PRINT_RATE = 300
 
@@ -27,9 +148,22 @@ class StatefulConsolePrinter:
         self.latest_latency = ""
         self.latest_down_bandwidth = ""
         self.latest_up_bandwidth = ""
+        self.latest_probe_latencies = {}
         self.next_print_unixtime = None
 
-    def print_data_to_console(self, date_time, latency, down_bandwidth, up_bandwidth, state_is_up):
+    @instrumentation.timed("print_data_to_console")
+    def print_data_to_console(self, date_time, latency, down_bandwidth, up_bandwidth, state_is_up, probe="",
+                              link=""):
+
+        # extra probes are shown next to the next latency line, not on their own
+        if probe != "":
+            self.latest_probe_latencies[probe.split(":")[0]] = latency if latency != "" else "-"
+            return
+        # and so are the other links' latencies
+        if link != primary_link:
+            if latency != "" or state_is_up == False:
+                self.latest_probe_latencies[link] = latency if latency != "" else "-"
+            return
 
         # overwrite latest data if its provided
         if latency != "":
@@ -67,6 +201,9 @@ class StatefulConsolePrinter:
             self.latest_up_bandwidth+'↑' if self.latest_up_bandwidth != "" else "",
             "UP" if state_is_up else "DOWN!"
         )
+        if self.latest_probe_latencies:
+            line += "  " + " ".join("{} {}".format(name, value)
+                                    for name, value in sorted(self.latest_probe_latencies.items()))
         line = line.ljust(70)  # pad to some len with " " chars to overwrite previous line
 
         print(line, end='\n' if should_print_new_line else '\r')
@@ -75,33 +212,182 @@ class StatefulConsolePrinter:
 
 
 printer = StatefulConsolePrinter()
-def save_to_csv(date_time=None, latency="", down_bandwidth="", up_bandwidth="", state_is_up=""):
+# name of the link whose rows go to the sample writers, "" when not using _LINKS
+primary_link = ""
+path_monitor = None
+csv_writer = None
+# extra sinks for latency/bandwidth samples, see get_sample_writers
+sample_writers = None
+# the ones of them keeping every link's samples (the stores), the others only take primary_link's
+link_sample_writers = None
+sample_ring = None
+shipper = None
+outage_tracker = None
+monitor_metrics = MonitorMetrics(_LATENCY_BUCKETS_MS) if _METRICS_ENABLED else None
+timestamp_formatter = TimestampFormatter()
+# save_to_csv is called from the main loop and the fast-detect thread
+_save_lock = threading.Lock()
+# the writers are opened by whichever thread needs them first: save_to_csv or the flush event
+_open_lock = threading.Lock()
+
+
+def get_csv_writer():
+    """Return the writer for _OUTPUT_CSV, opened on first use."""
+    global csv_writer
+    with _open_lock:
+        if csv_writer is None:
+            if _SPLIT_OUTPUT_PERIOD is None:
+                csv_writer = BufferedCsvWriter(_OUTPUT_CSV)
+            else:
+                csv_writer = BufferedCsvWriter(splitlogfile.SplitIntoChunksByWriteDate(
+                    _OUTPUT_CSV,
+                    period=_SPLIT_OUTPUT_PERIOD,
+                    auto_delete_older_than_timedelta=_DELETE_OUTPUT_OLDER_THAN,
+                    auto_compress_older_than_timedelta=_COMPRESS_OUTPUT_OLDER_THAN))
+    return csv_writer
+
+
+def get_sample_writers():
+    """Return the sinks turned on besides the CSV (ring, columnar store, SQLite, sketches), opened on first use.
+
+    Only the stores (also listed in link_sample_writers) take the samples of links other than primary_link."""
+    global sample_writers, link_sample_writers, sample_ring
+    with _open_lock:
+        if sample_writers is None:
+            writers = []
+            stores = []
+            if _RECENT_SAMPLES_HOURS is not None:
+                # sized for the normal sampling rate, holds less while sampling faster
+                sample_ring = SampleRing(capacity_for(_RECENT_SAMPLES_HOURS, _LATENCY_PERIOD_SECONDS))
+                writers.append(sample_ring)
+            if _OUTPUT_COLUMNS is not None:
+                stores.append(ColumnarWriter(_OUTPUT_COLUMNS))
+            if _OUTPUT_SQLITE is not None:
+                stores.append(SqliteWriter(_OUTPUT_SQLITE))
+            if _OUTPUT_LATENCY_SKETCHES is not None:
+                writers.append(SketchWriter(_OUTPUT_LATENCY_SKETCHES))
+            link_sample_writers = stores
+            sample_writers = writers + stores
+    return sample_writers
+
+
+def get_shipper():
+    """Return the shipper for _SHIP_TO, started on first use, or None if rows aren't shipped."""
+    global shipper
+    with _open_lock:
+        if shipper is None and _SHIP_TO is not None:
+            shipper = Shipper(_SHIP_SPOOL_DIRECTORY, transport_from_url(_SHIP_TO), _SHIP_SITE)
+            shipper.start()
+    return shipper
+
+
+def get_outage_tracker():
+    """Return the tracker writing _OUTAGE_LOG, or None if it is turned off."""
+    global outage_tracker
+    with _open_lock:
+        if outage_tracker is None and _OUTAGE_LOG is not None:
+            outage_tracker = OutageTracker(_OUTAGE_LOG)
+    return outage_tracker
+
+
+def get_sample_ring():
+    """Return the ring of recent samples, or None if it is turned off."""
+    get_sample_writers()
+    return sample_ring
+
+
+def flush_writers_if_due():
+    get_csv_writer().flush_if_due()
+    for writer in get_sample_writers():
+        writer.flush_if_due()
+    if get_shipper() is not None:
+        get_shipper().flush_if_due()
+
+
+def close_writers():
+    get_csv_writer().close()
+    for writer in get_sample_writers():
+        writer.close()
+    if get_shipper() is not None:
+        get_shipper().close()
+    if get_outage_tracker() is not None:
+        get_outage_tracker().close()
+
+
+@instrumentation.timed("save_to_csv")
+def save_to_csv(date_time=None, latency="", down_bandwidth="", up_bandwidth="", state_is_up="",
+                probe_result=None, probe="", sample_interval=None, subsecond=False, tier_states=None, link=""):
     global printer
-    if date_time is None:
-        date_time = datetime.datetime.now()
-    with open(_OUTPUT_CSV, "a") as handle:
-        print(
-            "{},{},{},{},{},{}".format(
-                date_time.strftime("%Y-%m-%d"),
-                date_time.strftime("%H:%M:%S"),
-                latency,
-                down_bandwidth,
-                up_bandwidth,
-                state_is_up
-            ),
-            file=handle)
-
-    printer.print_data_to_console(date_time, latency, down_bandwidth, up_bandwidth, state_is_up)
+    with _save_lock:
+        # stamp rows inside the lock, so rows from different threads are written in time order
+        if date_time is None:
+            date_time = datetime.datetime.now()
+
+        time_string = timestamp_formatter.time_string(date_time)
+        if subsecond:
+            time_string += ".{:03d}".format(date_time.microsecond // 1000)
+
+        row = [
+            timestamp_formatter.date_string(date_time),
+            time_string,
+            latency,
+            down_bandwidth,
+            up_bandwidth,
+            str(state_is_up),
+        ]
+        # cols 6-13: sent, received, loss %, min, avg, max, mdev, jitter
+        row.extend(probe_result.csv_fields() if probe_result is not None else [""] * 8)
+        # col 14: name of the extra probe this row is from, empty for the latency ping
+        row.append(probe)
+        # col 15: seconds this sample stands for, i.e. since the previous one
+        row.append("" if sample_interval is None else "{:.2f}".format(sample_interval))
+        # cols 16-18: did the lan, isp and remote tiers answer (consensus mode)
+        for tier, _ in _CONSENSUS_TIERS:
+            row.append(str(tier_states[tier]) if tier_states and tier_states.get(tier) is not None else "")
+        # col 19: link (interface) this sample was taken on, see _LINKS
+        row.append(link)
+        # leave off empty trailing columns so rows without extras keep the original 6
+        while len(row) > 6 and row[-1] == "":
+            row.pop()
+
+        # extra probe rows (and other links' rows) don't count towards the link's state
+        is_primary = probe == "" and link == primary_link
+        get_csv_writer().write_row(row, state_is_up=state_is_up if is_primary and state_is_up != "" else None)
+        if get_shipper() is not None:
+            get_shipper().write_row(row)
+        unixtime = date_time.timestamp()
+        if probe == "":
+            for writer in get_sample_writers():
+                if is_primary or writer in link_sample_writers:
+                    writer.write_sample(unixtime, latency, down_bandwidth, up_bandwidth, state_is_up,
+                                        sample_interval, tier_states, link)
+
+        # only latency samples (and fast-detect markers) decide whether the link is up; they are
+        # the rows with an interval, a speed test that couldn't connect isn't an outage
+        if get_outage_tracker() is not None and probe == "" and state_is_up != "" and sample_interval is not None:
+            failed_tier = None
+            if tier_states:
+                failed_tier = next((tier for tier, _ in _CONSENSUS_TIERS if tier_states.get(tier) is False), None)
+            get_outage_tracker().record(unixtime, state_is_up, failed_tier, link, is_sample=sample_interval != 0)
+
+        if monitor_metrics is not None:
+            monitor_metrics.record_sample(unixtime, latency, down_bandwidth, up_bandwidth, state_is_up, probe,
+                                          tier_states, link)
+
+        printer.print_data_to_console(date_time, latency, down_bandwidth, up_bandwidth, state_is_up, probe, link)
 
 
 class PeriodicEvent():
-    def __init__(self, period_in_secs, callback):
+    """Call callback every period_in_secs. Times are on the time.monotonic() clock."""
+
+    def __init__(self, period_in_secs, callback, name=None):
         self.period = period_in_secs
         self.callback = callback
-        self.next_run = time.time()
+        self.name = name
+        self.next_run = time.monotonic()
 
     def reset_timer(self):
-        time_now = time.time()
+        time_now = time.monotonic()
 
         self.next_run += self.period
 
@@ -122,7 +408,7 @@ class PeriodicEvent():
             self.next_run += (self.period * number_of_missed_periods)
 
     def is_timer_expired(self, auto_reset=True):
-        now = time.time()
+        now = time.monotonic()
         if now > self.next_run:
             if auto_reset:
                 self.reset_timer()
@@ -131,55 +417,501 @@ class PeriodicEvent():
 
     def run(self):
         if self.is_timer_expired():
-            self.callback()
-
-
-def log_latency(ip):
-    try:
-        latency = ping(ip, _PING_SAMPLE_COUNT)
-    except NoConnectionException:
+            self.fire()
+
+    def fire(self):
+        """Run the callback now. The scheduler calls this once the event is due."""
+        self.callback()
+
+
+class AdaptivePeriodicEvent(PeriodicEvent):
+    """A PeriodicEvent that speeds up when its callback reports trouble.
+
+    The callback is given the seconds since its previous run and how long its
+    probes may wait for a reply (see probe_timeout), and returns (True if
+    everything looked healthy, latency in ms or None if nothing answered). One
+    unhealthy run drops the period to min_period, every
+    stable_runs_before_backoff healthy runs in a row multiply it by
+    backoff_factor, up to max_period."""
+
+    def __init__(self, period_in_secs, callback, min_period, max_period,
+                 backoff_factor=_LATENCY_BACKOFF_FACTOR,
+                 stable_runs_before_backoff=_STABLE_SAMPLES_BEFORE_BACKOFF,
+                 max_timeout=_LATENCY_TIMEOUT_SECONDS, name=None):
+        super().__init__(period_in_secs, callback, name)
+        self.min_period = min_period
+        self.max_period = max_period
+        self.backoff_factor = backoff_factor
+        self.stable_runs_before_backoff = stable_runs_before_backoff
+        self.max_timeout = max_timeout
+        self.stable_runs = 0
+        self.last_run_monotonic = None
+        self.last_latency = None
+
+    def probe_timeout(self):
+        """Return the period, stretched to a few times the last latency, up to max_timeout."""
+        timeout = self.period
+        if self.last_latency is not None:
+            timeout = max(timeout, self.last_latency / 1000 * _LATENCY_TIMEOUT_FACTOR)
+        return min(self.max_timeout, timeout)
+
+    def fire(self):
+        now = time.monotonic()
+        if self.last_run_monotonic is None:
+            sample_interval = self.period
+        else:
+            sample_interval = now - self.last_run_monotonic
+        self.last_run_monotonic = now
+
+        healthy, latency = self.callback(sample_interval, self.probe_timeout())
+        if latency is not None:
+            self.last_latency = latency
+        self.adapt(healthy)
+
+    def adapt(self, healthy):
+        if not healthy:
+            self.stable_runs = 0
+            if self.period != self.min_period:
+                logging.debug("trouble: sampling every {}s".format(self.min_period))
+                self.period = self.min_period
+                self.next_run = time.monotonic() + self.period
+            return
+
+        self.stable_runs += 1
+        if self.stable_runs >= self.stable_runs_before_backoff and self.period < self.max_period:
+            self.stable_runs = 0
+            self.period = min(self.max_period, self.period * self.backoff_factor)
+            logging.debug("stable: sampling every {:.2f}s".format(self.period))
+
+
+@instrumentation.timed("log_latency")
+def log_latency(ip, sample_interval=None, timeout=_LATENCY_TIMEOUT_SECONDS):
+    """Ping ip and save the result. Returns (True if the link looked healthy, latency or None)."""
+    # one sample is enough when sampling faster than once a second
+    sample_count = 1 if timeout < 1 else _PING_SAMPLE_COUNT
+    result = ping_and_return_probe_result(ip, sample_count, timeout=timeout)
+    if not result.is_up:
         # logging.info("LATENCY    : no connection")
-        save_to_csv(state_is_up=False)
+        save_to_csv(state_is_up=False, probe_result=result, sample_interval=sample_interval)
     else:
-        # logging.info("LATENCY    : {:.2f} ms to {}".format(latency, ip))
-        save_to_csv(state_is_up=True, latency="{:.2f}".format(latency))
+        # logging.info("LATENCY    : {:.2f} ms to {}".format(result.avg, ip))
+        save_to_csv(state_is_up=True, latency="{:.2f}".format(result.avg), probe_result=result,
+                    sample_interval=sample_interval)
+    return result.is_up and result.received == result.sent and result.avg < _SLOW_LATENCY_MS, result.avg
 
 
-def log_bandwidth():
+def read_default_gateway(route_file="/proc/net/route"):
+    """Return the IPv4 default gateway, or None if there isn't one (or no /proc)."""
     try:
-        download = speedtest.Speedtest().download()
-        upload = speedtest.Speedtest().upload()
-    except speedtest.SpeedtestHTTPError:
-        # logging.info("BANDWIDTH  : no connection")
-        save_to_csv(state_is_up=False)
-    else:
-        # logging.info("BANDWIDTH  : {:.2f} mbits down {:.2f} mbits up".format(download / 1000000, upload / 1000000))
-        save_to_csv(state_is_up=True,
-                    down_bandwidth="{:.2f}".format(download / 1000000),
-                    up_bandwidth="{:.2f}".format(upload / 1000000))
+        with open(route_file) as handle:
+            next(handle)  # header
+            for line in handle:
+                fields = line.split()
+                # destination 0.0.0.0 with the RTF_GATEWAY flag set
+                if len(fields) > 3 and fields[1] == "00000000" and int(fields[3], 16) & 0x2:
+                    return socket.inet_ntoa(struct.pack("<L", int(fields[2], 16)))
+    except (OSError, StopIteration, ValueError):
+        pass
+    return None
+
+
+def resolve_consensus_targets(tiers=_CONSENSUS_TIERS):
+    """Return a list of (tier, ip), with "gateway" replaced by the current gateway."""
+    targets = []
+    for tier, ips in tiers:
+        for ip in ips:
+            if ip == "gateway":
+                ip = read_default_gateway()
+            elif ip == "isp_hop":
+                ip = path_monitor.hop_address(2) if path_monitor is not None else None
+            if ip is None:
+                continue
+            targets.append((tier, ip))
+    return targets
+
+
+async def probe_consensus_targets(targets, remote_sample_count=1, timeout=_CONSENSUS_TIMEOUT_SECONDS):
+    """Ping every (tier, ip) of targets at once, return a ProbeResult for each, None if it was dropped.
+
+    The remote anchors get remote_sample_count pings each, the nearer tiers
+    one. Once an anchor has answered, the pings still out are dropped: the
+    link is up, and gateways and ISP hops often ignore echo requests, so
+    waiting for them would hold up every tick. While no anchor answers they
+    are waited for, to tell where the link broke."""
+    tasks = start_probe_results(list((ip, remote_sample_count if tier == "remote" else 1) for tier, ip in targets),
+                                timeout)
+    remote_tasks = set(task for (tier, _), task in zip(targets, tasks) if tier == "remote")
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if any(task in remote_tasks and task.result().is_up for task in done):
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    return list(None if task in pending else task.result() for task in tasks)
+
+
+@instrumentation.timed("log_latency_consensus")
+def log_latency_consensus(tiers=_CONSENSUS_TIERS, sample_interval=None, timeout=_CONSENSUS_TIMEOUT_SECONDS):
+    """Ping every tier's targets at once and save one row with each tier's verdict.
+
+    The link's state and health go by the remote anchors alone, the nearer
+    tiers are only there to tell where an outage is. The row's ping columns
+    are the fastest anchor's. Returns (True if the link looked healthy,
+    latency or None)."""
+    targets = resolve_consensus_targets(tiers)
+    # one ping per anchor is enough when sampling faster than once a second
+    sample_count = 1 if timeout < 1 else _PING_SAMPLE_COUNT
+    results = run_sync(probe_consensus_targets(targets, sample_count, timeout))
+    tier_states = dict((tier, None) for tier, _ in tiers)
+    remote_results = []
+    for (tier, _), result in zip(targets, results):
+        if result is None:
+            continue
+        tier_states[tier] = bool(tier_states[tier]) or result.is_up
+        if tier == "remote":
+            remote_results.append(result)
+
+    answered = list(result for result in remote_results if result.is_up)
+    if not answered:
+        save_to_csv(state_is_up=False, probe_result=remote_results[0] if remote_results else None,
+                    sample_interval=sample_interval, tier_states=tier_states)
+        return False, None
+
+    # the fastest anchor is the one closest to what a user would get
+    result = min(answered, key=lambda answered_result: answered_result.avg)
+    save_to_csv(state_is_up=True, latency="{:.2f}".format(result.avg), probe_result=result,
+                sample_interval=sample_interval, tier_states=tier_states)
+    return result.received == result.sent and result.avg < _SLOW_LATENCY_MS, result.avg
+
+
+@instrumentation.timed("log_latency_from_session")
+def log_latency_from_session(session, sample_interval=None):
+    samples = session.pop_samples()
+    latencies = list(latency for _, latency in samples if latency is not None)
+    if latencies:
+        result = ProbeResult.from_latencies(session.ip, len(samples), latencies)
+        save_to_csv(state_is_up=True, latency="{:.2f}".format(result.avg), probe_result=result,
+                    sample_interval=sample_interval)
+        return
+
+    # no replies: down if packets were lost or ping has gone quiet for too long
+    silent_for = None
+    if session.last_output_unixtime is not None:
+        silent_for = time.time() - session.last_output_unixtime
+    if samples:
+        save_to_csv(state_is_up=False, probe_result=ProbeResult.from_latencies(session.ip, len(samples), []),
+                    sample_interval=sample_interval)
+    elif (not session.is_running()
+            or silent_for is None
+            or silent_for > session.timeout + session.interval):
+        save_to_csv(state_is_up=False, sample_interval=sample_interval)
+
+
+def interface_address(interface):
+    """Return the IPv4 address of interface (a name, or already an address), None if it has none (linux only)."""
+    try:
+        return str(ipaddress.IPv4Address(interface))
+    except ValueError:
+        pass
+    try:
+        import fcntl
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            # SIOCGIFADDR fills in a struct ifreq: 16 bytes of name, then a sockaddr_in
+            ifreq = fcntl.ioctl(sock.fileno(), 0x8915, struct.pack("256s", interface[:15].encode()))
+    except (ImportError, OSError):
+        return None
+    return socket.inet_ntoa(ifreq[20:24])
+
+
+class Link:
+    """One uplink to monitor, see _LINKS."""
 
+    def __init__(self, interface, targets, name=None):
+        self.interface = interface
+        self.targets = list(targets)
+        self.name = name if name is not None else interface
 
-def run_events(event_list):
-    for e in event_list:
-        e.run()
+    def __repr__(self):
+        return "Link({!r}, {!r})".format(self.interface, self.targets)
 
 
-def monitor_forever(ping_ip):
-    event_list = [
-        PeriodicEvent(2, lambda i=ping_ip: log_latency(i)),
-        PeriodicEvent(600, lambda: log_bandwidth())
-    ]
+@instrumentation.timed("log_link_latency")
+def log_link_latency(link, sample_interval=None, timeout=_CONSENSUS_TIMEOUT_SECONDS):
+    """Ping all of link's targets at once from its interface and save one row tagged with the link.
 
-    while(True):
+    The link is up if any target answered. Returns (True if it looked healthy, latency or None)."""
+    latencies = list(result for _, result in iter_ping_parallel(link.targets, sample_count=1, timeout=timeout,
+                                                                source=link.interface)
+                     if not isinstance(result, Exception))
+    if not latencies:
+        save_to_csv(state_is_up=False, sample_interval=sample_interval, link=link.name)
+        return False, None
+
+    # the fastest target is the one closest to what a user would get
+    latency = min(latencies)
+    save_to_csv(state_is_up=True, latency="{:.2f}".format(latency), sample_interval=sample_interval,
+                link=link.name)
+    return latency < _SLOW_LATENCY_MS and len(latencies) == len(link.targets), latency
+
+
+def log_probes(probes):
+    for probe, result in run_sync(measure_all(probes)):
+        if isinstance(result, Exception):
+            save_to_csv(state_is_up=False, probe=probe.name)
+        else:
+            save_to_csv(state_is_up=True, latency="{:.2f}".format(result), probe=probe.name)
+
+
+def log_fast_detect_transition(state_is_up, unixtime):
+    logging.info("fast-detect: link {} at {:.3f}".format("up" if state_is_up else "down", unixtime))
+    # a marker for the exact moment of the change, not a sample of its own
+    save_to_csv(date_time=datetime.datetime.fromtimestamp(unixtime), state_is_up=state_is_up,
+                sample_interval=0, subsecond=True)
+
+
+def start_fast_detect(ip):
+    if uses_native_icmp():
+        probe = lambda timeout, i=ip: icmp_ping.get_prober().probe(i, timeout)
+    else:
+        # without ICMP sockets, time TCP handshakes to a port that is usually open; a
+        # refused connection still came back over the link
+        probe = TcpConnectProbe(ip, 53, refused_is_up=True).measure
+    detector = FastOutageDetector(probe, log_fast_detect_transition)
+    detector.start()
+    return detector
+
+
+def log_path(monitor):
+    hops = run_sync(monitor.probe_path())
+    logging.debug("path to {} ({} hops): {}".format(monitor.target, len(hops), monitor.summary()))
+
+
+class SpeedtestSession:
+    """Keep one speedtest.Speedtest between runs.
+
+    Building a Speedtest downloads speedtest.net's config, and its first use
+    downloads the server list and pings the closest servers to pick the best
+    one: seconds and hundreds of KB before measuring anything. Both are kept
+    until they are max_age seconds old, or until a test fails (the server may
+    have gone away).
+
+    source is the interface (or local address) to test from, None for the
+    default route. Its address is looked up again with each new Speedtest, so
+    a new DHCP lease is picked up after the next failed test."""
+
+    def __init__(self, max_age=_SPEEDTEST_SESSION_MAX_AGE_SECONDS, source=None):
+        self.max_age = max_age
+        self.source = source
+        self._speedtest = None
+        self._created = None
+
+    def get_speedtest(self):
+        if self._speedtest is None or time.monotonic() - self._created > self.max_age:
+            logging.debug("speedtest: fetching config and choosing a server")
+            if self.source is None:
+                self._speedtest = speedtest.Speedtest()
+            else:
+                source_address = interface_address(self.source)
+                if source_address is None:
+                    raise speedtest.SpeedtestException("{} has no IPv4 address".format(self.source))
+                self._speedtest = speedtest.Speedtest(source_address=source_address)
+            self._speedtest.get_best_server()
+            self._created = time.monotonic()
+        return self._speedtest
+
+    def invalidate(self):
+        self._speedtest = None
+
+    @instrumentation.timed("speedtest_measure")
+    def measure(self):
+        """Run a speed test, return (download, upload) in bits/s. Takes 20-40s."""
         try:
-            time.sleep(1.0)
-            run_events(event_list)
-        except (KeyboardInterrupt, SystemExit):
-            logging.info("exiting")
-            break
-        except Exception as e:
-            logging.exception("Exception thrown while checking connection, waiting 10s...")
-            time.sleep(10)
+            tester = self.get_speedtest()
+            download = tester.download()
+            upload = tester.upload()
+        except Exception:
+            self.invalidate()
+            raise
+        return download, upload
+
+
+@instrumentation.timed("log_bandwidth")
+def log_bandwidth(result, link=""):
+    """Save a speed test result: (download, upload), or None if the test couldn't connect."""
+    if result is None:
+        # logging.info("BANDWIDTH  : no connection")
+        save_to_csv(state_is_up=False, link=link)
+    else:
+        download, upload = result
+        # logging.info("BANDWIDTH  : {:.2f} mbits down {:.2f} mbits up".format(download / 1000000, upload / 1000000))
+        save_to_csv(state_is_up=True,
+                    down_bandwidth="{:.2f}".format(download / 1000000),
+                    up_bandwidth="{:.2f}".format(upload / 1000000),
+                    link=link)
+
+
+class BandwidthWorker:
+    """Run speed tests on a thread of their own, one at a time.
+
+    request() returns straight away. Results wait in a queue until
+    write_results() saves them, so they are written from the scheduler like
+    every other row and stamped when written: rows stay in time order and
+    latency sampling carries on during the test.
+
+    Results are saved tagged with link, see _LINKS."""
+
+    def __init__(self, measure=None, link=""):
+        self.measure = measure if measure is not None else SpeedtestSession().measure
+        self.link = link
+        self.results = queue.Queue()
+        self._requests = queue.Queue()
+        self._busy = threading.Event()
+        self._thread = None
+
+    def start(self):
+        name = "BandwidthWorker({})".format(self.link) if self.link else "BandwidthWorker"
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._requests.put(None)
+
+    def request(self):
+        """Ask for a speed test, unless one is already waiting or running."""
+        if self._busy.is_set():
+            logging.debug("speed test still running, skipping this one")
+            return
+        self._busy.set()
+        self._requests.put(True)
+
+    def write_results(self):
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                return
+            log_bandwidth(result, self.link)
+
+    def _run(self):
+        while self._requests.get() is not None:
+            try:
+                self.results.put(self.measure())
+            except speedtest.SpeedtestHTTPError:
+                self.results.put(None)
+            except Exception:
+                logging.exception("speed test failed")
+            finally:
+                self._busy.clear()
+
+
+def monitor_forever(ping_ip, fast_detect=_FAST_DETECT_ENABLED, links=None):
+    """Sample until interrupted: ping_ip over the default route, or each of links, a list of (interface, targets).
+
+    All links share the scheduler, its worker threads (each with one event loop
+    and one ICMP socket per interface) and the writers; only the speed tests
+    get a thread per link."""
+    global path_monitor, primary_link
+    fast_detector = start_fast_detect(_FAST_DETECT_IP) if fast_detect else None
+
+    ping_session = None
+    if links:
+        links = list(Link(interface, targets) for interface, targets in links)
+        primary_link = links[0].name
+        latency_events = list(AdaptivePeriodicEvent(
+            _LATENCY_PERIOD_SECONDS,
+            lambda interval, timeout, l=link: log_link_latency(l, sample_interval=interval, timeout=timeout),
+            min_period=_LATENCY_MIN_PERIOD_SECONDS,
+            max_period=_LATENCY_MAX_PERIOD_SECONDS,
+            max_timeout=_CONSENSUS_TIMEOUT_SECONDS,
+            name="latency:" + link.name) for link in links)
+        bandwidth_workers = list(BandwidthWorker(SpeedtestSession(source=link.interface).measure, link.name)
+                                 for link in links)
+    elif _USE_PING_SESSION and not uses_native_icmp():
+        ping_session = PingSession(ping_ip, interval=_PING_SESSION_INTERVAL_SECONDS)
+        ping_session.start()
+        # the ping process sets its own pace, so this one is not adaptive
+        latency_event = PeriodicEvent(
+            _LATENCY_PERIOD_SECONDS,
+            lambda s=ping_session: log_latency_from_session(s, sample_interval=_LATENCY_PERIOD_SECONDS),
+            name="latency")
+    elif _CONSENSUS_ENABLED:
+        latency_event = AdaptivePeriodicEvent(
+            _LATENCY_PERIOD_SECONDS,
+            lambda interval, timeout: log_latency_consensus(sample_interval=interval, timeout=timeout),
+            min_period=_LATENCY_MIN_PERIOD_SECONDS,
+            max_period=_LATENCY_MAX_PERIOD_SECONDS,
+            max_timeout=_CONSENSUS_TIMEOUT_SECONDS,
+            name="latency")
+    else:
+        latency_event = AdaptivePeriodicEvent(
+            _LATENCY_PERIOD_SECONDS,
+            lambda interval, timeout, i=ping_ip: log_latency(i, sample_interval=interval, timeout=timeout),
+            min_period=_LATENCY_MIN_PERIOD_SECONDS,
+            max_period=_LATENCY_MAX_PERIOD_SECONDS,
+            name="latency")
+    if not links:
+        latency_events = [latency_event]
+        bandwidth_workers = [BandwidthWorker()]
+
+    event_list = list(latency_events)
+    for bandwidth_worker in bandwidth_workers:
+        bandwidth_worker.start()
+        suffix = ":" + bandwidth_worker.link if bandwidth_worker.link else ""
+        event_list.append(PeriodicEvent(600, bandwidth_worker.request, name="bandwidth" + suffix))
+        event_list.append(PeriodicEvent(1, bandwidth_worker.write_results, name="bandwidth_results" + suffix))
+    if _EXTRA_PROBES:
+        event_list.append(PeriodicEvent(_LATENCY_PERIOD_SECONDS, lambda: log_probes(_EXTRA_PROBES),
+                                        name="probes"))
+    if _PATH_MONITOR_ENABLED:
+        path_monitor = PathMonitor(ping_ip)
+        event_list.append(PeriodicEvent(_PATH_PROBE_PERIOD_SECONDS, lambda: log_path(path_monitor),
+                                        name="path"))
+    # rows are batched; make sure they don't sit in memory while sampling slowly
+    event_list.append(PeriodicEvent(1, flush_writers_if_due, name="flush"))
+
+    status_server = None
+    if _STATUS_SERVER_ADDRESS is not None:
+        routes = {}
+        if get_sample_ring() is not None:
+            routes.update(samples_routes(get_sample_ring()))
+            routes.update(graph_routes(get_sample_ring()))
+        if monitor_metrics is not None:
+            routes.update(metrics_routes(monitor_metrics))
+        if routes:
+            status_server = start_status_server(routes, _STATUS_SERVER_ADDRESS)
+
+    scheduler = Scheduler(event_list)
+    scheduler.add(PeriodicEvent(_SCHEDULER_STATS_PERIOD_SECONDS,
+                                lambda: logging.debug("scheduler: {}".format(scheduler.summary())),
+                                name="scheduler_stats"))
+    if _STATS_FILE is not None:
+        instrumentation.enable()
+        scheduler.add(PeriodicEvent(_STATS_PERIOD_SECONDS,
+                                    lambda: instrumentation.dump(_STATS_FILE, {"scheduler": scheduler.stats()}),
+                                    name="stats"))
+    try:
+        run_sync(scheduler.run_forever())
+    except (KeyboardInterrupt, SystemExit):
+        logging.info("exiting")
+    finally:
+        # a second ctrl+c (or SIGTERM) while stopping mustn't skip writing out the buffered rows
+        with exit_signals_ignored():
+            for bandwidth_worker in bandwidth_workers:
+                bandwidth_worker.stop()
+            if status_server is not None:
+                status_server.shutdown()
+                status_server.server_close()
+            if ping_session is not None:
+                ping_session.stop()
+            if fast_detector is not None:
+                fast_detector.stop()
+            close_writers()
+            if _STATS_FILE is not None:
+                instrumentation.dump(_STATS_FILE, {"scheduler": scheduler.stats()})
 
 
 def main():
@@ -189,7 +921,10 @@ def main():
     logging.getLogger("requests").setLevel(logging.WARNING)
     logging.getLogger("urllib3").setLevel(logging.WARNING)
 
-    monitor_forever(ping_ip=_LATENCY_IP)
+    # SIGTERM (e.g. systemctl stop) exits like ctrl+c, so buffered rows get written
+    get_csv_writer().install_signal_handler()
+    atexit.register(close_writers)
+    monitor_forever(ping_ip=_LATENCY_IP, links=_LINKS)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+"""Outages as they happen, one JSON line each, so reports don't have to scan every sample.
+
+    {"start": 1604510176.25, "end": 1604510188.5, "duration": 12.25, "tier": "isp", "samples": 6}
+
+monitoring feeds OutageTracker every latency sample as it is saved. An outage
+starts at the first down sample and ends at the first up one after it;
+samples is how many down samples it spanned, and tier is the nearest
+consensus tier that didn't answer (null if unknown). With several links (see
+monitoring._LINKS) each is tracked on its own and its records carry a "link"
+key. An outage still going on when the monitor stops is written with the time
+of its last sample as the end and "ongoing": true."""
+import json
+import os
+import threading
+
+
+class OutageTracker:
+    """Follow each link's state through record() and append a line to filename per outage. Safe to share between threads."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        # {link: open outage dict}
+        self._outages = {}
+        self._lock = threading.Lock()
+
+    def record(self, unixtime, state_is_up, failed_tier=None, link="", is_sample=True):
+        """Take one latency sample's state. is_sample=False for a marker of the moment the state changed."""
+        with self._lock:
+            outage = self._outages.get(link)
+            if not state_is_up:
+                if outage is None:
+                    outage = self._outages[link] = {"start": unixtime, "last": unixtime, "tier": failed_tier,
+                                                    "samples": 0}
+                outage["start"] = min(outage["start"], unixtime)
+                outage["last"] = max(outage["last"], unixtime)
+                if outage["tier"] is None:
+                    outage["tier"] = failed_tier
+                if is_sample:
+                    outage["samples"] += 1
+            elif outage is not None:
+                del self._outages[link]
+                self._write_locked(outage, unixtime, link)
+
+    def close(self):
+        """Write the outages still going on."""
+        with self._lock:
+            for link, outage in sorted(self._outages.items()):
+                self._write_locked(outage, outage["last"], link, ongoing=True)
+            self._outages.clear()
+
+    def _write_locked(self, outage, end, link, ongoing=False):
+        # a fast-detect marker dated back to the moment of recovery can come before the last down sample
+        end = max(end, outage["start"])
+        record = {
+            "start": round(outage["start"], 3),
+            "end": round(end, 3),
+            "duration": round(end - outage["start"], 3),
+            "tier": outage["tier"],
+            "samples": outage["samples"],
+        }
+        if link:
+            record["link"] = link
+        if ongoing:
+            record["ongoing"] = True
+        # rare enough to make durable straight away
+        with open(self.filename, "a") as handle:
+            handle.write(json.dumps(record) + "\n")
+            handle.flush()
+            os.fsync(handle.fileno())
+
+
+def iter_outages(filename, start=None, link=None):
+    """Yield the outage dicts in filename ending at or after unixtime start, of link if given."""
+    with open(filename) as handle:
+        for line in handle:
+            try:
+                outage = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by a crash
+            if start is not None and outage["end"] < start:
+                continue
+            if link is not None and outage.get("link", "") != link:
+                continue
+            yield outage
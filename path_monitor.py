@@ -0,0 +1,209 @@
+"""Watch every hop on the path to a target, probing all hops at once.
+
+Each hop gets its own UDP socket with IP_TTL set to the hop number and
+IP_RECVERR turned on, so the ICMP time exceeded (or, from the target itself,
+port unreachable) comes back on that socket's error queue. This needs no
+privileges, but IP_RECVERR is Linux only.
+
+Results are kept per hop in fixed-size arrays, see HopSeries."""
+import asyncio
+import math
+import socket
+import struct
+import time
+from array import array
+
+from my_exceptions import NoConnectionException
+
+_MAX_HOPS = 20
+_PATH_PROBE_TIMEOUT_SECONDS = 2
+# samples kept per hop: a day at one path probe a minute
+_HOP_HISTORY_SAMPLES = 1440
+# traceroute's first UDP port; each hop uses _BASE_PORT + ttl
+_BASE_PORT = 33434
+
+_IP_RECVERR = getattr(socket, "IP_RECVERR", 11)
+_SO_EE_ORIGIN_ICMP = 2
+_ICMP_DEST_UNREACHABLE = 3
+_ICMP_TIME_EXCEEDED = 11
+# struct sock_extended_err: ee_errno, ee_origin, ee_type, ee_code, ee_pad, ee_info, ee_data,
+# followed by the sockaddr_in of whoever sent the ICMP error
+_SOCK_EXTENDED_ERR = struct.Struct("=IBBBBII")
+
+
+class HopResult:
+    """One probe to one hop: who answered, how fast, and whether it was the target."""
+    __slots__ = ("ttl", "responder", "rtt", "reached_target")
+
+    def __init__(self, ttl, responder=None, rtt=None, reached_target=False):
+        self.ttl = ttl
+        self.responder = responder
+        self.rtt = rtt
+        self.reached_target = reached_target
+
+    def __repr__(self):
+        return "HopResult(ttl={}, responder={!r}, rtt={!r}, reached_target={})".format(
+            self.ttl, self.responder, self.rtt, self.reached_target)
+
+
+def parse_extended_error(ancillary_data):
+    """Return (icmp type, icmp code, offender ip) from recvmsg() ancillary data, or None."""
+    for level, kind, data in ancillary_data:
+        if level != socket.IPPROTO_IP or kind != _IP_RECVERR or len(data) < _SOCK_EXTENDED_ERR.size:
+            continue
+        _, origin, icmp_type, icmp_code, _, _, _ = _SOCK_EXTENDED_ERR.unpack_from(data)
+        if origin != _SO_EE_ORIGIN_ICMP:
+            continue
+        offender = data[_SOCK_EXTENDED_ERR.size:]
+        offender_ip = socket.inet_ntoa(offender[4:8]) if len(offender) >= 8 else None
+        return icmp_type, icmp_code, offender_ip
+    return None
+
+
+async def probe_hop(ip, ttl, timeout=_PATH_PROBE_TIMEOUT_SECONDS):
+    """Send one TTL-limited UDP datagram to ip, return a HopResult.
+
+    Raises NoConnectionException if nothing came back within timeout."""
+    loop = asyncio.get_event_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    future = loop.create_future()
+
+    def on_readable():
+        try:
+            _, ancillary_data, _, _ = sock.recvmsg(512, 512, socket.MSG_ERRQUEUE)
+        except BlockingIOError:
+            # no error queued; maybe something is really listening on the port
+            try:
+                sock.recv(512)
+            except OSError:
+                return
+            error = (_ICMP_DEST_UNREACHABLE, 3, ip)
+        except OSError:
+            return
+        else:
+            error = parse_extended_error(ancillary_data)
+        if error is not None and not future.done():
+            future.set_result((time.perf_counter(), error))
+
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+        sock.setsockopt(socket.IPPROTO_IP, _IP_RECVERR, 1)
+        sock.connect((ip, _BASE_PORT + ttl))
+        loop.add_reader(sock.fileno(), on_readable)
+        try:
+            send_time = time.perf_counter()
+            sock.send(b"internet_connection_monitor")
+            receive_time, (icmp_type, _, responder) = await asyncio.wait_for(future, timeout)
+        finally:
+            loop.remove_reader(sock.fileno())
+    except asyncio.TimeoutError:
+        raise NoConnectionException("no answer from hop {} towards {}".format(ttl, ip))
+    except OSError as e:
+        raise NoConnectionException("could not probe hop {} towards {}: {}".format(ttl, ip, e))
+    finally:
+        sock.close()
+
+    return HopResult(ttl, responder, (receive_time - send_time) * 1000,
+                     reached_target=icmp_type == _ICMP_DEST_UNREACHABLE)
+
+
+class HopSeries:
+    """RTT history of one hop in fixed-size ring arrays. Lost probes are NaN."""
+    __slots__ = ("unixtimes", "rtts", "responder", "count", "next_index")
+
+    def __init__(self, capacity=_HOP_HISTORY_SAMPLES):
+        self.unixtimes = array("d", bytes(8 * capacity))
+        self.rtts = array("f", bytes(4 * capacity))
+        self.responder = None
+        self.count = 0
+        self.next_index = 0
+
+    def add(self, unixtime, rtt, responder=None):
+        self.unixtimes[self.next_index] = unixtime
+        self.rtts[self.next_index] = math.nan if rtt is None else rtt
+        self.next_index = (self.next_index + 1) % len(self.rtts)
+        self.count = min(self.count + 1, len(self.rtts))
+        if responder is not None:
+            self.responder = responder
+
+    def samples(self):
+        """Return [(unixtime, rtt or None)], oldest first."""
+        start = (self.next_index - self.count) % len(self.rtts)
+        indexes = (((start + n) % len(self.rtts)) for n in range(self.count))
+        return list((self.unixtimes[i], None if math.isnan(self.rtts[i]) else self.rtts[i])
+                    for i in indexes)
+
+    def loss_percent(self):
+        if not self.count:
+            return 0.0
+        lost = sum(1 for _, rtt in self.samples() if rtt is None)
+        return 100.0 * lost / self.count
+
+    def latest_rtt(self):
+        if not self.count:
+            return None
+        rtt = self.rtts[(self.next_index - 1) % len(self.rtts)]
+        return None if math.isnan(rtt) else rtt
+
+
+class PathMonitor:
+    """Probe every hop towards a target at once and keep a HopSeries per hop."""
+
+    def __init__(self, target, max_hops=_MAX_HOPS, timeout=_PATH_PROBE_TIMEOUT_SECONDS,
+                 history=_HOP_HISTORY_SAMPLES):
+        self.target = target
+        self.max_hops = max_hops
+        self.timeout = timeout
+        self.history = history
+        self.hops = {}
+        self.hop_count = None
+
+    async def probe_path(self):
+        """Probe all hops once, record the results, return them as HopResults."""
+        loop = asyncio.get_event_loop()
+        infos = await loop.getaddrinfo(self.target, None, family=socket.AF_INET)
+        ip = infos[0][4][0]
+
+        results = await asyncio.gather(*(probe_hop(ip, ttl, self.timeout)
+                                         for ttl in range(1, self.max_hops + 1)),
+                                       return_exceptions=True)
+        results = list(result if isinstance(result, HopResult) else HopResult(ttl)
+                       for ttl, result in enumerate(results, start=1))
+
+        # every probe past the target's distance is answered by the target too
+        reached = list(result.ttl for result in results if result.reached_target)
+        if reached:
+            self.hop_count = min(reached)
+            results = results[:self.hop_count]
+
+        now = time.time()
+        for result in results:
+            series = self.hops.get(result.ttl)
+            if series is None:
+                series = self.hops[result.ttl] = HopSeries(self.history)
+            series.add(now, result.rtt, result.responder)
+        return results
+
+    def hop_address(self, ttl):
+        """Return the last address seen answering at hop ttl, or None."""
+        series = self.hops.get(ttl)
+        return series.responder if series is not None else None
+
+    def summary(self):
+        """Return a one line description of the latest probe, for logging."""
+        return " ".join("{}:{}({})".format(
+            ttl,
+            self.hops[ttl].responder or "*",
+            "-" if self.hops[ttl].latest_rtt() is None else "{:.1f}".format(self.hops[ttl].latest_rtt()))
+            for ttl in sorted(self.hops) if self.hop_count is None or ttl <= self.hop_count)
+
+
+if __name__ == "__main__":
+    import sys
+    from event_loop import run_sync
+
+    monitor = PathMonitor(sys.argv[1] if len(sys.argv) > 1 else "8.8.8.8")
+    for result in run_sync(monitor.probe_path()):
+        print(result)
+    print(monitor.summary())
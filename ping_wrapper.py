@@ -1,42 +1,337 @@
 """Provide an OS-agnostic interface to the ping command."""
+import asyncio
+import os
+import signal
 import subprocess
 import platform
 import re
-from multiprocessing import Pool
+import threading
+import time
+import logging
+import math
+from collections import deque
 
 from my_exceptions import NoConnectionException
+from event_loop import get_thread_event_loop, run_sync
+import icmp_ping
+import instrumentation
 
 # The ping timeout. This is also the max measurable ping time output by this module.
 # If the connection is down, ping() will take at least this long to report this fact.
 _MAX_PING_TIME_SECONDS = 2
 
-# a number too high may affect ping times for ping_parallel()
-_MAX_THREADS_FOR_PARALLEL_PING = 5
+# Upper bound on probes in flight at once in ping_many()/ping_parallel(). A
+# number too high may affect ping times, especially when each probe is a ping
+# process rather than a packet on the shared ICMP socket.
+_MAX_PROBES_IN_FLIGHT = 32
 
+# Ping from inside the process (see icmp_ping) when the OS allows us to open an
+# ICMP socket, instead of forking a shell and the ping binary for every sample.
+_PREFER_NATIVE_ICMP = True
 
+_IS_WINDOWS = platform.system().lower() == "windows"
+
+# should match both unix/win ping: optional space before ms
+#   "time=10.0 ms"  unix
+#   "time=<1ms"     windows
+#   "time=10.0ms"   windows
+_LATENCY_REGEX = re.compile(r"time=?([<\d.]+) ?ms")
+
+# Everything parse_probe_result() needs from ping's output, found in one pass:
+#   "time=10.0 ms" (as above)
+#   "2 packets transmitted, 1 received, 50% packet loss"      linux
+#   "2 packets transmitted, 1 packets received, 50.0% ..."    mac
+#   "rtt min/avg/max/mdev = 9.8/10.0/10.2/0.2 ms"             linux
+#   "round-trip min/avg/max/stddev = 9.8/10.0/10.2/0.2 ms"    mac
+#   "Packets: Sent = 2, Received = 1, Lost = 1 (50% loss)"    windows
+_PING_OUTPUT_REGEX = re.compile(
+    r"time=?(?P<time>[<\d.]+) ?ms"
+    r"|(?P<sent>\d+) packets transmitted, (?P<received>\d+) (?:packets )?received"
+    r"|min/avg/max/(?:mdev|stddev) = (?P<min>[\d.]+)/(?P<avg>[\d.]+)/(?P<max>[\d.]+)/(?P<mdev>[\d.]+)"
+    r"|Sent = (?P<windows_sent>\d+)")
+
+# lines from a continuous ping that mean one packet got no reply
+#   "no answer yet for icmp_seq=5"                     unix, with -O
+#   "From 10.0.0.1 icmp_seq=3 Destination Host Unreachable"  unix
+#   "Request timeout for icmp_seq 5"                   mac
+#   "Request timed out."                               windows
+#   "Reply from 10.0.0.1: Destination host unreachable."     windows
+_LOST_PACKET_REGEX = re.compile(r"no answer yet|unreachable|timed out|request timeout", re.IGNORECASE)
+
+# the sequence number of a reply or lost packet, to spot gaps where a ping
+# without -O stayed silent: "icmp_seq=5" (linux, mac replies), "icmp_seq 5" (mac timeouts)
+_ICMP_SEQ_REGEX = re.compile(r"icmp_seq[= ](\d+)")
+
+# whether the ping binary accepts -O (only iputils ping does), found out once
+_ping_reports_outstanding = None
+
+# how long PingSession waits before restarting a ping process that exited
+_PING_SESSION_RESTART_DELAY_SECONDS = 5
+
+# FastOutageDetector defaults: a probe goes out every 50ms and each has 250ms
+# to come back, so about 5 are in flight at once. 3 misses (or replies) in a
+# row change the state, which is noticed ~0.35s after it happens and dated to
+# within one send interval.
+_FAST_DETECT_SEND_INTERVAL_SECONDS = 0.05
+_FAST_DETECT_DEADLINE_SECONDS = 0.25
+_FAST_DETECT_CONSECUTIVE = 3
+
+
+def uses_native_icmp():
+    """Return True if pings are sent from this process rather than the ping binary."""
+    return _PREFER_NATIVE_ICMP and icmp_ping.is_available()
+
+
+@instrumentation.timed("ping")
 def ping(ip, sample_count=2):
     """Ping an IP, return its average latency."""
     latencies = ping_and_return_latency_list(ip, sample_count)
     return sum(latencies) / len(latencies)  # average
 
 
-def ping_parallel(ip_list, sample_count=2):
+class ProbeResult:
+    """Statistics of one ping run to one IP, all times in ms.
+
+    Unlike ping_and_return_latency_list(), partial loss is kept rather than
+    reported as no connection. min/avg/max/mdev/jitter are None if nothing
+    came back."""
+    __slots__ = ("ip", "sent", "received", "min", "avg", "max", "mdev", "jitter")
+
+    def __init__(self, ip, sent, received, min=None, avg=None, max=None, mdev=None, jitter=None):
+        self.ip = ip
+        self.sent = sent
+        self.received = received
+        self.min = min
+        self.avg = avg
+        self.max = max
+        self.mdev = mdev
+        self.jitter = jitter
+
+    @classmethod
+    def from_latencies(cls, ip, sent, latencies):
+        result = cls(ip, sent, len(latencies))
+        if latencies:
+            count = len(latencies)
+            result.min = min(latencies)
+            result.max = max(latencies)
+            result.avg = sum(latencies) / count
+            # mdev is the standard deviation, same as ping reports it
+            result.mdev = math.sqrt(max(0.0, sum(n * n for n in latencies) / count - result.avg ** 2))
+            result.jitter = mean_absolute_difference(latencies)
+        return result
+
+    @property
+    def is_up(self):
+        return self.received > 0
+
+    @property
+    def loss_percent(self):
+        if not self.sent:
+            return 100.0
+        return 100.0 * (self.sent - self.received) / self.sent
+
+    def csv_fields(self):
+        """Return sent, received, loss %, min, avg, max, mdev, jitter as strings."""
+        return [str(self.sent), str(self.received), "{:.1f}".format(self.loss_percent)] + list(
+            "" if n is None else "{:.2f}".format(n)
+            for n in (self.min, self.avg, self.max, self.mdev, self.jitter))
+
+    def __repr__(self):
+        return "ProbeResult({})".format(", ".join(
+            "{}={!r}".format(name, getattr(self, name)) for name in self.__slots__))
+
+
+def mean_absolute_difference(latencies):
+    """Return the average change between consecutive latencies (the jitter)."""
+    if len(latencies) < 2:
+        return 0.0
+    return sum(abs(b - a) for a, b in zip(latencies, latencies[1:])) / (len(latencies) - 1)
+
+
+def ping_parallel(ip_list, sample_count=2, max_in_flight=_MAX_PROBES_IN_FLIGHT):
     """Check latency to multiple IPs in parallel. 
 
     Returns a list of (address, ping in ms) tuples."""
+    latencies = [None] * len(ip_list)
+    for index, result in iter_ping_parallel(ip_list, sample_count, max_in_flight, with_index=True):
+        if isinstance(result, Exception):
+            raise result
+        latencies[index] = result
+
+    return list(zip(ip_list, latencies))
+
+
+def iter_ping_parallel(ip_list, sample_count=2, max_in_flight=_MAX_PROBES_IN_FLIGHT, with_index=False,
+                       timeout=_MAX_PING_TIME_SECONDS, source=None):
+    """Blocking version of ping_many(): yield results as each ping finishes."""
+    loop = get_thread_event_loop()
+    results = _ping_as_completed(ip_list, sample_count, max_in_flight, timeout, source)
+    try:
+        while True:
+            try:
+                index, result = loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                return
+            yield (index if with_index else ip_list[index]), result
+    finally:
+        loop.run_until_complete(results.aclose())
+
+
+async def ping_many(ip_list, sample_count=2, max_in_flight=_MAX_PROBES_IN_FLIGHT, timeout=_MAX_PING_TIME_SECONDS,
+                    source=None):
+    """Ping many IPs concurrently, at most max_in_flight at a time.
+
+    Yields (ip, average latency in ms) as each ping finishes, or (ip, exception)
+    if it failed, so one dead target never holds back the others."""
+    async for index, result in _ping_as_completed(ip_list, sample_count, max_in_flight, timeout, source):
+        yield ip_list[index], result
+
+
+async def _ping_as_completed(ip_list, sample_count, max_in_flight, timeout, source=None):
+    semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def bounded_ping(index, ip):
+        async with semaphore:
+            try:
+                latencies = await async_ping_and_return_latency_list(ip, sample_count, timeout, source)
+            except (NoConnectionException, RuntimeError, OSError) as e:
+                # OSError: e.g. source names an interface that doesn't exist (ENODEV)
+                return index, e
+        return index, sum(latencies) / len(latencies)
+
+    loop = asyncio.get_event_loop()
+    tasks = list(loop.create_task(bounded_ping(index, ip)) for index, ip in enumerate(ip_list))
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def async_ping_and_return_latency_list(ip, sample_count=2, timeout=_MAX_PING_TIME_SECONDS, source=None):
+    """Coroutine version of ping_and_return_latency_list()."""
+    if uses_native_icmp():
+        return await icmp_ping.async_ping_and_return_latency_list(ip, sample_count, timeout, source)
+
+    process = await asyncio.create_subprocess_exec(*ping_command(ip, sample_count, timeout, source),
+                                                   stdout=subprocess.PIPE,
+                                                   stderr=subprocess.DEVNULL)
+    try:
+        stdout, _ = await process.communicate()
+    except asyncio.CancelledError:
+        kill_process(process)
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        raise NoConnectionException("bad response from ping: server probably down")
+    return parse_latency_list(stdout.decode("utf-8"), sample_count)
+
+
+@instrumentation.timed("ping_and_return_probe_result")
+def ping_and_return_probe_result(ip, sample_count=2, source=None, timeout=_MAX_PING_TIME_SECONDS):
+    """Ping an IP, return a ProbeResult. Lost packets are counted, not raised."""
+    if uses_native_icmp():
+        samples = run_sync(icmp_ping.async_ping_and_return_samples(ip, sample_count, timeout, source))
+        return ProbeResult.from_latencies(ip, sample_count, list(n for n in samples if n is not None))
+
+    complete_proc = subprocess.run(ping_command(ip, sample_count, timeout, source), stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL)
+    return parse_probe_result(ip, complete_proc.stdout.decode("utf-8"), sample_count)
+
+
+async def async_ping_and_return_probe_result(ip, sample_count=2, timeout=_MAX_PING_TIME_SECONDS, source=None):
+    """Coroutine version of ping_and_return_probe_result()."""
+    if uses_native_icmp():
+        try:
+            samples = await icmp_ping.async_ping_and_return_samples(ip, sample_count, timeout, source)
+        except NoConnectionException:
+            samples = []
+        return ProbeResult.from_latencies(ip, sample_count, list(n for n in samples if n is not None))
+
+    process = await asyncio.create_subprocess_exec(*ping_command(ip, sample_count, timeout, source),
+                                                   stdout=subprocess.PIPE,
+                                                   stderr=subprocess.DEVNULL)
+    try:
+        stdout, _ = await process.communicate()
+    except asyncio.CancelledError:
+        kill_process(process)
+        await process.wait()
+        raise
+    return parse_probe_result(ip, stdout.decode("utf-8"), sample_count)
+
 
-    ip_count_list = [(ip, sample_count) for ip in ip_list]
+def kill_process(process):
+    """Kill an asyncio subprocess that may have exited already."""
+    if _IS_WINDOWS:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        return
+    # Process.kill() polls the child first, which can reap it before asyncio's
+    # child watcher does; a signal to a child that exited but wasn't reaped yet
+    # is harmless
+    os.kill(process.pid, signal.SIGKILL)
 
-    with Pool(_MAX_THREADS_FOR_PARALLEL_PING) as p:
-        raw_results = p.map_async(ping_with_wrapped_parameters,
-                                  ip_count_list).get(999)
 
-    return list(zip(ip_list, raw_results))
+def start_probe_results(targets, timeout=_MAX_PING_TIME_SECONDS, max_in_flight=_MAX_PROBES_IN_FLIGHT, source=None):
+    """Start pinging each (ip, sample_count) of targets on the running loop, at most max_in_flight at a time.
+
+    Returns one task per target, giving its ProbeResult. Cancel the ones you
+    stop waiting for."""
+    semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def bounded_probe(ip, sample_count):
+        async with semaphore:
+            return await async_ping_and_return_probe_result(ip, sample_count, timeout, source)
+
+    loop = asyncio.get_event_loop()
+    return list(loop.create_task(bounded_probe(ip, sample_count)) for ip, sample_count in targets)
+
+
+def parse_probe_result(ip, text, sample_count):
+    """Build a ProbeResult from ping's text output.
+
+    Uses ping's own summary lines where present, otherwise works the statistics
+    out from the individual time= values."""
+    latencies = []
+    sent = received = summary = None
+    for match in _PING_OUTPUT_REGEX.finditer(text):
+        value = match.group("time")
+        if value is not None:
+            # Windows shows all values lower than 1ms as "<1ms"
+            latencies.append(0.5 if value == "<1" else float(value))
+        elif match.group("sent") is not None:
+            sent = int(match.group("sent"))
+            received = int(match.group("received"))
+        elif match.group("min") is not None:
+            summary = match
+        else:
+            # windows counts "Destination host unreachable" replies as received
+            sent = int(match.group("windows_sent"))
+
+    result = ProbeResult.from_latencies(ip, sample_count if sent is None else sent, latencies)
+    if received is not None:
+        result.received = received
+    if summary is not None:
+        result.min, result.avg, result.max, result.mdev = (
+            float(summary.group(name)) for name in ("min", "avg", "max", "mdev"))
+    return result
 
 
 def ping_and_return_latency_list(ip, sample_count=2):
     """Ping an IP, return a list of latencies in ms, one per sample_count."""
-    lines = ping_and_return_text_output(ip, sample_count=sample_count).splitlines()
+    if uses_native_icmp():
+        return icmp_ping.ping_and_return_latency_list(ip, sample_count)
+
+    return parse_latency_list(ping_and_return_text_output(ip, sample_count=sample_count), sample_count)
+
+
+def parse_latency_list(text, sample_count):
+    """Return the latencies in ms from ping's text output."""
+    lines = text.splitlines()
 
     # TODO: replace with a real check once I see the error message
     if "Error resolving network or something" in lines:
@@ -48,11 +343,7 @@ def ping_and_return_latency_list(ip, sample_count=2):
 
     values = []
     for line in lines:
-        # should match both unix/win ping: optional space before ms
-        #   "time=10.0 ms"  unix
-        #   "time=<1ms"     windows
-        #   "time=10.0ms"   windows
-        match = re.search("time=?([<\d.]+) ?ms", line)
+        match = _LATENCY_REGEX.search(line)
         if match:
             # Windows shows all values lower than 1ms as "<1ms"
             value = 0.5 if match.group(1) == "<1" else match.group(1)
@@ -66,30 +357,259 @@ def ping_and_return_latency_list(ip, sample_count=2):
     return list(float(n) for n in values)
 
 
-def ping_and_return_text_output(ip, sample_count=1, timeout=_MAX_PING_TIME_SECONDS):
-    """Ping an ip and return ping's output, otherwise raise NoConnectionException.."""
-    if platform.system().lower() == "windows":
+def ping_command(ip, sample_count=1, timeout=_MAX_PING_TIME_SECONDS, source=None):
+    """Return the argument list to run ping on this OS.
+
+    source is the interface name or local address to send from, None for
+    whatever the routing table picks."""
+    if _IS_WINDOWS:
         timeout = int(timeout * 1000)
         timeout = 1 if timeout < 1 else timeout
-        ping_params = "-n {} -w {}".format(sample_count, timeout)
-    else:
-        timeout = int(timeout)
-        timeout = 1 if timeout < 1 else timeout
-        ping_params = "-c {} -W {}".format(sample_count, timeout)
+        # windows can only bind an address, not an interface
+        source_args = [] if source is None else ["-S", source]
+        return ["ping", "-n", str(sample_count), "-w", str(timeout)] + source_args + [ip]
 
-    cmd = "ping {} {}".format(ping_params, ip)
+    timeout = int(timeout)
+    timeout = 1 if timeout < 1 else timeout
+    source_args = [] if source is None else ["-I", source]
+    return ["ping", "-c", str(sample_count), "-W", str(timeout)] + source_args + [ip]
+
+
+def ping_and_return_text_output(ip, sample_count=1, timeout=_MAX_PING_TIME_SECONDS):
+    """Ping an ip and return ping's output, otherwise raise NoConnectionException.."""
     try:
-        complete_proc = subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-    except subprocess.CalledProcessError:
+        complete_proc = subprocess.run(ping_command(ip, sample_count, timeout), check=True,
+                                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except (subprocess.CalledProcessError, FileNotFoundError):
         raise NoConnectionException("bad response from ping: server probably down")
 
     return complete_proc.stdout.decode("utf-8")
 
 
-def ping_with_wrapped_parameters(ip_count_tuple):
-    ip, sample_count = ip_count_tuple
-    return ping(ip, sample_count=sample_count)
+def ping_reports_outstanding():
+    """Return whether ping prints a line for packets that got no reply (-O).
+
+    Only iputils ping has -O, busybox and BSD/mac ping reject it. Its -V names
+    iputils, the others fail or print something else."""
+    global _ping_reports_outstanding
+    if _ping_reports_outstanding is None:
+        try:
+            output = subprocess.run(["ping", "-V"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    universal_newlines=True, timeout=5).stdout
+        except (OSError, subprocess.SubprocessError):
+            output = ""
+        _ping_reports_outstanding = "iputils" in output
+    return _ping_reports_outstanding
+
+
+class PingSession:
+    """Run one long-lived continuous ping to a target and parse it as it runs.
+
+    Each reply (or lost packet) is stored with the time its line arrived, and
+    pop_samples() hands them over to the caller. The ping process is restarted
+    if it exits, e.g. because the network was unreachable when it started.
+
+    A ping without -O stays silent about lost packets, so they are counted
+    from the gaps in icmp_seq when the next reply arrives."""
+
+    def __init__(self, ip, interval=1.0, timeout=_MAX_PING_TIME_SECONDS, max_samples=1000, source=None):
+        self.ip = ip
+        self.interval = interval
+        self.timeout = timeout
+        self.source = source
+        self.last_output_unixtime = None
+        self._samples = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+        self._process = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._last_seq = None
+
+    def command(self):
+        if _IS_WINDOWS:
+            # windows ping can not change its 1s interval
+            timeout = max(1, int(self.timeout * 1000))
+            source_args = [] if self.source is None else ["-S", self.source]
+            return ["ping", "-t", "-w", str(timeout)] + source_args + [self.ip]
+        timeout = max(1, int(self.timeout))
+        source_args = [] if self.source is None else ["-I", self.source]
+        # -O prints a line for every packet that got no reply before the next was sent
+        outstanding_args = ["-O"] if ping_reports_outstanding() else []
+        return (["ping", "-n"] + outstanding_args + ["-i", str(self.interval), "-W", str(timeout)]
+                + source_args + [self.ip])
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="PingSession({})".format(self.ip), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        process = self._process
+        if process is not None and process.poll() is None:
+            process.terminate()
+        if self._thread is not None:
+            self._thread.join(timeout=self.timeout + 1)
+
+    def is_running(self):
+        process = self._process
+        return process is not None and process.poll() is None
+
+    def pop_samples(self):
+        """Return and forget all (unixtime, latency in ms or None) samples collected so far."""
+        with self._lock:
+            samples = list(self._samples)
+            self._samples.clear()
+        return samples
+
+    def _run(self):
+        while not self._stopped.is_set():
+            # a new process counts icmp_seq from the start again
+            self._last_seq = None
+            try:
+                self._process = subprocess.Popen(self.command(), stdout=subprocess.PIPE,
+                                                 stderr=subprocess.DEVNULL, bufsize=1,
+                                                 universal_newlines=True)
+            except OSError:
+                logging.exception("could not start ping for {}".format(self.ip))
+            else:
+                for line in self._process.stdout:
+                    self._parse_line(line)
+                self._process.wait()
+                logging.debug("ping to {} exited with {}".format(self.ip, self._process.returncode))
+            self._stopped.wait(_PING_SESSION_RESTART_DELAY_SECONDS)
+
+    def _parse_line(self, line):
+        now = time.time()
+        self.last_output_unixtime = now
+        match = _LATENCY_REGEX.search(line)
+        if match:
+            # Windows shows all values lower than 1ms as "<1ms"
+            latency = 0.5 if match.group(1) == "<1" else float(match.group(1))
+        elif _LOST_PACKET_REGEX.search(line):
+            latency = None
+        else:
+            return
+        missed = 0
+        seq_match = _ICMP_SEQ_REGEX.search(line)
+        if seq_match:
+            seq = int(seq_match.group(1))
+            if self._last_seq is not None and seq > self._last_seq:
+                # packets in between got neither a reply nor a line of their own
+                missed = seq - self._last_seq - 1
+            if self._last_seq is None or seq > self._last_seq:
+                self._last_seq = seq
+        with self._lock:
+            self._samples.extend([(now, None)] * missed)
+            self._samples.append((now, latency))
+
+
+class FastOutageDetector:
+    """Notice the link going down or coming back up within a fraction of a second.
+
+    Staggered probes are kept in flight, each with a short deadline, and their
+    outcomes are taken in send order. Once `consecutive` probes in a row have
+    all missed (or all met) their deadline, on_transition(state_is_up, unixtime)
+    is called. unixtime is the send time of the first probe of that run, read
+    from the monotonic clock and mapped onto the wall clock, so NTP steps don't
+    move it.
+
+    probe is a coroutine function taking a timeout and raising
+    NoConnectionException on failure, e.g. icmp_ping.get_prober().probe bound
+    to an IP, or probes.TcpConnectProbe(...).measure."""
+
+    def __init__(self, probe, on_transition,
+                 send_interval=_FAST_DETECT_SEND_INTERVAL_SECONDS,
+                 deadline=_FAST_DETECT_DEADLINE_SECONDS,
+                 consecutive=_FAST_DETECT_CONSECUTIVE):
+        self.probe = probe
+        self.on_transition = on_transition
+        self.send_interval = send_interval
+        self.deadline = deadline
+        self.consecutive = consecutive
+        self.state_is_up = None
+        self._run_is_up = None
+        self._run_length = 0
+        self._run_start = None
+        self._stopped = threading.Event()
+        self._thread = None
+        self._loop = None
+        self._in_flight = None
+        # anchor the monotonic clock to the wall clock once
+        self._wall_anchor = time.time()
+        self._monotonic_anchor = time.monotonic()
+
+    def unixtime_from_monotonic(self, monotonic_time):
+        return self._wall_anchor + (monotonic_time - self._monotonic_anchor)
+
+    async def _timed_probe(self):
+        try:
+            await asyncio.wait_for(self.probe(self.deadline), self.deadline)
+        except (NoConnectionException, asyncio.TimeoutError):
+            return False
+        return True
+
+    def record_outcome(self, is_up, sent_at):
+        if is_up == self._run_is_up:
+            self._run_length += 1
+        else:
+            self._run_is_up = is_up
+            self._run_length = 1
+            self._run_start = sent_at
+
+        if self._run_length >= self.consecutive and is_up != self.state_is_up:
+            self.state_is_up = is_up
+            self.on_transition(is_up, self.unixtime_from_monotonic(self._run_start))
+
+    async def run_forever(self):
+        loop = asyncio.get_event_loop()
+        in_flight = asyncio.Queue()
+        self._loop, self._in_flight = loop, in_flight
+
+        async def send_probes():
+            next_send = loop.time()
+            while not self._stopped.is_set():
+                in_flight.put_nowait((time.monotonic(), loop.create_task(self._timed_probe())))
+                # schedule from the previous send time so the cadence doesn't drift
+                next_send += self.send_interval
+                await asyncio.sleep(max(0.0, next_send - loop.time()))
+
+        sender = loop.create_task(send_probes())
+        try:
+            while not self._stopped.is_set():
+                item = await in_flight.get()
+                if item is None:
+                    # stop() woke us up
+                    break
+                sent_at, task = item
+                # the oldest probe is always done by its deadline, so taking
+                # them in send order never waits longer than that
+                self.record_outcome(await task, sent_at)
+        finally:
+            sender.cancel()
+            while not in_flight.empty():
+                item = in_flight.get_nowait()
+                if item is not None:
+                    item[1].cancel()
+
+    def start(self):
+        """Run in a background thread with its own event loop."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=lambda: run_sync(self.run_forever()),
+                                        name="FastOutageDetector", daemon=True)
+        self._thread.start()
 
+    def stop(self):
+        self._stopped.set()
+        loop, in_flight = self._loop, self._in_flight
+        if loop is not None and not loop.is_closed():
+            try:
+                # the consumer may be waiting on an empty queue once the sender has stopped
+                loop.call_soon_threadsafe(in_flight.put_nowait, None)
+            except RuntimeError:
+                pass  # the loop closed in the meantime
+        if self._thread is not None:
+            self._thread.join(timeout=self.deadline + 1)
 
 if __name__ == "__main__":
 
@@ -109,8 +629,9 @@ if __name__ == "__main__":
     print("two parallel pings to 10.0.0.1 and 8.8.8.8:")
     print("ping_parallel(['10.0.0.1','8.8.8.8']) = {}".format(ping_parallel(['10.0.0.1','8.8.8.8'])))
     print()
-    print("{} parallel ping operations (max thread count) to 8.8.8.8:".format(_MAX_THREADS_FOR_PARALLEL_PING))
-    print("ping_parallel(['8.8.8.8']*{}) = {}".format(_MAX_THREADS_FOR_PARALLEL_PING, ping_parallel(['8.8.8.8']*_MAX_THREADS_FOR_PARALLEL_PING)))
+    print("{} parallel ping operations (max in flight) to 8.8.8.8:".format(_MAX_PROBES_IN_FLIGHT))
+    print("ping_parallel(['8.8.8.8']*{}) = {}".format(_MAX_PROBES_IN_FLIGHT, ping_parallel(['8.8.8.8']*_MAX_PROBES_IN_FLIGHT)))
     print()
-    print("{} parallel ping operations (max thread count) to 8.8.8.8, one sample each:".format(_MAX_THREADS_FOR_PARALLEL_PING))
-    print("ping_parallel(['8.8.8.8']*{}, sample_count=1) = {}".format(_MAX_THREADS_FOR_PARALLEL_PING, ping_parallel(['8.8.8.8']*_MAX_THREADS_FOR_PARALLEL_PING, sample_count=1)))
+    print("results from 8.8.8.8, 1.1.1.1 and 10.0.0.1 in the order they finish:")
+    for ip, result in iter_ping_parallel(['10.0.0.1', '8.8.8.8', '1.1.1.1'], sample_count=1):
+        print("  {}: {}".format(ip, result))
@@ -0,0 +1,222 @@
+"""Latency probes that look more like what users feel than ICMP does.
+
+Every probe has a name and an async measure() which returns the latency in ms
+or raises NoConnectionException. measure_all() runs a list of them at once on
+one event loop."""
+import asyncio
+import random
+import socket
+import ssl
+import struct
+import time
+from urllib.parse import urlsplit
+
+from my_exceptions import NoConnectionException
+import ping_wrapper
+
+# Per-probe timeout, same meaning as ping_wrapper._MAX_PING_TIME_SECONDS
+_MAX_PROBE_TIME_SECONDS = 2
+
+_DNS_HEADER = struct.Struct("!HHHHHH")
+_DNS_TYPE_A = 1
+_DNS_CLASS_IN = 1
+
+
+class Probe:
+    """Base class: measure() the latency to something, in ms."""
+    name = "probe"
+
+    async def measure(self, timeout=_MAX_PROBE_TIME_SECONDS):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.name)
+
+
+class IcmpProbe(Probe):
+    """One ping, through ping_wrapper."""
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.name = "icmp:{}".format(ip)
+
+    async def measure(self, timeout=_MAX_PROBE_TIME_SECONDS):
+        latencies = await ping_wrapper.async_ping_and_return_latency_list(self.ip, 1, timeout)
+        return latencies[0]
+
+
+class TcpConnectProbe(Probe):
+    """Time a TCP handshake. The connection is closed straight away.
+
+    With refused_is_up, a refused connection (the host answered with a RST)
+    counts too and is timed like a handshake: it shows the path is up even if
+    nothing listens on the port."""
+
+    def __init__(self, host, port, refused_is_up=False):
+        self.host = host
+        self.port = port
+        self.refused_is_up = refused_is_up
+        self.name = "tcp:{}:{}".format(host, port)
+
+    async def measure(self, timeout=_MAX_PROBE_TIME_SECONDS):
+        start = time.perf_counter()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), timeout)
+        except ConnectionRefusedError as e:
+            if self.refused_is_up:
+                return (time.perf_counter() - start) * 1000
+            raise NoConnectionException("tcp connect to {}:{} failed: {!r}".format(self.host, self.port, e))
+        except (OSError, asyncio.TimeoutError) as e:
+            raise NoConnectionException("tcp connect to {}:{} failed: {!r}".format(self.host, self.port, e))
+        latency = (time.perf_counter() - start) * 1000
+        writer.close()
+        return latency
+
+
+class _DnsResponseProtocol(asyncio.DatagramProtocol):
+    def __init__(self, query_id, future):
+        self.query_id = query_id
+        self.future = future
+
+    def datagram_received(self, data, address):
+        if len(data) < _DNS_HEADER.size or self.future.done():
+            return
+        query_id, flags = struct.unpack_from("!HH", data)
+        if query_id == self.query_id and flags & 0x8000:  # QR bit: this is a response
+            self.future.set_result(time.perf_counter())
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class DnsProbe(Probe):
+    """Time a DNS A query to one server, over UDP.
+
+    Any response counts, NXDOMAIN included: it shows the resolver answered."""
+
+    def __init__(self, server, query_name="example.com", port=53):
+        self.server = server
+        self.query_name = query_name
+        self.port = port
+        self.name = "dns:{}".format(server)
+
+    def build_query(self, query_id):
+        qname = b"".join(struct.pack("!B", len(label)) + label.encode("ascii")
+                         for label in self.query_name.strip(".").split(".")) + b"\x00"
+        # flags 0x0100: recursion desired
+        return (_DNS_HEADER.pack(query_id, 0x0100, 1, 0, 0, 0)
+                + qname + struct.pack("!HH", _DNS_TYPE_A, _DNS_CLASS_IN))
+
+    async def measure(self, timeout=_MAX_PROBE_TIME_SECONDS):
+        loop = asyncio.get_event_loop()
+        query_id = random.getrandbits(16)
+        future = loop.create_future()
+        try:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: _DnsResponseProtocol(query_id, future),
+                remote_addr=(self.server, self.port))
+        except OSError as e:
+            raise NoConnectionException("dns query to {} failed: {!r}".format(self.server, e))
+        try:
+            start = time.perf_counter()
+            transport.sendto(self.build_query(query_id))
+            end = await asyncio.wait_for(future, timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise NoConnectionException("dns query to {} failed: {!r}".format(self.server, e))
+        finally:
+            transport.close()
+        return (end - start) * 1000
+
+
+class HttpTtfbProbe(Probe):
+    """Time from starting a HTTP(S) GET to the first byte of the response."""
+
+    def __init__(self, url):
+        self.url = url
+        self.name = "http:{}".format(url)
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.use_ssl = parts.scheme == "https"
+        self.port = parts.port or (443 if self.use_ssl else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        self.request = ("GET {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: internet_connection_monitor\r\n"
+                        "Connection: close\r\n\r\n").format(path, parts.netloc).encode("ascii")
+
+    async def measure(self, timeout=_MAX_PROBE_TIME_SECONDS):
+        start = time.perf_counter()
+        ssl_context = ssl.create_default_context() if self.use_ssl else None
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=ssl_context), timeout)
+            writer.write(self.request)
+            remaining = timeout - (time.perf_counter() - start)
+            first_byte = await asyncio.wait_for(reader.read(1), max(0.0, remaining))
+        except (OSError, asyncio.TimeoutError, ssl.SSLError) as e:
+            raise NoConnectionException("http get {} failed: {!r}".format(self.url, e))
+        finally:
+            if writer is not None:
+                writer.close()
+        if not first_byte:
+            raise NoConnectionException("http get {} closed without a response".format(self.url))
+        return (time.perf_counter() - start) * 1000
+
+
+async def measure_all(probes, timeout=_MAX_PROBE_TIME_SECONDS):
+    """Run all probes concurrently, return a list of (probe, latency or exception)."""
+    results = await asyncio.gather(*(probe.measure(timeout) for probe in probes),
+                                   return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception) and not isinstance(result, NoConnectionException):
+            raise result
+    return list(zip(probes, results))
+
+
+if __name__ == "__main__":
+    # measure against stand-in servers on 127.0.0.1
+    from event_loop import run_sync
+
+    class StandInDnsServer(asyncio.DatagramProtocol):
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, address):
+            # echo the query back with the QR bit set, no answers
+            self.transport.sendto(data[:2] + b"\x81\x80" + data[4:], address)
+
+    async def serve_http(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(b"HTTP/1.1 204 No Content\r\n\r\n")
+        writer.close()
+
+    async def demo():
+        loop = asyncio.get_event_loop()
+        tcp_server = await asyncio.start_server(lambda r, w: w.close(), "127.0.0.1", 0)
+        http_server = await asyncio.start_server(serve_http, "127.0.0.1", 0)
+        dns_transport, _ = await loop.create_datagram_endpoint(StandInDnsServer, local_addr=("127.0.0.1", 0))
+
+        tcp_port = tcp_server.sockets[0].getsockname()[1]
+        http_port = http_server.sockets[0].getsockname()[1]
+        dns_port = dns_transport.get_extra_info("sockname")[1]
+        closed_port = socket.socket()
+        closed_port.bind(("127.0.0.1", 0))
+
+        probes = [
+            TcpConnectProbe("127.0.0.1", tcp_port),
+            DnsProbe("127.0.0.1", port=dns_port),
+            HttpTtfbProbe("http://127.0.0.1:{}/".format(http_port)),
+            TcpConnectProbe("127.0.0.1", closed_port.getsockname()[1]),
+            TcpConnectProbe("127.0.0.1", closed_port.getsockname()[1], refused_is_up=True),
+        ]
+        for probe, result in await measure_all(probes):
+            print("{:<40} {}".format(probe.name, result))
+
+        closed_port.close()
+        tcp_server.close()
+        http_server.close()
+        dns_transport.close()
+
+    run_sync(demo())
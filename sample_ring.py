@@ -0,0 +1,108 @@
+"""The last N hours of samples, in memory, for consumers that shouldn't re-read the CSV.
+
+SampleRing keeps the same columns as columnar_store (epoch ms, latency, down,
+up, state, interval) in fixed-size arrays allocated up front, so its memory
+use never changes: 25 bytes a sample, 7.5 MB for 7 days at one sample every
+2s. Once full, each new sample overwrites the oldest.
+
+Samples are kept in time order, so a time range is found by binary search,
+O(log n), and copied out as arrays."""
+import threading
+from array import array
+
+from columnar_store import COLUMNS, encode_float, encode_state
+
+_DEFAULT_HOURS = 7 * 24
+_DEFAULT_SAMPLE_PERIOD_SECONDS = 2
+
+
+def capacity_for(hours=_DEFAULT_HOURS, sample_period=_DEFAULT_SAMPLE_PERIOD_SECONDS):
+    """Return the number of samples needed to hold hours of samples taken every sample_period seconds."""
+    return int(hours * 3600 / sample_period)
+
+
+class SampleRing:
+    """Fixed-capacity ring of samples, one array per column. Safe to share between threads.
+
+    Samples have ids counting up from 1 over the life of the ring, so a reader
+    can tell whether anything new arrived (see last_id)."""
+
+    def __init__(self, capacity=capacity_for()):
+        self.capacity = capacity
+        self._columns = dict((name, array(typecode, bytes(array(typecode).itemsize * capacity)))
+                             for name, typecode, _ in COLUMNS)
+        self._epoch_ms = self._columns["epoch_ms"]
+        self._start = 0
+        self._count = 0
+        self.last_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def write_sample(self, unixtime, latency="", down_bandwidth="", up_bandwidth="", state_is_up="",
+                     sample_interval=None, tier_states=None, link=""):
+        """Add one sample, same signature as the writers in columnar_store and sqlite_store.
+
+        A sample dated before the newest one (a fast-detect marker dated back
+        to the moment of the change) is filed at the newest one's time, to
+        keep the ring sorted."""
+        epoch_ms = int(round(unixtime * 1000))
+        values = (encode_float(latency), encode_float(down_bandwidth), encode_float(up_bandwidth),
+                  encode_state(state_is_up), encode_float(sample_interval))
+        with self._lock:
+            if self._count:
+                epoch_ms = max(epoch_ms, self._epoch_ms[(self._start + self._count - 1) % self.capacity])
+            if self._count < self.capacity:
+                index = (self._start + self._count) % self.capacity
+                self._count += 1
+            else:
+                index = self._start
+                self._start = (self._start + 1) % self.capacity
+            self._epoch_ms[index] = epoch_ms
+            for (name, _, _), value in zip(COLUMNS[1:], values):
+                self._columns[name][index] = value
+            self.last_id += 1
+
+    def flush_if_due(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _bisect_locked(self, epoch_ms):
+        """Return the position (0 = oldest) of the first sample at or after epoch_ms."""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._epoch_ms[(self._start + middle) % self.capacity] < epoch_ms:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def slice(self, start=None, end=None):
+        """Return {column name: array} of the samples with start <= unixtime < end (None = open), oldest first."""
+        with self._lock:
+            first = 0 if start is None else self._bisect_locked(int(round(start * 1000)))
+            last = self._count if end is None else self._bisect_locked(int(round(end * 1000)))
+            result = {}
+            for name, values in self._columns.items():
+                result[name] = self._copy_locked(values, first, last)
+            return result
+
+    def _copy_locked(self, values, first, last):
+        # at most two runs: up to the end of the arrays, then from the start
+        first_index = (self._start + first) % self.capacity
+        count = max(0, last - first)
+        if first_index + count <= self.capacity:
+            return values[first_index:first_index + count]
+        return values[first_index:] + values[:first_index + count - self.capacity]
+
+    def latest(self):
+        """Return {column name: value} of the newest sample, or None if there isn't one."""
+        with self._lock:
+            if not self._count:
+                return None
+            index = (self._start + self._count - 1) % self.capacity
+            return dict((name, values[index]) for name, values in self._columns.items())
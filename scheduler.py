@@ -0,0 +1,156 @@
+"""Run periodic events on time, concurrently, from a heap ordered by due time.
+
+Events are anything with a period, a next_run on the time.monotonic() clock,
+reset_timer() and fire(), i.e. monitoring.PeriodicEvent. The scheduler sleeps
+until the earliest one is due, starts it on a worker thread and goes back to
+sleep: a slow event (a path probe, a speed test) doesn't hold up the others.
+An event never overlaps itself; if it is still running when it is due again,
+it starts as soon as it finishes and the missed periods are skipped, the same
+catch-up reset_timer() does after a suspend.
+
+The monotonic clock means NTP steps don't cause missed or doubled runs.
+
+How late each event starts is recorded, see Scheduler.stats()."""
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import time
+
+# an event that raises is retried after this long instead of its period
+_ERROR_BACKOFF_SECONDS = 10
+# starting this late means the box can't keep up
+_OVERLOAD_LAG_SECONDS = 1.0
+
+
+class EventStats:
+    """Scheduling lag (due time to start time) and run time of one event."""
+    __slots__ = ("name", "runs", "errors", "missed_periods", "overruns",
+                 "last_lag", "max_lag", "total_lag", "last_duration", "max_duration")
+
+    def __init__(self, name):
+        self.name = name
+        self.runs = 0
+        self.errors = 0
+        # periods skipped by the catch-up
+        self.missed_periods = 0
+        # times the event was due while its previous run hadn't finished
+        self.overruns = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "runs": self.runs,
+            "errors": self.errors,
+            "missed_periods": self.missed_periods,
+            "overruns": self.overruns,
+            "lag_last_ms": self.last_lag * 1000,
+            "lag_max_ms": self.max_lag * 1000,
+            "lag_mean_ms": self.total_lag * 1000 / self.runs if self.runs else 0.0,
+            "duration_last_ms": self.last_duration * 1000,
+            "duration_max_ms": self.max_duration * 1000,
+        }
+
+
+class Scheduler:
+    """Start events when they are due. Call run_forever() from the thread that owns the loop."""
+
+    def __init__(self, events=(), max_workers=None):
+        self._heap = []
+        self._order = itertools.count()
+        self._stats = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix="scheduler")
+        self._wakeup = None
+        self._running = set()
+        for event in events:
+            self.add(event)
+
+    def add(self, event):
+        name = getattr(event, "name", None) or "event{}".format(len(self._stats))
+        self._stats[id(event)] = EventStats(name)
+        self._push(event)
+
+    def stats(self):
+        """Return a list of dicts, one per event, see EventStats.as_dict()."""
+        return list(stats.as_dict() for stats in self._stats.values())
+
+    def summary(self):
+        """Return a one line description of the lag of every event, for logging."""
+        return " ".join("{}: lag {:.1f}/{:.1f}ms (mean/max), {} runs, {} missed".format(
+            stats["name"], stats["lag_mean_ms"], stats["lag_max_ms"], stats["runs"], stats["missed_periods"])
+            for stats in self.stats())
+
+    def _push(self, event):
+        heapq.heappush(self._heap, (event.next_run, next(self._order), event))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run_forever(self):
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                if not self._heap:
+                    await self._wakeup.wait()
+                    self._wakeup.clear()
+                    continue
+                next_run, _, event = self._heap[0]
+                delay = next_run - time.monotonic()
+                if delay > 0:
+                    # a finished event may be pushed with an earlier due time, so wake for that too
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                heapq.heappop(self._heap)
+                self._start(event, next_run)
+        finally:
+            for task in self._running:
+                task.cancel()
+            # don't wait for a running event, e.g. a speed test, to exit
+            self._executor.shutdown(wait=False)
+
+    def _start(self, event, due):
+        stats = self._stats[id(event)]
+        stats.runs += 1
+        lag = time.monotonic() - due
+        stats.last_lag = lag
+        stats.max_lag = max(stats.max_lag, lag)
+        stats.total_lag += lag
+        if lag > _OVERLOAD_LAG_SECONDS:
+            logging.warning("{} started {:.2f}s late, overloaded?".format(stats.name, lag))
+
+        # plan the next run from the due time, not from now, so runs don't drift
+        planned = event.next_run + event.period
+        event.reset_timer()
+        if event.next_run > planned:
+            stats.missed_periods += int(round((event.next_run - planned) / event.period))
+
+        task = asyncio.ensure_future(self._run(event, stats))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, event, stats):
+        loop = asyncio.get_event_loop()
+        start = time.monotonic()
+        try:
+            await loop.run_in_executor(self._executor, event.fire)
+        except Exception:
+            stats.errors += 1
+            logging.exception("{} failed, retrying in {}s".format(stats.name, _ERROR_BACKOFF_SECONDS))
+            event.next_run = max(event.next_run, time.monotonic() + _ERROR_BACKOFF_SECONDS)
+        stats.last_duration = time.monotonic() - start
+        stats.max_duration = max(stats.max_duration, stats.last_duration)
+
+        if event.next_run < time.monotonic():
+            # still running when it was due again: start now, the catch-up skips what was missed
+            stats.overruns += 1
+        self._push(event)
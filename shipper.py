@@ -0,0 +1,376 @@
+"""Push the monitor's CSV rows to a central collector (see collector.py).
+
+Rows are batched in memory and, once a batch is full or old enough, sealed by
+the sender thread: gzipped into a file in the spool directory. The sender
+thread pushes spooled batches oldest first and deletes each one only once the collector has
+acknowledged it, so every row is delivered at least once: while the collector
+is unreachable batches wait on disk (oldest dropped past max_spool_bytes) and
+go out when it comes back, including after a restart of the monitor.
+
+A batch id is "<shipper id>-<sequence>": the shipper id is made once per
+spool directory, and sequence numbers only go up, the last one being kept
+(fsync'd) in the spool directory so a restart or a clock step can't take them
+back. Since batches are sent in order, the collector only has to remember the
+highest sequence stored from each shipper to drop a batch resent after a lost
+acknowledgement.
+
+A batch the collector refuses for good (an HTTP 4xx, or an ERROR reply over
+tcp) is moved to the spool's rejected/ directory and logged, so it doesn't hold
+up the batches behind it. So are files found at startup that aren't batches, or
+a batch whose sealing was cut short.
+
+Per row this is one join and one list append on the caller's thread;
+compression, fsyncs and network costs are paid by the sender thread once per
+batch (500 rows, or 30s, by default).
+
+Transports, see transport_from_url():
+
+    http://host:port/ingest   POST the gzipped batch, X-Batch-Id and X-Site headers
+    tcp://host:port           a JSON header line then the gzipped batch, answered
+                              with "OK <batch id>"; one connection kept open"""
+import gzip
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from urllib.parse import urlsplit
+
+# seal the batch once it has this many rows or its oldest is this old
+_BATCH_ROWS = 500
+_BATCH_SECONDS = 30
+# drop the oldest spooled batches beyond this (~1 month of 2s samples, compressed)
+_MAX_SPOOL_BYTES = 100 * 1000 * 1000
+# wait this long after a failed push, doubling up to the max
+_RETRY_MIN_SECONDS = 1
+_RETRY_MAX_SECONDS = 300
+_SEND_TIMEOUT_SECONDS = 30
+_SPOOL_EXTENSION = ".csv.gz"
+_SHIPPER_ID_FILENAME = "shipper_id"
+_LAST_SEQUENCE_FILENAME = "last_sequence"
+_REJECTED_DIRECTORY = "rejected"
+# 4xx answers worth trying again: request timeout, too many requests
+_RETRYABLE_HTTP_STATUSES = (408, 429)
+
+
+class DeliveryError(Exception):
+    """The collector didn't acknowledge a batch; it will be sent again."""
+
+
+class BatchRejected(Exception):
+    """The collector refused a batch for good; sending it again won't help."""
+
+
+class HttpTransport:
+    def __init__(self, url, timeout=_SEND_TIMEOUT_SECONDS):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, batch_id, site, payload):
+        request = urllib.request.Request(self.url, data=payload, method="POST", headers={
+            "Content-Type": "text/csv",
+            "Content-Encoding": "gzip",
+            "X-Batch-Id": batch_id,
+            "X-Site": site,
+        })
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+        except urllib.error.HTTPError as e:
+            if 400 <= e.code < 500 and e.code not in _RETRYABLE_HTTP_STATUSES:
+                raise BatchRejected("{}: {}".format(self.url, e))
+            raise DeliveryError("{}: {}".format(self.url, e))
+        except (urllib.error.URLError, OSError) as e:
+            raise DeliveryError("{}: {}".format(self.url, e))
+
+    def close(self):
+        pass
+
+
+class TcpTransport:
+    def __init__(self, address, timeout=_SEND_TIMEOUT_SECONDS):
+        self.address = address
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+
+    def send(self, batch_id, site, payload):
+        header = json.dumps({"batch_id": batch_id, "site": site, "length": len(payload)})
+        try:
+            if self._sock is None:
+                self._sock = socket.create_connection(self.address, timeout=self.timeout)
+                self._reader = self._sock.makefile("rb")
+            self._sock.sendall(header.encode() + b"\n" + payload)
+            reply = self._reader.readline().decode().strip()
+        except OSError as e:
+            self.close()
+            raise DeliveryError("{}:{}: {}".format(self.address[0], self.address[1], e))
+        if reply.startswith("ERROR "):
+            # the collector hangs up after an error
+            self.close()
+            raise BatchRejected("{}:{}: {}".format(self.address[0], self.address[1], reply))
+        if reply != "OK " + batch_id:
+            self.close()
+            raise DeliveryError("{}:{}: unexpected reply {!r}".format(self.address[0], self.address[1], reply))
+
+    def close(self):
+        if self._sock is not None:
+            self._reader.close()
+            self._sock.close()
+            self._sock = None
+            self._reader = None
+
+
+def split_batch_id(batch_id):
+    """Return (shipper id, sequence) of a batch id, raise ValueError if it isn't one."""
+    shipper_id, separator, sequence = batch_id.rpartition("-")
+    if not separator or not shipper_id.isalnum() or not sequence.isdigit():
+        raise ValueError("bad batch id {!r}".format(batch_id))
+    return shipper_id, int(sequence)
+
+
+def load_shipper_id(spool_directory):
+    """Return the spool directory's shipper id, making one the first time."""
+    path = os.path.join(spool_directory, _SHIPPER_ID_FILENAME)
+    try:
+        with open(path) as handle:
+            return handle.read().strip()
+    except FileNotFoundError:
+        pass
+    shipper_id = uuid.uuid4().hex
+    with open(path + ".tmp", "w") as handle:
+        handle.write(shipper_id + "\n")
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(path + ".tmp", path)
+    return shipper_id
+
+
+def load_last_sequence(spool_directory):
+    """Return the last sequence saved by save_last_sequence() in the spool directory, None if there isn't one."""
+    try:
+        with open(os.path.join(spool_directory, _LAST_SEQUENCE_FILENAME)) as handle:
+            return int(handle.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_last_sequence(spool_directory, sequence):
+    path = os.path.join(spool_directory, _LAST_SEQUENCE_FILENAME)
+    with open(path + ".tmp", "w") as handle:
+        handle.write("{}\n".format(sequence))
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def transport_from_url(url):
+    """Return the transport for an http://host:port/path or tcp://host:port url."""
+    parts = urlsplit(url)
+    if parts.scheme in ("http", "https"):
+        return HttpTransport(url)
+    if parts.scheme == "tcp":
+        return TcpTransport((parts.hostname, parts.port))
+    raise ValueError("can't ship to {}: use http://host:port/path or tcp://host:port".format(url))
+
+
+class Shipper:
+    """Batch rows, spool the batches in spool_directory and push them with transport. Safe to share between threads.
+
+    Call start() to begin sending, close() to spool what is left and stop."""
+
+    def __init__(self, spool_directory, transport, site, batch_rows=_BATCH_ROWS, batch_seconds=_BATCH_SECONDS,
+                 max_spool_bytes=_MAX_SPOOL_BYTES):
+        self.spool_directory = spool_directory
+        self.transport = transport
+        self.site = site
+        self.batch_rows = batch_rows
+        self.batch_seconds = batch_seconds
+        self.max_spool_bytes = max_spool_bytes
+        self._rows = []
+        self._oldest_row_time = None
+        # _lock guards the rows being batched, _seal_lock the sequence and the spool files
+        self._lock = threading.Lock()
+        self._seal_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        os.makedirs(spool_directory, exist_ok=True)
+        self.shipper_id = load_shipper_id(spool_directory)
+        last_sequence = load_last_sequence(spool_directory) or 0
+        for name in os.listdir(spool_directory):
+            if name.endswith(_SPOOL_EXTENSION + ".tmp"):
+                # the process died while sealing this batch
+                self._set_aside(name, "shipper: unfinished batch")
+            elif name.endswith(_SPOOL_EXTENSION):
+                try:
+                    sequence = split_batch_id(name[:-len(_SPOOL_EXTENSION)])[1]
+                except ValueError:
+                    self._set_aside(name, "shipper: not a batch")
+                    continue
+                # sealed, but the process may have died before saving its sequence
+                last_sequence = max(last_sequence, sequence)
+        self._last_sequence = last_sequence
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="Shipper", daemon=True)
+        self._thread.start()
+
+    def write_row(self, fields):
+        """Queue one CSV row (a list of strings)."""
+        line = ",".join(fields)
+        with self._lock:
+            is_first = not self._rows
+            if is_first:
+                self._oldest_row_time = time.monotonic()
+            self._rows.append(line)
+            if is_first or len(self._rows) == self.batch_rows:
+                # the sender thread seals the batch: when it is full, or when the first row has waited long enough
+                self._wakeup.set()
+
+    def flush_if_due(self):
+        with self._lock:
+            if self._rows and time.monotonic() - self._oldest_row_time >= self.batch_seconds:
+                self._wakeup.set()
+
+    def flush(self):
+        """Seal the rows in memory now, on the caller's thread."""
+        self._seal(everything=True)
+        self._wakeup.set()
+
+    def close(self, timeout=5):
+        """Spool the rows still in memory and give the sender up to timeout seconds to push them."""
+        self.flush()
+        deadline = time.monotonic() + timeout
+        while self._thread is not None and self.spooled_batches() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+        self.transport.close()
+
+    def spooled_batches(self):
+        """Return the spool's file names, oldest first."""
+        return sorted(name for name in os.listdir(self.spool_directory) if name.endswith(_SPOOL_EXTENSION))
+
+    def _seal(self, everything=False):
+        """Spool full batches, and the rest of the rows if they are old enough (or everything is True)."""
+        with self._seal_lock:
+            while True:
+                with self._lock:
+                    if not self._rows:
+                        return
+                    is_due = time.monotonic() - self._oldest_row_time >= self.batch_seconds
+                    if len(self._rows) < self.batch_rows and not (everything or is_due):
+                        return
+                    rows = self._rows[:self.batch_rows]
+                    del self._rows[:self.batch_rows]
+                try:
+                    self._spool(rows)
+                except Exception:
+                    # e.g. the disk is full: keep the rows for the next try
+                    with self._lock:
+                        self._rows[:0] = rows
+                    raise
+
+    def _spool(self, rows):
+        payload = gzip.compress(("\n".join(rows) + "\n").encode(), compresslevel=6)
+        self._last_sequence += 1
+        batch_id = "{}-{:013d}".format(self.shipper_id, self._last_sequence)
+        path = os.path.join(self.spool_directory, batch_id + _SPOOL_EXTENSION)
+        with open(path + ".tmp", "wb") as handle:
+            handle.write(payload)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(path + ".tmp", path)
+        save_last_sequence(self.spool_directory, self._last_sequence)
+        self._trim_spool()
+
+    def _seconds_until_due(self):
+        with self._lock:
+            if not self._rows:
+                return None
+            return max(0.0, self._oldest_row_time + self.batch_seconds - time.monotonic())
+
+    def _trim_spool(self):
+        names = self.spooled_batches()
+        sizes = dict((name, os.path.getsize(os.path.join(self.spool_directory, name))) for name in names)
+        total = sum(sizes.values())
+        for name in names[:-1]:
+            if total <= self.max_spool_bytes:
+                break
+            logging.warning("shipper: spool over {} bytes, dropping {}".format(self.max_spool_bytes, name))
+            os.remove(os.path.join(self.spool_directory, name))
+            total -= sizes[name]
+
+    def _send_spooled(self):
+        """Push every spooled batch, oldest first. Raises DeliveryError at the first one that fails.
+
+        Batches the collector rejects are set aside (see _set_aside) and the next one is sent."""
+        for name in self.spooled_batches():
+            if self._stopped.is_set():
+                return
+            path = os.path.join(self.spool_directory, name)
+            try:
+                with open(path, "rb") as handle:
+                    payload = handle.read()
+            except FileNotFoundError:
+                continue  # dropped by _trim_spool meanwhile
+            try:
+                self.transport.send(name[:-len(_SPOOL_EXTENSION)], self.site, payload)
+            except BatchRejected as e:
+                self._set_aside(name, "shipper: {}".format(e))
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _set_aside(self, name, reason):
+        """Move a spool file that can't be sent to the rejected/ directory."""
+        logging.error("{}, moving {} to {}".format(reason, name, _REJECTED_DIRECTORY))
+        rejected_directory = os.path.join(self.spool_directory, _REJECTED_DIRECTORY)
+        os.makedirs(rejected_directory, exist_ok=True)
+        try:
+            os.replace(os.path.join(self.spool_directory, name), os.path.join(rejected_directory, name))
+        except FileNotFoundError:
+            pass  # dropped by _trim_spool meanwhile
+
+    def _run(self):
+        retry_delay = _RETRY_MIN_SECONDS
+        # monotonic time of the next push after a failed one, None to push right away
+        retry_at = None
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            try:
+                self._seal()
+            except Exception:
+                logging.exception("shipper: sealing a batch failed")
+                self._stopped.wait(retry_delay)
+                retry_delay = min(_RETRY_MAX_SECONDS, retry_delay * 2)
+                continue
+            if retry_at is None or time.monotonic() >= retry_at:
+                retry_at = None
+                try:
+                    self._send_spooled()
+                except DeliveryError as e:
+                    logging.debug("shipper: {}, retrying in {}s".format(e, retry_delay))
+                    retry_at = time.monotonic() + retry_delay
+                    retry_delay = min(_RETRY_MAX_SECONDS, retry_delay * 2)
+                except Exception:
+                    logging.exception("shipper: sending failed")
+                    retry_at = time.monotonic() + retry_delay
+                else:
+                    retry_delay = _RETRY_MIN_SECONDS
+            # keep sealing on time while waiting to push again
+            timeouts = list(timeout for timeout in (
+                self._seconds_until_due(),
+                None if retry_at is None else max(0.0, retry_at - time.monotonic())) if timeout is not None)
+            self._wakeup.wait(min(timeouts) if timeouts else None)
@@ -0,0 +1,235 @@
+"""A log file that is split into one chunk per day (or hour, or month).
+
+    slf = splitlogfile.SplitIntoChunksByWriteDate(
+            'output.csv',
+            period=splitlogfile.DAILY,
+            auto_delete_older_than_timedelta=datetime.timedelta(days=365),
+            auto_compress_older_than_timedelta=datetime.timedelta(days=31))
+    slf.write(line)
+    slf.write(line)
+
+Chunks sit next to the base name (output.2020-11-04.csv, ...). A manifest,
+output.csv.manifest.json, maps each chunk to the span of time it was written
+in, so readers only open the chunks covering the window they want. The
+manifest is saved when a chunk is opened, rolled over, compressed or deleted
+and on close, so the newest chunk's end time may be stale and readers treat it
+as still open. Old chunks
+are compressed (zstd if the zstandard module is installed, otherwise gzip) and
+deleted by a background thread."""
+import datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# periods are the strftime format of the chunk's key
+HOURLY = "%Y-%m-%dT%H"
+DAILY = "%Y-%m-%d"
+MONTHLY = "%Y-%m"
+
+GZIP = "gzip"
+ZSTD = "zstd"
+
+_COMPRESSED_SUFFIXES = {GZIP: ".gz", ZSTD: ".zst"}
+
+# rows can be written a little after the time they describe (the CSV writer
+# batches them), so readers widen their window by this much
+_READ_SLACK = datetime.timedelta(minutes=5)
+
+
+def manifest_filename(base_filename):
+    return base_filename + ".manifest.json"
+
+
+def has_manifest(base_filename):
+    return os.path.exists(manifest_filename(base_filename))
+
+
+def _load_manifest(base_filename):
+    try:
+        with open(manifest_filename(base_filename)) as handle:
+            return json.load(handle)["chunks"]
+    except FileNotFoundError:
+        return []
+
+
+def _chunk_path(base_filename, chunk):
+    return os.path.join(os.path.dirname(base_filename), chunk["filename"])
+
+
+def open_chunk(base_filename, chunk):
+    """Open a chunk from the manifest for reading text, decompressing if needed."""
+    path = _chunk_path(base_filename, chunk)
+    compression = chunk.get("compression")
+    if compression == GZIP:
+        return gzip.open(path, "rt")
+    if compression == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("{} is zstd compressed, install the zstandard module to read it".format(path))
+        return zstandard.open(path, "rt")
+    return open(path, "r")
+
+
+def chunks_covering(base_filename, start=None, end=None):
+    """Return the manifest entries written between start and end (datetimes, None = open), oldest first."""
+    start_unixtime = None if start is None else (start - _READ_SLACK).timestamp()
+    end_unixtime = None if end is None else (end + _READ_SLACK).timestamp()
+    chunks = sorted(_load_manifest(base_filename), key=lambda c: c["start"])
+    # the newest chunk may still be written to after its recorded end
+    return list(chunk for i, chunk in enumerate(chunks)
+                if (start_unixtime is None or chunk["end"] >= start_unixtime or i == len(chunks) - 1)
+                and (end_unixtime is None or chunk["start"] <= end_unixtime))
+
+
+def iter_lines(base_filename, start=None, end=None):
+    """Yield every line of the chunks covering start..end, oldest chunk first."""
+    for chunk in chunks_covering(base_filename, start, end):
+        try:
+            with open_chunk(base_filename, chunk) as handle:
+                for line in handle:
+                    yield line
+        except FileNotFoundError:
+            # deleted or compressed by the writer since we read the manifest
+            logging.warning("chunk {} went away while reading".format(chunk["filename"]))
+
+
+class SplitIntoChunksByWriteDate:
+    """Write to one file per period, chosen by the time of each write."""
+
+    def __init__(self, base_filename, period=DAILY,
+                 auto_delete_older_than_timedelta=None,
+                 auto_compress_older_than_timedelta=None,
+                 compression=None):
+        self.base_filename = base_filename
+        self.period = period
+        self.auto_delete_older_than_timedelta = auto_delete_older_than_timedelta
+        self.auto_compress_older_than_timedelta = auto_compress_older_than_timedelta
+        if compression is None:
+            compression = ZSTD if zstandard is not None else GZIP
+        self.compression = compression
+
+        self._root, self._extension = os.path.splitext(os.path.basename(base_filename))
+        self._chunks = dict((chunk["filename"], chunk) for chunk in _load_manifest(base_filename))
+        self._handle = None
+        self._current_filename = None
+        self._manifest_lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._maintenance_thread = None
+
+        self._start_maintenance()
+
+    def chunk_filename(self, date_time):
+        return "{}.{}{}".format(self._root, date_time.strftime(self.period), self._extension)
+
+    def write(self, text):
+        now = time.time()
+        filename = self.chunk_filename(datetime.datetime.fromtimestamp(now))
+        if filename != self._current_filename:
+            self._roll_over(filename, now)
+
+        self._handle.write(text)
+        with self._manifest_lock:
+            self._chunks[filename]["end"] = now
+
+    def flush(self):
+        if self._handle is not None:
+            self._handle.flush()
+
+    def fileno(self):
+        if self._handle is None:
+            raise ValueError("I/O operation on closed file")
+        return self._handle.fileno()
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+            self._current_filename = None
+            self._save_manifest()
+
+    def _roll_over(self, filename, now):
+        if self._handle is not None:
+            self._handle.close()
+        self._handle = open(os.path.join(os.path.dirname(self.base_filename), filename), "a")
+        self._current_filename = filename
+        with self._manifest_lock:
+            if filename not in self._chunks:
+                self._chunks[filename] = {"filename": filename, "start": now, "end": now, "compression": None}
+        self._save_manifest()
+        self._start_maintenance()
+
+    def _save_manifest(self):
+        with self._manifest_lock:
+            chunks = sorted((dict(chunk) for chunk in self._chunks.values()), key=lambda c: c["start"])
+        path = manifest_filename(self.base_filename)
+        with self._save_lock:
+            with open(path + ".tmp", "w") as handle:
+                json.dump({"chunks": chunks}, handle, indent=1)
+            os.replace(path + ".tmp", path)
+
+    def _start_maintenance(self):
+        if self._maintenance_thread is not None and self._maintenance_thread.is_alive():
+            return
+        self._maintenance_thread = threading.Thread(target=self._maintain, name="SplitLogFileMaintenance",
+                                                    daemon=True)
+        self._maintenance_thread.start()
+
+    def _maintain(self):
+        """Compress and delete closed chunks that are old enough."""
+        now = time.time()
+        with self._manifest_lock:
+            closed_chunks = list(dict(chunk) for name, chunk in self._chunks.items()
+                                 if name != self._current_filename)
+
+        for chunk in closed_chunks:
+            age = datetime.timedelta(seconds=now - chunk["end"])
+            try:
+                if self.auto_delete_older_than_timedelta is not None and age > self.auto_delete_older_than_timedelta:
+                    self._delete_chunk(chunk)
+                elif (self.auto_compress_older_than_timedelta is not None
+                        and age > self.auto_compress_older_than_timedelta
+                        and chunk.get("compression") is None):
+                    self._compress_chunk(chunk)
+            except OSError:
+                logging.exception("maintenance of {} failed".format(chunk["filename"]))
+        self._save_manifest()
+
+    def _delete_chunk(self, chunk):
+        with self._manifest_lock:
+            del self._chunks[chunk["filename"]]
+        try:
+            os.remove(_chunk_path(self.base_filename, chunk))
+        except FileNotFoundError:
+            pass
+        logging.info("deleted {}".format(chunk["filename"]))
+
+    def _compress_chunk(self, chunk):
+        source = _chunk_path(self.base_filename, chunk)
+        compressed_filename = chunk["filename"] + _COMPRESSED_SUFFIXES[self.compression]
+        destination = _chunk_path(self.base_filename, dict(chunk, filename=compressed_filename))
+
+        with open(source, "rb") as source_handle:
+            if self.compression == ZSTD:
+                with open(destination + ".tmp", "wb") as destination_handle:
+                    zstandard.ZstdCompressor(level=10).copy_stream(source_handle, destination_handle)
+            else:
+                with gzip.open(destination + ".tmp", "wb") as destination_handle:
+                    shutil.copyfileobj(source_handle, destination_handle)
+        os.replace(destination + ".tmp", destination)
+
+        # point readers at the compressed file before the original goes away
+        with self._manifest_lock:
+            del self._chunks[chunk["filename"]]
+            self._chunks[compressed_filename] = dict(chunk, filename=compressed_filename,
+                                                     compression=self.compression)
+        self._save_manifest()
+        os.remove(source)
+        logging.info("compressed {} to {}".format(chunk["filename"], compressed_filename))
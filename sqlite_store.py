@@ -0,0 +1,165 @@
+"""Samples in a SQLite database, for readers that want a time range without reading everything.
+
+The database is in WAL mode: readers (summary.py, graph servers) see a
+consistent snapshot and never block the monitor, and the monitor never
+waits for them. Rows are inserted in batches, one transaction each, and
+looked up through an index on epoch_ms.
+
+    CREATE TABLE samples (epoch_ms, latency, down, up, state, interval, lan, isp, remote, link)
+
+state is 1 up / 0 down / NULL unknown, lan/isp/remote are the consensus tier
+verdicts (1/0/NULL), link the interface the sample was taken on (see
+monitoring._LINKS), "" when not monitoring several. Extra probe rows
+(tcp/dns/http) stay in the CSV."""
+import logging
+import sqlite3
+import threading
+import time
+
+# write the batch once it has this many samples or its oldest is this old
+# (a state change always writes), same as csv_writer
+_FLUSH_ROWS = 64
+_FLUSH_SECONDS = 10
+# readers give up on a locked database after this long (only during schema creation in practice)
+_BUSY_TIMEOUT_MS = 5000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    epoch_ms INTEGER NOT NULL,
+    latency REAL,
+    down REAL,
+    up REAL,
+    state INTEGER,
+    interval REAL,
+    lan INTEGER,
+    isp INTEGER,
+    remote INTEGER,
+    link TEXT
+);
+CREATE INDEX IF NOT EXISTS samples_epoch_ms ON samples (epoch_ms);
+"""
+
+COLUMNS = ("epoch_ms", "latency", "down", "up", "state", "interval", "lan", "isp", "remote", "link")
+_TIERS = ("lan", "isp", "remote")
+
+
+def _float_or_none(value):
+    if value is None or value == "":
+        return None
+    return float(value)
+
+
+def _bool_or_none(value):
+    if value is True or value == "True":
+        return 1
+    if value is False or value == "False":
+        return 0
+    return None
+
+
+class SqliteWriter:
+    """Insert samples into the database in batches. Safe to share between threads."""
+
+    def __init__(self, filename, flush_rows=_FLUSH_ROWS, flush_seconds=_FLUSH_SECONDS):
+        self.filename = filename
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self._rows = []
+        self._oldest_row_time = None
+        # {link: last known state}
+        self._last_states = {}
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def write_sample(self, unixtime, latency="", down_bandwidth="", up_bandwidth="", state_is_up="",
+                     sample_interval=None, tier_states=None, link=""):
+        """Queue one sample. Values may be numbers or the strings save_to_csv writes, "" for none."""
+        state = _bool_or_none(state_is_up)
+        tier_states = tier_states or {}
+        row = ((int(round(unixtime * 1000)), _float_or_none(latency), _float_or_none(down_bandwidth),
+                _float_or_none(up_bandwidth), state, _float_or_none(sample_interval))
+               + tuple(_bool_or_none(tier_states.get(tier)) for tier in _TIERS) + (link,))
+        with self._lock:
+            now = time.monotonic()
+            if not self._rows:
+                self._oldest_row_time = now
+            self._rows.append(row)
+
+            last_state = self._last_states.get(link)
+            state_changed = state is not None and last_state is not None and state != last_state
+            if state is not None:
+                self._last_states[link] = state
+            if (state_changed or len(self._rows) >= self.flush_rows
+                    or now - self._oldest_row_time >= self.flush_seconds):
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def flush_if_due(self):
+        with self._lock:
+            if self._rows and time.monotonic() - self._oldest_row_time >= self.flush_seconds:
+                self._flush_locked()
+
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _connect(self):
+        connection = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA busy_timeout = {:d}".format(_BUSY_TIMEOUT_MS))
+        connection.execute("PRAGMA journal_mode = WAL")
+        # in WAL mode NORMAL only risks the last transactions on power loss, never corruption
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.executescript(_SCHEMA)
+        return connection
+
+    def _flush_locked(self):
+        if not self._rows:
+            return
+        if self._connection is None:
+            self._connection = self._connect()
+        try:
+            with self._connection:
+                self._connection.execute("BEGIN")
+                self._connection.executemany("INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self._rows)
+        except sqlite3.OperationalError:
+            # e.g. disk full; keep the rows and try again on the next flush
+            logging.exception("could not write {} rows to {}".format(len(self._rows), self.filename))
+            return
+        self._rows = []
+
+
+def connect_read_only(filename):
+    """Open the database for reading. Fails rather than creating it if it doesn't exist."""
+    connection = sqlite3.connect("file:{}?mode=ro".format(filename), uri=True)
+    connection.execute("PRAGMA busy_timeout = {:d}".format(_BUSY_TIMEOUT_MS))
+    return connection
+
+
+def iter_samples(filename, start=None, end=None, link=None):
+    """Yield sample rows (see COLUMNS) between start and end (datetimes, None = open), oldest first.
+
+    Only link's rows if given ("" for the untagged ones). The range is
+    answered from the epoch_ms index, rows outside it are never read."""
+    connection = connect_read_only(filename)
+    try:
+        start_ms = -2 ** 63 if start is None else int(start.timestamp() * 1000)
+        end_ms = 2 ** 63 - 1 if end is None else int(end.timestamp() * 1000)
+        query = "SELECT {} FROM samples WHERE epoch_ms BETWEEN ? AND ?".format(", ".join(COLUMNS))
+        parameters = (start_ms, end_ms)
+        if link is not None:
+            query += " AND link = ?"
+            parameters += (link,)
+        cursor = connection.execute(query + " ORDER BY epoch_ms", parameters)
+        while True:
+            rows = cursor.fetchmany(4096)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        connection.close()
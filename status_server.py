@@ -0,0 +1,114 @@
+"""A small HTTP server, run inside the monitor, answering from its in-memory data.
+
+    /samples?hours=6            recent samples as JSON, one list per column
+    /samples?start=..&end=..    the same between two unix times
+    /samples/latency.f32?hours=6
+                                one column as raw native-endian values, same
+                                names and types as the columnar_store files
+
+Missing values are null in JSON and NaN in raw columns. State is 1 up, 0 down,
+255 unknown."""
+import http.server
+import json
+import logging
+import math
+import socketserver
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from columnar_store import COLUMNS, EXTENSIONS
+
+_DEFAULT_ADDRESS = ("127.0.0.1", 8000)
+
+
+class StatusHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Serve routes: {path: function(query dict, request headers) -> (status, content type, body, headers)}."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, routes):
+        self.routes = routes
+        super().__init__(address, StatusRequestHandler)
+
+
+class StatusRequestHandler(http.server.BaseHTTPRequestHandler):
+    server_version = "internet_connection_monitor"
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        route = self.server.routes.get(parts.path)
+        if route is None:
+            self.send_error(404)
+            return
+        query = dict((key, values[-1]) for key, values in parse_qs(parts.query).items())
+        try:
+            status, content_type, body, headers = route(query, self.headers)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except Exception:
+            logging.exception("{} failed".format(self.path))
+            self.send_error(500)
+            return
+
+        self.send_response(status)
+        if content_type is not None:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("status server: " + format, *args)
+
+
+def time_range_from_query(query, now=None):
+    """Return (start, end) unix times from ?hours=N or ?start=..&end=.., None for open ends."""
+    if "hours" in query:
+        now = time.time() if now is None else now
+        return now - float(query["hours"]) * 3600, None
+    start = float(query["start"]) if "start" in query else None
+    end = float(query["end"]) if "end" in query else None
+    return start, end
+
+
+def samples_routes(ring):
+    """Return the /samples routes for a sample_ring.SampleRing."""
+
+    def samples_json(query, headers):
+        start, end = time_range_from_query(query)
+        columns = ring.slice(start, end)
+        document = {"last_id": ring.last_id}
+        for name, typecode, _ in COLUMNS:
+            if typecode == "f":
+                document[name] = list(None if math.isnan(value) else round(value, 3) for value in columns[name])
+            else:
+                document[name] = columns[name].tolist()
+        return 200, "application/json", json.dumps(document).encode(), {}
+
+    def samples_raw(name):
+        def route(query, headers):
+            start, end = time_range_from_query(query)
+            values = ring.slice(start, end)[name]
+            return 200, "application/octet-stream", values.tobytes(), {
+                "X-Sample-Count": str(len(values)),
+                "X-Last-Id": str(ring.last_id),
+            }
+        return route
+
+    routes = {"/samples": samples_json}
+    for name, typecode, _ in COLUMNS:
+        routes["/samples/" + name + EXTENSIONS[typecode]] = samples_raw(name)
+    return routes
+
+
+def start_status_server(routes, address=_DEFAULT_ADDRESS):
+    """Serve routes on a daemon thread, return the server (call shutdown() to stop it)."""
+    server = StatusHTTPServer(address, routes)
+    thread = threading.Thread(target=server.serve_forever, name="StatusServer", daemon=True)
+    thread.start()
+    logging.info("status server on http://{}:{}/".format(*server.server_address[:2]))
+    return server
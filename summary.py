@@ -4,6 +4,8 @@ import csv
 import numpy as np
 
 import datetime
+import itertools
+import os
 
 import matplotlib.pyplot as plt
 from matplotlib.dates import (YEARLY, DateFormatter,
@@ -11,15 +13,34 @@ from matplotlib.dates import (YEARLY, DateFormatter,
 
 import numpy
 
+import columnar_store
+import latency_sketch
+import outage_log
+import splitlogfile
+import sqlite_store
+
 
 # number of bytes to read at the end of the csv. if None, read all
 _CSV_READ_SIZE = 1024 * 8 * 8 * 8 * 3
 _CSV_READ_SIZE = None
 
+# seconds a sample stands for when its row has no interval column (col 15),
+# i.e. rows written before the latency sampling rate became adaptive
+_DEFAULT_SAMPLE_INTERVAL_SECONDS = 2
+
+# consensus mode columns (16-18): whether each tier answered, nearest first.
+# A dropout is put down to the nearest tier that didn't answer.
+_TIER_COLUMNS = (("lan", 16), ("isp", 17), ("remote", 18))
+
+# latency percentiles printed and plotted from the monitor's sketches (see latency_sketch.py)
+_PERCENTILES = (0.5, 0.95, 0.99)
+
 # plot size settings
 _PLOT_WIDTH = 1600
 _PLOT_HEIGHT = 900
 _PLOT_DPI = 96
+# the columnar path draws a line with more points than this as the max of each of this many buckets
+_MAX_DRAWN_POINTS = 2 * _PLOT_WIDTH
 
 
 def average_timedelta(input_list):
@@ -60,12 +81,15 @@ def datetime_from_date_and_time_string(date_str, time_str):
         hour, minute, second = time_str.split(':')
     except ValueError:
         raise ValueError(('failed to parse time_str {}').format(time_str))
+    # fast-detect rows have milliseconds: 17:36:16.250
+    second, _, millisecond = second.partition('.')
     return datetime.datetime(year=int(year),
                              month=int(month),
                              day=int(day),
                              hour=int(hour),
                              minute=int(minute),
-                             second=int(second))
+                             second=int(second),
+                             microsecond=int(millisecond or 0) * 1000)
 
 
 def remove_duplicate_data_points(date_value_tuple):
@@ -89,24 +113,65 @@ def remove_duplicate_data_points(date_value_tuple):
     return results
 
 
-def print_dropout_stats(connected_states):
-    total_duration = connected_states[-1][0] - connected_states[0][0]
-    dropouts = 0
-    dropout_durations = []
-    idx = 0
-    for idx, (date, state) in enumerate(connected_states):
+def dropouts_from_states(tiered_states):
+    """Return a (start, end, tier) tuple per run of down samples in (date, state, failed tier) tuples.
+
+    A dropout lasts from its first down sample to the first up sample after it
+    (the last sample, if there isn't one); its tier is the first failed tier
+    seen during it."""
+    dropouts = []
+    dropout_start = None
+    dropout_tier = None
+    for date, state, failed_tier in tiered_states:
         if state == 0:
-            dropouts += 1
-            try:
-                dropout_duration = connected_states[idx+1][0] - connected_states[idx][0]
-            except IndexError:
-                pass
-            else:
-                dropout_durations.append(dropout_duration)
+            if dropout_start is None:
+                dropout_start = date
+                dropout_tier = failed_tier
+            elif dropout_tier is None:
+                dropout_tier = failed_tier
+        elif dropout_start is not None:
+            dropouts.append((dropout_start, date, dropout_tier))
+            dropout_start = None
+    if dropout_start is not None:
+        dropouts.append((dropout_start, tiered_states[-1][0], dropout_tier))
+    return dropouts
+
+
+def dropouts_from_outage_log(filename, start_date=None, link=None):
+    """Return {link: (start, end, tier) tuples} of the outages in monitoring's outage log (see outage_log.py).
+
+    Only link's if given, "" for the outages of a monitor not using monitoring._LINKS."""
+    start = None if start_date is None else start_date.timestamp()
+    dropouts = {}
+    for outage in outage_log.iter_outages(filename, start, link):
+        dropouts.setdefault(outage.get("link", ""), []).append(
+            (datetime.datetime.fromtimestamp(outage["start"]), datetime.datetime.fromtimestamp(outage["end"]),
+             outage["tier"]))
+    return dropouts
+
+
+def dropouts_from_state_array(dates, states):
+    """Return a (start, end, None) tuple per run of 0s in states, dates being the samples' datetime64s.
+
+    Same runs as dropouts_from_states, found with numpy.diff: only the
+    dropouts become Python datetimes."""
+    if not len(states):
+        return []
+    edges = numpy.diff(numpy.concatenate(([0], states == 0, [0])).astype(numpy.int8))
+    starts = numpy.flatnonzero(edges == 1)
+    # a run still going at the end lasts until the last sample
+    ends = numpy.minimum(numpy.flatnonzero(edges == -1), len(states) - 1)
+    return list(zip(dates[starts].astype(object).tolist(), dates[ends].astype(object).tolist(),
+                    itertools.repeat(None)))
+
+
+def print_dropout_stats(total_duration, dropouts):
+    """Print dropout count and durations of the (start, end, tier) dropouts seen over total_duration."""
+    dropout_durations = list(end - start for start, end, _ in dropouts)
     dropout_durations.sort()
     durations_5_perc = max(1, int(len(dropout_durations) * 10.0 / 100.0))
 
-    logging.info(f"in the last {total_duration}, {dropouts} dropouts")
+    logging.info(f"in the last {total_duration}, {len(dropouts)} dropouts")
     try:
         logging.info(f"max:       {max(dropout_durations)}")
         logging.info(f"worst 10%: {average_timedelta(dropout_durations[-durations_5_perc:])}")
@@ -117,38 +182,102 @@ def print_dropout_stats(connected_states):
         pass
 
 
-def save_data_over_time_graph(filename, connected_states, latencies, down_speeds, up_speeds):
-    fix, ax = plt.subplots()
-    plt.figure(figsize=(_PLOT_WIDTH/_PLOT_DPI, _PLOT_HEIGHT/_PLOT_DPI), dpi=_PLOT_DPI)
+def failed_tier_from_row(row):
+    """Return the nearest tier that did not answer in this row, or None if unknown."""
+    for tier, column in _TIER_COLUMNS:
+        if len(row) > column and row[column] == "False":
+            return tier
+    return None
+
+
+def print_dropout_stats_by_tier(dropouts):
+    """Print dropout counts/durations per tier of (start, end, tier) dropouts."""
+    counts = {}
+    durations = {}
+    for start, end, dropout_tier in dropouts:
+        tier = dropout_tier or "unknown"
+        counts[tier] = counts.get(tier, 0) + 1
+        durations[tier] = durations.get(tier, datetime.timedelta(0)) + (end - start)
+
+    for tier in list(name for name, _ in _TIER_COLUMNS) + ["unknown"]:
+        if tier in counts:
+            logging.info("{:<10} {} dropouts, {} total".format(tier + ":", counts[tier], durations[tier]))
+
+
+def print_uptime_stats(weighted_states):
+    """Print uptime from (date, state, seconds the sample stands for) tuples, see print_uptime_stats_from_arrays."""
+    print_uptime_stats_from_arrays(numpy.array(list(date for date, _, _ in weighted_states), dtype="datetime64[ms]"),
+                                   numpy.array(list(state for _, state, _ in weighted_states), dtype=numpy.int8),
+                                   numpy.array(list(interval for _, _, interval in weighted_states),
+                                               dtype=numpy.float64))
+
+
+def print_uptime_stats_from_arrays(dates, states, intervals):
+    """Print uptime from datetime64 dates, 1/0 states and the seconds each sample stands for.
+
+    Samples are weighted by their interval, so the fast samples taken during
+    trouble don't count for more than the slow ones taken while stable. The
+    interval before a sample is put down to the state the link was last seen
+    in: the sample before it, or a fast-detect marker (interval 0) in between.
+    The first down sample of an outage often comes after a long stable
+    interval, which the link mostly spent up."""
+    order = numpy.argsort(dates, kind="stable")
+    dates, states, intervals = dates[order], states[order], intervals[order]
+    is_marker = intervals == 0
+    positions = numpy.flatnonzero(~is_marker)
+    if not len(positions):
+        return
+    # the last marker at or before each sample, -1 for none
+    last_marker = numpy.maximum.accumulate(numpy.where(is_marker, numpy.arange(len(dates)), -1))[positions]
+    previous_positions = numpy.concatenate(([-1], positions[:-1]))
+    sample_states = states[positions]
+    sample_intervals = intervals[positions]
+    previous_states = numpy.concatenate((sample_states[:1], sample_states[:-1]))
+
+    # only a marker after the previous sample counts
+    has_marker = last_marker > previous_positions
+    marker_positions = numpy.where(has_marker, last_marker, 0)
+    since_marker = (dates[positions] - dates[marker_positions]) / numpy.timedelta64(1, "s")
+    since_marker = numpy.where(has_marker, numpy.minimum(sample_intervals, numpy.maximum(0.0, since_marker)), 0.0)
+
+    total_seconds = float(sample_intervals.sum())
+    down_seconds = float(since_marker[has_marker & (states[marker_positions] == 0)].sum()
+                         + (sample_intervals - since_marker)[previous_states == 0].sum())
+    if total_seconds == 0:
+        return
+    logging.info("uptime:    {:.3f}% (down for {} of {})".format(
+        100.0 * (total_seconds - down_seconds) / total_seconds,
+        datetime.timedelta(seconds=round(down_seconds)),
+        datetime.timedelta(seconds=round(total_seconds))))
+
 
-    logging.debug('plot connected_states...')
+def save_data_over_time_graph(filename, connected_states, latencies, down_speeds, up_speeds):
     connected_states = remove_duplicate_data_points(connected_states)
-    plt.plot_date(list(x[0] for x in connected_states),
-                  list(x[1] for x in connected_states),
-                  linestyle='-',
-                  marker=None)
-    logging.debug('plot latencies...')
     #latencies = remove_duplicate_data_points(latencies)
     #latencies = convert_to_moving_average(latencies, window_size=30)
     latencies = convert_to_max_of_last_n(latencies, window_size=60)
-    plt.plot_date(list(x[0] for x in latencies),
-                  list(x[1] for x in latencies),
-                  linestyle='-',
-                  marker=None)
-    logging.debug('plot down_speeds...')
     #down_speeds = remove_duplicate_data_points(down_speeds)
     #down_speeds = convert_to_moving_average(down_speeds, window_size=3)
-    plt.plot_date(list(x[0] for x in down_speeds),
-                  list(x[1] for x in down_speeds),
-                  linestyle='-',
-                  marker=None)
-    logging.debug('plot up_speeds...')
     #up_speeds = remove_duplicate_data_points(up_speeds)
     #up_speeds = convert_to_moving_average(up_speeds, window_size=3)
-    plt.plot_date(list(x[0] for x in up_speeds),
-                  list(x[1] for x in up_speeds),
-                  linestyle='-',
-                  marker=None)
+    save_series_graph(filename, list((name, list(x[0] for x in points), list(x[1] for x in points))
+                                     for name, points in (("connected_states", connected_states),
+                                                          ("latencies", latencies),
+                                                          ("down_speeds", down_speeds),
+                                                          ("up_speeds", up_speeds))))
+
+
+def save_series_graph(filename, series):
+    """Plot (name, dates, values) series, dates being datetimes or datetime64s, and save the graph to filename."""
+    fix, ax = plt.subplots()
+    plt.figure(figsize=(_PLOT_WIDTH/_PLOT_DPI, _PLOT_HEIGHT/_PLOT_DPI), dpi=_PLOT_DPI)
+
+    for name, dates, values in series:
+        logging.debug('plot {}...'.format(name))
+        plt.plot_date(dates,
+                      values,
+                      linestyle='-',
+                      marker=None)
 
     plt.ylim([-5, 100])
     formatter = DateFormatter('%m/%d/%y')
@@ -156,11 +285,46 @@ def save_data_over_time_graph(filename, connected_states, latencies, down_speeds
     ax.xaxis.set_tick_params(rotation=30, labelsize=10)
 
     plt.savefig(filename)
+    # the graph server draws many graphs in one process, don't keep the figures around
+    plt.close('all')
     logging.debug('saved graph to {}'.format(filename))
     
     #plt.show()
 
 
+def load_latency_percentiles(filename, start_date=None, period_hours=1):
+    """Merge the monitor's per-minute latency sketches, return (sketch of everything, [(period start date, sketch)])."""
+    start = None if start_date is None else start_date.timestamp()
+    periods = latency_sketch.merge_windows(latency_sketch.iter_windows(filename, start), period_hours * 3600)
+    overall = latency_sketch.LatencySketch()
+    for _, sketch in periods:
+        overall.merge(sketch)
+    return overall, list((datetime.datetime.fromtimestamp(period_start), sketch) for period_start, sketch in periods)
+
+
+def print_latency_percentiles(sketch):
+    if not sketch.count:
+        return
+    logging.info("latency:   {} ({} samples, mean {:.2f} ms)".format(
+        ", ".join("p{:g} {:.2f} ms".format(q * 100, sketch.quantile(q)) for q in _PERCENTILES),
+        sketch.count, sketch.mean()))
+
+
+def save_latency_percentile_graph(filename, periods):
+    """Plot p50/p95/p99 latency of each (period start date, sketch)."""
+    fig, ax = plt.subplots(figsize=(_PLOT_WIDTH/_PLOT_DPI, _PLOT_HEIGHT/_PLOT_DPI), dpi=_PLOT_DPI)
+    dates = list(date for date, _ in periods)
+    for q in _PERCENTILES:
+        ax.plot(dates, list(sketch.quantile(q) for _, sketch in periods), label="p{:g}".format(q * 100))
+    ax.set_ylabel("latency (ms)")
+    ax.legend()
+    ax.xaxis.set_major_formatter(DateFormatter('%m/%d/%y'))
+    ax.xaxis.set_tick_params(rotation=30, labelsize=10)
+    fig.savefig(filename)
+    plt.close('all')
+    logging.debug('saved graph to {}'.format(filename))
+
+
 def save_scatter(two_dimensional_list):
 
     len_y = len(two_dimensional_list)
@@ -254,11 +418,242 @@ def save_weekly_binned_data_scatter(connected_states):
     return
 
 
+class LoadedSamples:
+    """(date, value) lists of everything summary.py graphs or summarizes."""
+
+    def __init__(self):
+        self.latencies = []
+        self.down_speeds = []
+        self.up_speeds = []
+        self.connected_states = []
+        # (date, state, seconds the sample stands for)
+        self.weighted_states = []
+        # (date, state, nearest tier that didn't answer)
+        self.tiered_states = []
+
+    def add_csv_row(self, row, start_date=None):
+        # col 0: date (2020-11-04)
+        # col 1: time (17:36:16)
+        try:
+            date = datetime_from_date_and_time_string(row[0], row[1])
+        except ValueError:
+            raise ValueError('fail to parse row[0]={}, row[1]={}'.format(row[0], row[1]))
+        if start_date is not None and date < start_date:
+            return
+        # col 14: extra probe (tcp/dns/http) rows, not the latency ping
+        if len(row) > 14 and row[14] != '':
+            return
+        # col 2: latency (16.25)
+        if row[2] != '':
+            self.latencies.append((date, float(row[2])))
+        # col 3: down speed
+        if row[3] != '':
+            self.down_speeds.append((date, float(row[3])))
+        # col 4: up speed
+        if row[4] != '':
+            self.up_speeds.append((date, float(row[4])))
+        # col 5: is connection up? state
+        if row[5] != '':
+            state = 1 if row[5] == "True" else 0
+            self.connected_states.append((date, state))
+            # col 15: seconds since the previous sample
+            if len(row) > 15 and row[15] != '':
+                interval = float(row[15])
+            else:
+                interval = _DEFAULT_SAMPLE_INTERVAL_SECONDS
+            self.weighted_states.append((date, state, interval))
+            self.tiered_states.append((date, state, failed_tier_from_row(row)))
+
+    def add_sqlite_row(self, row):
+        """Add a row from sqlite_store.iter_samples()."""
+        epoch_ms, latency, down, up, state, interval, lan, isp, remote, _ = row
+        date = datetime.datetime.fromtimestamp(epoch_ms / 1000)
+        if latency is not None:
+            self.latencies.append((date, latency))
+        if down is not None:
+            self.down_speeds.append((date, down))
+        if up is not None:
+            self.up_speeds.append((date, up))
+        if state is not None:
+            self.connected_states.append((date, state))
+            if interval is None:
+                interval = _DEFAULT_SAMPLE_INTERVAL_SECONDS
+            self.weighted_states.append((date, state, interval))
+            failed_tier = next((tier for (tier, _), tier_state in zip(_TIER_COLUMNS, (lan, isp, remote))
+                                if tier_state == 0), None)
+            self.tiered_states.append((date, state, failed_tier))
+
+    def __len__(self):
+        """The number of samples with a state."""
+        return len(self.connected_states)
+
+    def duration(self):
+        if not self.connected_states:
+            return datetime.timedelta(0)
+        dates = list(date for date, _ in self.connected_states)
+        return max(dates) - min(dates)
+
+    def dropouts(self):
+        # fast-detect rows are dated back to the moment the link changed, so they
+        # can land a little after later samples in the file
+        return dropouts_from_states(sorted(self.tiered_states, key=lambda date_state_tier: date_state_tier[0]))
+
+    def print_uptime_stats(self):
+        print_uptime_stats(self.weighted_states)
+
+    def save_graph(self, filename):
+        # a collector's CSV has each monitor's backlog where it arrived, not where it belongs;
+        # sorted before the duplicates are dropped and the latency windows are taken
+        save_data_over_time_graph(filename, *(sorted(points, key=lambda date_value: date_value[0])
+                                              for points in (self.connected_states, self.latencies,
+                                                             self.down_speeds, self.up_speeds)))
+
+
+class ColumnSamples:
+    """The arrays of columnar_store.load() (or a sample_ring slice), summarized and graphed without leaving numpy.
+
+    Dates are local datetime64s, which matplotlib draws as they are. Only the
+    dropouts become Python objects."""
+
+    def __init__(self, columns):
+        epoch_ms = numpy.asarray(columns["epoch_ms"], dtype="=i8")
+        # fast-detect rows are dated back to the moment the link changed, so they can come after later samples
+        order = slice(None)
+        if numpy.any(epoch_ms[1:] < epoch_ms[:-1]):
+            order = numpy.argsort(epoch_ms, kind="stable")
+        self.dates = columnar_store.local_datetime64s(epoch_ms[order])
+        self.latencies = numpy.asarray(columns["latency"])[order]
+        self.down_speeds = numpy.asarray(columns["down"])[order]
+        self.up_speeds = numpy.asarray(columns["up"])[order]
+        states = numpy.asarray(columns["state"])[order]
+        known = states != columnar_store.STATE_UNKNOWN
+        self.state_dates = self.dates[known]
+        self.states = states[known].astype(numpy.int8)
+        self.intervals = numpy.asarray(columns["interval"])[order][known].astype(numpy.float64)
+        self.intervals[numpy.isnan(self.intervals)] = _DEFAULT_SAMPLE_INTERVAL_SECONDS
+
+    def __len__(self):
+        """The number of samples with a state."""
+        return len(self.state_dates)
+
+    def duration(self):
+        if not len(self.state_dates):
+            return datetime.timedelta(0)
+        return (self.state_dates[-1] - self.state_dates[0]).astype(object)
+
+    def dropouts(self):
+        # the columnar store doesn't keep the tier columns
+        return dropouts_from_state_array(self.state_dates, self.states)
+
+    def print_uptime_stats(self):
+        print_uptime_stats_from_arrays(self.state_dates, self.states, self.intervals)
+
+    def save_graph(self, filename):
+        """Same graph as save_data_over_time_graph, with the points picked in numpy."""
+        # remove_duplicate_data_points: keep the ends and both sides of every change
+        keep = numpy.ones(len(self.states), dtype=bool)
+        if len(self.states) > 2:
+            same = self.states[1:] == self.states[:-1]
+            keep[1:-1] = ~(same[:-1] & same[1:])
+        measured = ~numpy.isnan(self.latencies)
+        latency_dates = self.dates[measured]
+        latencies = self.latencies[measured]
+        if len(latencies):
+            # convert_to_max_of_last_n, window_size=60
+            padded = numpy.concatenate((numpy.full(59, latencies[0]), latencies))
+            # a (len, 60) view of the windows; sliding_window_view would need numpy 1.20
+            windows = numpy.lib.stride_tricks.as_strided(padded, shape=(len(latencies), 60),
+                                                         strides=(padded.strides[0], padded.strides[0]),
+                                                         writeable=False)
+            latencies = windows.max(axis=1)
+        if len(latencies) > _MAX_DRAWN_POINTS:
+            # more points than pixels: the peaks are what the graph shows
+            bucket_starts = numpy.linspace(0, len(latencies), _MAX_DRAWN_POINTS, endpoint=False).astype(numpy.int64)
+            latency_dates = latency_dates[bucket_starts]
+            latencies = numpy.maximum.reduceat(latencies, bucket_starts)
+        down_measured = ~numpy.isnan(self.down_speeds)
+        up_measured = ~numpy.isnan(self.up_speeds)
+        save_series_graph(filename, [
+            ("connected_states", self.state_dates[keep], self.states[keep]),
+            ("latencies", latency_dates, latencies),
+            ("down_speeds", self.dates[down_measured], self.down_speeds[down_measured]),
+            ("up_speeds", self.dates[up_measured], self.up_speeds[up_measured]),
+        ])
+
+
+def iter_csv_lines(filename, start_date=None):
+    """Yield the lines of the output CSV.
+
+    If the monitor splits its output (see splitlogfile), only the chunks
+    covering start_date onwards are read, after the old unsplit file if it is
+    still around."""
+    if splitlogfile.has_manifest(filename):
+        if os.path.exists(filename):
+            with open(filename, 'r') as handle:
+                yield from handle
+        yield from splitlogfile.iter_lines(filename, start=start_date)
+        return
+
+    with open(filename, 'r') as handle:
+        filesize = handle.seek(0, 2)  # seek to end
+        if _CSV_READ_SIZE is None:
+            handle.seek(0, 0)  # seek to beginning
+        else:
+            handle.seek(filesize - _CSV_READ_SIZE, 0)  # seek to CSV_READ_SIZE bytes from the end
+            handle.readline()  # throw out the first line: it is probably a partial line
+        yield from handle
+
+
+def load_csv(filename, start_date=None, link=None):
+    """Return {link: LoadedSamples} of the CSV's samples, only link's if given ("" for untagged rows)."""
+    samples = {}
+    for row in csv.reader(iter_csv_lines(filename, start_date), delimiter=','):
+        # col 19: link (interface) the row was sampled on, when monitoring several
+        row_link = row[19] if len(row) > 19 else ''
+        if link is None or row_link == link:
+            if row_link not in samples:
+                samples[row_link] = LoadedSamples()
+            samples[row_link].add_csv_row(row, start_date)
+    # extra probe rows and rows before start_date add nothing
+    return dict((row_link, link_samples) for row_link, link_samples in samples.items() if len(link_samples))
+
+
+def load_columns(directory, start_date=None, link=None):
+    """Return {link: ColumnSamples} of the columnar store's samples, only link's if given."""
+    samples = {}
+    for store_link in columnar_store.links(directory):
+        if link is None or store_link == link:
+            store_samples = ColumnSamples(columnar_store.load(columnar_store.link_directory(directory, store_link),
+                                                              start=start_date))
+            if len(store_samples):
+                samples[store_link] = store_samples
+    return samples
+
+
+def load_sqlite(filename, start_date=None, link=None):
+    """Return {link: LoadedSamples} of the database's samples, only link's if given."""
+    samples = {}
+    for row in sqlite_store.iter_samples(filename, start=start_date, link=link):
+        row_link = row[-1]
+        if row_link not in samples:
+            samples[row_link] = LoadedSamples()
+        samples[row_link].add_sqlite_row(row)
+    return dict((row_link, link_samples) for row_link, link_samples in samples.items() if len(link_samples))
+
+
 def main():
     import argparse
     parser = argparse.ArgumentParser(description='Save network CSV data to png graph.')
     parser.add_argument('--csv_input_filename', default='output.csv', help='location of csv to read for internet status')
     parser.add_argument('--graph_filename', default='graph.png', help='location to save graph')
+    parser.add_argument('--columns_input_directory', help='read samples from this columnar store (see columnar_store.py) instead of the csv')
+    parser.add_argument('--sqlite_input_filename', help='read samples from this database (see sqlite_store.py) instead of the csv')
+    parser.add_argument('--outage_log_filename', help='read dropouts from this outage log (see outage_log.py) instead of working them out from the samples; default outages.jsonl next to the csv, if there is one')
+    parser.add_argument('--latency_sketch_filename', help='read latency percentiles from these sketches (see latency_sketch.py); default latency_sketches.jsonl next to the csv, if there is one')
+    parser.add_argument('--percentile_graph_filename', default='percentiles.png', help='location to save the latency percentile graph')
+    parser.add_argument('--percentile_period_hours', type=float, default=1, help='one point per this many hours in the percentile graph')
+    parser.add_argument('--percentiles_only', action='store_true', help='only print and plot latency percentiles from the sketches, without reading the samples')
+    parser.add_argument('--link', help='only use samples taken on this link (interface) of monitoring._LINKS; by default each link is summarized and graphed (graph.<link>.png) on its own')
     parser.add_argument('--start_n_hours_ago', type=int, help='start the graph using data captured N hours ago')
     parser.add_argument('-q', '--quiet', action='store_true', help='hide status/progress messages')
     parser.add_argument('-v', '--verbose', action='store_true', help='show extra debug messages')
@@ -276,52 +671,67 @@ def main():
     else:
         start_date = None
 
-    latencies = []
-    down_speeds = []
-    up_speeds = []
-    connected_states = []
-
-    logging.debug('load {}'.format(args.csv_input_filename))
-    with open(args.csv_input_filename, 'r') as handle:
-        filesize = handle.seek(0, 2)  # seek to end
-        if _CSV_READ_SIZE is None:
-            handle.seek(0, 0)  # seek to beginning
+    latency_sketch_filename = args.latency_sketch_filename
+    if latency_sketch_filename is None:
+        latency_sketch_filename = os.path.join(os.path.dirname(args.csv_input_filename), 'latency_sketches.jsonl')
+        if not os.path.exists(latency_sketch_filename):
+            latency_sketch_filename = None
+    if latency_sketch_filename is not None:
+        logging.debug('load {}'.format(latency_sketch_filename))
+        overall, periods = load_latency_percentiles(latency_sketch_filename, start_date, args.percentile_period_hours)
+        print_latency_percentiles(overall)
+        if periods:
+            save_latency_percentile_graph(args.percentile_graph_filename, periods)
+    elif args.percentiles_only:
+        parser.error('no latency sketches found, give --latency_sketch_filename')
+    if args.percentiles_only:
+        return
+
+    if args.sqlite_input_filename:
+        logging.debug('load {}'.format(args.sqlite_input_filename))
+        samples_by_link = load_sqlite(args.sqlite_input_filename, start_date, args.link)
+    elif args.columns_input_directory:
+        logging.debug('load {}'.format(args.columns_input_directory))
+        samples_by_link = load_columns(args.columns_input_directory, start_date, args.link)
+    else:
+        logging.debug('load {}'.format(args.csv_input_filename))
+        samples_by_link = load_csv(args.csv_input_filename, start_date, args.link)
+    if not samples_by_link:
+        logging.warning('no samples{}'.format(' of link {}'.format(args.link) if args.link is not None else ''))
+        return
+
+    # the outage log has every dropout already, no need to work them out from the samples
+    outage_log_filename = args.outage_log_filename
+    if outage_log_filename is None:
+        outage_log_filename = os.path.join(os.path.dirname(args.csv_input_filename), 'outages.jsonl')
+        if not os.path.exists(outage_log_filename):
+            outage_log_filename = None
+    log_dropouts = None
+    if outage_log_filename is not None:
+        logging.debug('load {}'.format(outage_log_filename))
+        log_dropouts = dropouts_from_outage_log(outage_log_filename, start_date, args.link)
+
+    # each link on its own: merging them would hide one link's dropouts behind another's samples
+    for link, samples in sorted(samples_by_link.items()):
+        graph_filename = args.graph_filename
+        if len(samples_by_link) > 1:
+            logging.info('link {}:'.format(link or '(untagged)'))
+            if link:
+                root, extension = os.path.splitext(args.graph_filename)
+                graph_filename = '{}.{}{}'.format(root, link, extension)
+        if log_dropouts is not None:
+            # a link without outages has no lines in the log
+            dropouts = log_dropouts.get(link, [])
         else:
-            handle.seek(filesize - _CSV_READ_SIZE, 0)  # seek to CSV_READ_SIZE bytes from the end
-            handle.readline()  # throw out the first line: it is probably a partial line
-
-        plots = csv.reader(handle, delimiter=',')
-        for row in plots:
-            # col 0: date (2020-11-04)
-            # col 1: time (17:36:16)
-            try:
-                date = datetime_from_date_and_time_string(row[0], row[1])
-            except ValueError:
-                raise ValueError('fail to parse row[0]={}, row[1]={}'.format(row[0], row[1]))
-            if start_date is not None and date < start_date:
-                continue
-            # col 2: latency (16.25)
-            if row[2] != '':
-                latencies.append((date, float(row[2])))
-            # col 3: down speed
-            if row[3] != '':
-                down_speeds.append((date, float(row[3])))
-            # col 4: up speed
-            if row[4] != '':
-                up_speeds.append((date, float(row[4])))
-            # col 5: is connection up? state
-            if row[5] != '':
-                connected_states.append((date, 1 if row[5] == "True" else 0))
-
-    # summarize dropout stats
-
-    connected_states = remove_duplicate_data_points(connected_states)
+            dropouts = samples.dropouts()
 
-    # summarize dropout stats
-    print_dropout_stats(connected_states)
+        # summarize dropout stats
+        print_dropout_stats(samples.duration(), dropouts)
+        samples.print_uptime_stats()
+        print_dropout_stats_by_tier(dropouts)
 
-    # plot data over time
-    save_data_over_time_graph(args.graph_filename, connected_states, latencies, down_speeds, up_speeds)
+        # plot data over time
+        samples.save_graph(graph_filename)
 
     # plot scatter
     #save_weekly_binned_data_scatter(connected_states)
@@ -0,0 +1,17 @@
+import unittest
+from unittest import mock
+
+import monitoring
+from monitoring import Link, log_link_latency
+
+
+class LogLinkLatencyTest(unittest.TestCase):
+
+    def test_missing_interface_saves_a_down_row(self):
+        with mock.patch.object(monitoring, "save_to_csv") as save_to_csv:
+            self.assertEqual(log_link_latency(Link("nonexist0", ["127.0.0.1"]), timeout=0.5), (False, None))
+        save_to_csv.assert_called_once_with(state_is_up=False, sample_interval=None, link="nonexist0")
+
+
+if __name__ == "__main__":
+    unittest.main()
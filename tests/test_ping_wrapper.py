@@ -0,0 +1,40 @@
+import asyncio
+import time
+import unittest
+
+from my_exceptions import NoConnectionException
+from ping_wrapper import FastOutageDetector
+
+
+class FastOutageDetectorTest(unittest.TestCase):
+
+    def test_stop_ends_the_thread(self):
+        async def probe(timeout):
+            await asyncio.sleep(0.001)
+
+        detector = FastOutageDetector(probe, lambda state_is_up, unixtime: None,
+                                      send_interval=0.01, deadline=0.05)
+        detector.start()
+        time.sleep(0.2)
+        detector.stop()
+        detector._thread.join(timeout=1)
+        self.assertFalse(detector._thread.is_alive())
+        self.assertTrue(detector.state_is_up)
+
+    def test_stop_while_the_link_is_down(self):
+        async def probe(timeout):
+            raise NoConnectionException("down")
+
+        transitions = []
+        detector = FastOutageDetector(probe, lambda state_is_up, unixtime: transitions.append(state_is_up),
+                                      send_interval=0.01, deadline=0.05)
+        detector.start()
+        time.sleep(0.2)
+        detector.stop()
+        detector._thread.join(timeout=1)
+        self.assertFalse(detector._thread.is_alive())
+        self.assertEqual(transitions, [False])
+
+
+if __name__ == "__main__":
+    unittest.main()